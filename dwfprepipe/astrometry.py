@@ -0,0 +1,241 @@
+import os
+import logging
+
+import numpy as np
+
+from astropy.io import fits
+from pathlib import Path
+from typing import Union, List
+
+logger = logging.getLogger('dwf_prepipe.astrometry')
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+# Blank cards reserved in the header of a calibrated science frame, so that
+# the SCAMP solution can be merged into it without moving the pixel data
+HEADER_RESERVE_CARDS = 72
+
+
+def ldac_imhead(header: fits.Header) -> fits.BinTableHDU:
+    """
+    Build the LDAC_IMHEAD extension of an LDAC catalog.
+    """
+    header_str = header.tostring(endcard=True)
+    col = fits.Column(name='Field Header Card',
+                      format=f'{len(header_str)}A',
+                      array=np.array([header_str])
+                      )
+    imhead = fits.BinTableHDU.from_columns([col])
+    imhead.header['EXTNAME'] = 'LDAC_IMHEAD'
+    imhead.header['TDIM1'] = f'(80, {len(header_str) // 80})'
+
+    return imhead
+
+
+def write_ldac(catalog_path: Union[str, Path],
+               header: fits.Header,
+               columns: List[fits.Column]
+               ) -> Path:
+    """
+    Write a FITS_LDAC catalog, as written by SExtractor and read by SCAMP.
+
+    Args:
+        catalog_path: Path to write the catalog to.
+        header: Header of the image the objects were extracted from.
+        columns: Columns of the LDAC_OBJECTS table.
+
+    Returns:
+        The path to the catalog.
+    """
+    catalog_path = Path(catalog_path)
+
+    objects = fits.BinTableHDU.from_columns(columns)
+    objects.header['EXTNAME'] = 'LDAC_OBJECTS'
+
+    tmp_path = catalog_path.with_name(
+        f'{catalog_path.name}.tmp{os.getpid()}'
+    )
+    fits.HDUList([fits.PrimaryHDU(),
+                  ldac_imhead(header),
+                  objects
+                  ]).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, catalog_path)
+
+    return catalog_path
+
+
+def merge_catalogs(catalogs: List[Union[str, Path]],
+                   out_path: Union[str, Path]
+                   ) -> Path:
+    """
+    Merge the FITS_LDAC catalogs of the CCDs of an exposure into a single
+    multi-extension FITS_LDAC catalog, so that SCAMP solves all CCDs of the
+    exposure together.
+
+    Args:
+        catalogs: Paths to the SExtractor catalog of each CCD. Their order
+            is the order of the extensions in the merged catalog.
+        out_path: Path to write the merged catalog to.
+
+    Returns:
+        The path to the merged catalog.
+    """
+    out_path = Path(out_path)
+
+    hdus = [fits.PrimaryHDU()]
+    for catalog in catalogs:
+        # Each CCD contributes an LDAC_IMHEAD and LDAC_OBJECTS pair
+        with fits.open(catalog, memmap=False) as hdul:
+            for hdu in hdul[1:]:
+                hdus.append(fits.BinTableHDU(data=hdu.data,
+                                             header=hdu.header
+                                             ))
+
+    tmp_path = out_path.with_name(f'{out_path.name}.tmp{os.getpid()}')
+    fits.HDUList(hdus).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, out_path)
+
+    logger.info(f"Merged {len(catalogs)} catalogs into {out_path}")
+
+    return out_path
+
+
+def split_head(head_path: Union[str, Path],
+               frames: List[Union[str, Path]]
+               ) -> List[Path]:
+    """
+    Split the SCAMP header of a merged catalog into a header for each of
+    the frames it was made from.
+
+    Args:
+        head_path: Path to the SCAMP header of the merged catalog.
+        frames: Path to the frame of each extension of the merged catalog,
+            in the same order as the catalogs passed to `merge_catalogs`.
+
+    Returns:
+        The paths to the header of each frame.
+
+    Raises:
+        ValueError: The number of headers does not match the number of
+            frames.
+    """
+    with open(head_path) as f:
+        lines = f.read().splitlines()
+
+    # SCAMP writes one header per extension, each terminated by an END card
+    blocks = []
+    block = []
+    for line in lines:
+        block.append(line)
+        if line[:8].rstrip() == 'END':
+            blocks.append(block)
+            block = []
+
+    if len(blocks) != len(frames):
+        raise ValueError(f"{head_path} has {len(blocks)} headers, but "
+                         f"{len(frames)} frames were given"
+                         )
+
+    head_paths = []
+    for frame, block in zip(frames, blocks):
+        frame_head = Path(str(frame).replace('.fits', '.head'))
+        tmp_path = frame_head.with_name(
+            f'{frame_head.name}.tmp{os.getpid()}'
+        )
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(block) + '\n')
+        os.replace(tmp_path, frame_head)
+        head_paths.append(frame_head)
+
+    return head_paths
+
+
+def read_head(head_path: Union[str, Path]) -> fits.Header:
+    """
+    Read a single SCAMP header file.
+
+    Args:
+        head_path: Path to the header file.
+
+    Returns:
+        The header.
+    """
+    with open(head_path) as f:
+        text = f.read()
+
+    # One card per line, not padded to 80 characters
+    return fits.Header.fromstring(text, sep='\n')
+
+
+def _read_header_bytes(f) -> bytes:
+    """
+    Read the primary header of an open FITS file, up to the end of the
+    block containing the END card.
+    """
+    raw = b''
+    while True:
+        block = f.read(FITS_BLOCK)
+        if len(block) < FITS_BLOCK:
+            raise ValueError(f"No END card in the header of {f.name}")
+        raw += block
+        for i in range(0, FITS_BLOCK, FITS_CARD):
+            if block[i:i + FITS_CARD].rstrip() == b'END':
+                return raw
+
+
+def merge_head(frame: Union[str, Path],
+               head_path: Union[str, Path]
+               ) -> bool:
+    """
+    Merge a SCAMP header into the primary header of a FITS frame, as
+    missfits does. Keywords in the SCAMP header replace those in the frame,
+    and commentary cards are appended.
+
+    If the merged header fits in the header blocks of the frame (using up
+    blank cards, see `HEADER_RESERVE_CARDS`), only those blocks are
+    rewritten in place. Otherwise the frame is rewritten once, to a new file
+    that is moved into place. Any extensions (e.g. an appended mask) are
+    kept.
+
+    Args:
+        frame: Path to the frame.
+        head_path: Path to the SCAMP header.
+
+    Returns:
+        True if the header was updated in place.
+    """
+    head = read_head(head_path)
+
+    with open(frame, 'rb') as f:
+        raw = _read_header_bytes(f)
+    header = fits.Header.fromstring(raw.decode('ascii'))
+
+    for card in head.cards:
+        if card.keyword in ('COMMENT', 'HISTORY'):
+            header.append(card)
+        elif card.keyword:
+            header[card.keyword] = (card.value, card.comment)
+
+    merged = header.tostring().encode('ascii')
+    if len(merged) == len(raw):
+        with open(frame, 'r+b') as f:
+            f.write(merged)
+        logger.debug(f"Merged {head_path} into {frame} in place")
+        return True
+
+    logger.info(f"Header of {frame} is full. Rewriting it to merge "
+                f"{head_path}"
+                )
+    for i in range(HEADER_RESERVE_CARDS):
+        header.append()
+    with fits.open(frame, do_not_scale_image_data=True) as hdul:
+        hdu = fits.PrimaryHDU(data=hdul[0].data,
+                              header=header,
+                              do_not_scale_image_data=True
+                              )
+        tmp_path = f'{frame}.tmp{os.getpid()}'
+        fits.HDUList([hdu] + hdul[1:]).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, frame)
+
+    return False
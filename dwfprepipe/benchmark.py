@@ -0,0 +1,919 @@
+import sys
+import pkgutil
+import logging
+import subprocess
+
+from pathlib import Path
+from typing import Union, List, Dict, Tuple
+
+logger = logging.getLogger('dwf_prepipe.benchmark')
+
+# Maximum cold import time of each command line entry point, in seconds
+STARTUP_BUDGET = 0.15
+
+
+def entry_points() -> List[str]:
+    """
+    Get the modules of all dwfprepipe command line entry points.
+
+    Args:
+        None
+
+    Returns:
+        The module names, e.g. `dwfprepipe.bin.run_prepipe`.
+    """
+    import dwfprepipe.bin
+
+    return sorted(f'dwfprepipe.bin.{module.name}'
+                  for module in pkgutil.iter_modules(dwfprepipe.bin.__path__)
+                  )
+
+
+def parse_importtime(importtime_out: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Parse the output of `python -X importtime`.
+
+    Args:
+        importtime_out: The stderr of the python process.
+
+    Returns:
+        A dictionary of the self and cumulative import time of each module,
+        in microseconds.
+    """
+    times = {}
+    for line in importtime_out.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        cols = line[len('import time:'):].split('|')
+        try:
+            self_us = int(cols[0])
+            cumulative_us = int(cols[1])
+        except ValueError:
+            # Column headings
+            continue
+        times[cols[2].strip()] = (self_us, cumulative_us)
+
+    return times
+
+
+def measure_import_time(module: str,
+                        repeat: int = 5
+                        ) -> Tuple[float, Dict[str, Tuple[int, int]]]:
+    """
+    Measure the cold import time of a module, in a fresh interpreter for
+    each repeat.
+
+    Args:
+        module: Name of the module to import.
+        repeat: Number of times to import the module.
+
+    Returns:
+        The fastest import time in seconds, and the import times of all
+        modules imported in the fastest run.
+
+    Raises:
+        RuntimeError: The module could not be imported.
+    """
+    best = None
+    best_times = {}
+    for i in range(repeat):
+        result = subprocess.run([sys.executable,
+                                 '-X',
+                                 'importtime',
+                                 '-c',
+                                 f'import {module}'
+                                 ],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True
+                                )
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not import {module}:\n"
+                               f"{result.stderr}"
+                               )
+
+        times = parse_importtime(result.stderr)
+        elapsed = times[module][1] / 1e6
+        logger.debug(f"{module} run {i}: {elapsed * 1e3:.1f} ms")
+        if best is None or elapsed < best:
+            best = elapsed
+            best_times = times
+
+    return best, best_times
+
+
+def benchmark_startup(modules: List[str],
+                      budget: float,
+                      repeat: int = 5,
+                      n_slowest: int = 5
+                      ) -> List[str]:
+    """
+    Check the start-up time of command line entry points against a budget.
+
+    Args:
+        modules: Entry point modules to check.
+        budget: Maximum import time in seconds.
+        repeat: Number of times to import each module.
+        n_slowest: Number of the slowest imports to report for modules
+            that are over budget.
+
+    Returns:
+        The modules that are over budget.
+    """
+    over_budget = []
+    for module in modules:
+        elapsed, times = measure_import_time(module, repeat=repeat)
+        if elapsed <= budget:
+            logger.info(f"{module}: {elapsed * 1e3:.1f} ms")
+            continue
+
+        logger.error(f"{module}: {elapsed * 1e3:.1f} ms is over the "
+                     f"budget of {budget * 1e3:.0f} ms"
+                     )
+        slowest = sorted(times.items(), key=lambda t: t[1][0], reverse=True)
+        for name, (self_us, cumulative_us) in slowest[:n_slowest]:
+            logger.error(f"    {name}: {self_us / 1e3:.1f} ms "
+                         f"({cumulative_us / 1e3:.1f} ms cumulative)"
+                         )
+        over_budget.append(module)
+
+    return over_budget
+
+
+def make_raw_frame(filepath: Union[str, Path],
+                   bitpix: int = 16,
+                   seed: int = 0):
+    """
+    Write a synthetic raw DECam CCD frame, with the same shape, amplifier
+    layout and header keywords as a real one.
+
+    Args:
+        filepath: Path to write the frame to.
+        bitpix: 16 for an unsigned integer frame like those from
+            j2f_DECam, or -32 for a float frame like a master bias.
+        seed: Random seed.
+
+    Returns:
+        None
+    """
+    import numpy as np
+    from astropy.io import fits
+
+    rng = np.random.default_rng(seed)
+    data = rng.normal(2000, 20, size=(4146, 2160))
+    # A few saturated stars
+    rows = rng.integers(51, 4146, 100)
+    cols = rng.integers(57, 2104, 100)
+    data[rows, cols] = 70000
+
+    header = fits.Header()
+    header['EXPNUM'] = 1
+    header['CCDNUM'] = 1
+    header['DATASEC'] = '[57:2104,51:4146]'
+    header['DATASECA'] = '[1081:2104,51:4146]'
+    header['DATASECB'] = '[57:1080,51:4146]'
+    header['BIASSECA'] = '[2105:2154,51:4146]'
+    header['BIASSECB'] = '[7:56,51:4146]'
+    header['CCDSECA'] = '[1025:2048,1:4096]'
+    header['CCDSECB'] = '[1:1024,1:4096]'
+    header['SATURATA'] = 40000
+    header['SATURATB'] = 40000
+
+    if bitpix == 16:
+        hdu = fits.PrimaryHDU(np.clip(data, 0, 65535).astype('uint16'),
+                              header=header
+                              )
+    else:
+        hdu = fits.PrimaryHDU(data.astype('float32'), header=header)
+
+    hdu.writeto(filepath, overwrite=True)
+
+
+def measure_peak_memory(func, *args, **kwargs) -> Tuple[int, object]:
+    """
+    Measure the peak memory allocated while running a function.
+
+    Memory-mapped file contents are not allocations, so they are not
+    counted.
+
+    Args:
+        func: Function to run.
+        *args: Passed to `func`.
+        **kwargs: Passed to `func`.
+
+    Returns:
+        The peak traced memory in bytes, and the return value of `func`.
+    """
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return peak, result
+
+
+def _overscan_file(filepath: Union[str, Path], overscan_func):
+    from astropy.io import fits
+
+    with fits.open(filepath) as hdul:
+        hdu, mask = overscan_func(hdul[0])
+
+    return hdu.data, mask.data
+
+
+def benchmark_overscan_memory(work_dir: Union[str, Path]
+                              ) -> Dict[str, Dict[str, float]]:
+    """
+    Measure the peak memory of `overscan_and_mask_single` for a science
+    frame and a bias of a single CCD, against the original implementation,
+    `overscan_and_mask_reference`.
+
+    Args:
+        work_dir: Directory to write the synthetic frames to.
+
+    Returns:
+        A dictionary of the peak memory in MiB and as a multiple of the
+        float32 frame size, for each frame type with each implementation
+        (e.g. `science` and `science (reference)`). The entries of
+        `overscan_and_mask_single` also have the fraction of the reference
+        peak that was saved, and whether the image and mask are identical
+        to the reference.
+    """
+    import numpy as np
+    from dwfprepipe.bin.prepipe_preprocess import (
+        overscan_and_mask_single,
+        overscan_and_mask_reference
+    )
+
+    work_dir = Path(work_dir)
+    frames = {'science': (work_dir / 'science.fits', 16),
+              'bias': (work_dir / 'bias.fits', -32),
+              }
+
+    results = {}
+    for name, (filepath, bitpix) in frames.items():
+        make_raw_frame(filepath, bitpix=bitpix)
+
+        peak_ref, (data_ref, mask_ref) = measure_peak_memory(
+            _overscan_file,
+            filepath,
+            overscan_and_mask_reference
+        )
+        peak, (data, mask) = measure_peak_memory(_overscan_file,
+                                                 filepath,
+                                                 overscan_and_mask_single
+                                                 )
+
+        frame_bytes = data.size * 4
+        results[f'{name} (reference)'] = {
+            'peak_mib': peak_ref / 2 ** 20,
+            'frames': peak_ref / frame_bytes,
+        }
+        results[name] = {'peak_mib': peak / 2 ** 20,
+                         'frames': peak / frame_bytes,
+                         'saved': 1 - peak / peak_ref,
+                         'identical': bool(
+                             np.array_equal(data, data_ref) and
+                             np.array_equal(mask, mask_ref)
+                         ),
+                         }
+        logger.debug(f"{name}: peak {peak / 2 ** 20:.1f} MiB, reference "
+                     f"{peak_ref / 2 ** 20:.1f} MiB"
+                     )
+
+    return results
+
+
+def make_star_field(n_stars: int = 1000,
+                    shape: Tuple[int, int] = (4096, 2048),
+                    fwhm: float = 3.5,
+                    sky: float = 100.0,
+                    seed: int = 0):
+    """
+    Make a synthetic calibrated CCD image of Gaussian stars on a noisy sky,
+    with a bad column.
+
+    Args:
+        n_stars: Number of stars.
+        shape: Shape of the image.
+        fwhm: FWHM of the stars in pixels.
+        sky: Sky level. The noise is Gaussian with a variance of `sky`.
+        seed: Random seed.
+
+    Returns:
+        The image, its mask, a header with a TAN WCS, and the 1-based
+        positions and fluxes of the stars.
+    """
+    import numpy as np
+    from astropy.io import fits
+
+    rng = np.random.default_rng(seed)
+    data = rng.normal(sky, np.sqrt(sky), size=shape).astype('float32')
+
+    half = int(np.ceil(3 * fwhm))
+    x = rng.uniform(half, shape[1] - half - 1, n_stars)
+    y = rng.uniform(half, shape[0] - half - 1, n_stars)
+    flux = 10 ** rng.uniform(3, 5.5, n_stars)
+
+    sigma = fwhm / 2.3548
+    offsets = np.arange(-half, half + 1)
+    for xi, yi, fi in zip(x, y, flux):
+        x0 = int(round(xi))
+        y0 = int(round(yi))
+        gx = np.exp(-(x0 + offsets - xi) ** 2 / (2 * sigma ** 2))
+        gy = np.exp(-(y0 + offsets - yi) ** 2 / (2 * sigma ** 2))
+        data[y0 - half:y0 + half + 1, x0 - half:x0 + half + 1] += \
+            fi / (2 * np.pi * sigma ** 2) * np.outer(gy, gx)
+
+    # A bad column, masked and set to NaN like calibrate_frame does
+    mask = np.zeros(shape, dtype='uint8')
+    mask[:, shape[1] // 3] = 2 ** 2
+    data[:, shape[1] // 3] = np.nan
+
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = 150.0
+    header['CRVAL2'] = -30.0
+    header['CRPIX1'] = shape[1] / 2
+    header['CRPIX2'] = shape[0] / 2
+    header['CD1_1'] = -0.263 / 3600
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 0.263 / 3600
+
+    truth = {'x': x + 1, 'y': y + 1, 'flux': flux}
+
+    return data, mask, header, truth
+
+
+def match_positions(x, y, x_ref, y_ref, radius: float = 1.0):
+    """
+    Match each position to the nearest reference position within a radius.
+
+    Args:
+        x: x positions.
+        y: y positions.
+        x_ref: Reference x positions.
+        y_ref: Reference y positions.
+        radius: Match radius.
+
+    Returns:
+        The indices of the matched positions, the indices of their
+        reference positions, and the separations.
+    """
+    import numpy as np
+
+    cells = {}
+    for j, key in enumerate(zip((x_ref // radius).astype(int),
+                                (y_ref // radius).astype(int)
+                                )):
+        cells.setdefault(key, []).append(j)
+
+    index = []
+    index_ref = []
+    separation = []
+    for i, (cx, cy) in enumerate(zip((x // radius).astype(int),
+                                     (y // radius).astype(int)
+                                     )):
+        candidates = [j
+                      for dx in (-1, 0, 1)
+                      for dy in (-1, 0, 1)
+                      for j in cells.get((cx + dx, cy + dy), [])
+                      ]
+        if not candidates:
+            continue
+        dist = np.hypot(x_ref[candidates] - x[i], y_ref[candidates] - y[i])
+        best = int(np.argmin(dist))
+        if dist[best] <= radius:
+            index.append(i)
+            index_ref.append(candidates[best])
+            separation.append(dist[best])
+
+    return (np.array(index, dtype=int),
+            np.array(index_ref, dtype=int),
+            np.array(separation)
+            )
+
+
+def _read_catalog_objects(catalog_path: Union[str, Path]):
+    from astropy.io import fits
+
+    with fits.open(catalog_path) as hdul:
+        return hdul['LDAC_OBJECTS'].data.copy()
+
+
+def _compare_catalog(objects, truth, match_radius: float) -> Dict[str, float]:
+    import numpy as np
+
+    index, index_ref, separation = match_positions(objects['XWIN_IMAGE'],
+                                                   objects['YWIN_IMAGE'],
+                                                   truth['x'],
+                                                   truth['y'],
+                                                   radius=match_radius
+                                                   )
+    true_mag = 27.5 - 2.5 * np.log10(truth['flux'][index_ref])
+
+    return {'sources': len(objects),
+            'completeness': len(index) / len(truth['x']),
+            'offset': float(np.median(separation)),
+            'mag_offset': float(np.median(objects['MAG_AUTO'][index] -
+                                          true_mag
+                                          )),
+            }
+
+
+def benchmark_extraction(work_dir: Union[str, Path],
+                         n_stars: int = 1000,
+                         seed: int = 0,
+                         match_radius: float = 1.0
+                         ) -> Dict[str, Dict[str, float]]:
+    """
+    Compare the SEP and SExtractor extraction backends on a synthetic star
+    field. Backends that are not available are skipped.
+
+    Args:
+        work_dir: Directory to write the images and catalogs to.
+        n_stars: Number of stars in the field.
+        seed: Random seed.
+        match_radius: Radius in pixels to match sources within.
+
+    Returns:
+        A dictionary of the run time, bytes written, number of sources,
+        completeness, median offset from the true positions and median
+        MAG_AUTO offset from the true magnitudes, for each backend. If both
+        backends ran, the entry `sep_vs_sextractor` has the fraction of
+        SExtractor sources that SEP found, and the median offset between
+        their positions and magnitudes.
+    """
+    import time
+    import shutil
+    import numpy as np
+    from astropy.io import fits
+    from dwfprepipe.extraction import extract_catalog, use_sep
+    from dwfprepipe.bin.prepipe_preprocess import run_sextractor
+
+    work_dir = Path(work_dir)
+    data, mask, header, truth = make_star_field(n_stars, seed=seed)
+
+    results = {}
+    objects = {}
+    if use_sep:
+        catalog = work_dir / 'sep.cat'
+        start = time.perf_counter()
+        extract_catalog(data, mask, header, catalog)
+        elapsed = time.perf_counter() - start
+        objects['sep'] = _read_catalog_objects(catalog)
+        results['sep'] = {'seconds': elapsed,
+                          'bytes_written': catalog.stat().st_size,
+                          }
+    else:
+        logger.warning("sep is not installed. Skipping the SEP backend.")
+
+    if shutil.which('sex') is not None:
+        image = work_dir / 'sextractor.fits'
+        start = time.perf_counter()
+        fits.PrimaryHDU(data, header=header).writeto(image, overwrite=True)
+        catalog = Path(run_sextractor(str(image), str(image)))
+        elapsed = time.perf_counter() - start
+        objects['sextractor'] = _read_catalog_objects(catalog)
+        noise = Path(str(image).replace('fits', 'noise.fits'))
+        written = image.stat().st_size + catalog.stat().st_size
+        if noise.is_file():
+            written += noise.stat().st_size
+        results['sextractor'] = {'seconds': elapsed,
+                                 'bytes_written': written,
+                                 }
+    else:
+        logger.warning("sex is not on the PATH. Skipping the SExtractor "
+                       "backend."
+                       )
+
+    for name in objects:
+        results[name].update(_compare_catalog(objects[name],
+                                              truth,
+                                              match_radius
+                                              ))
+
+    if len(objects) == 2:
+        sep_objects = objects['sep']
+        sex_objects = objects['sextractor']
+        index, index_ref, separation = match_positions(
+            sep_objects['XWIN_IMAGE'],
+            sep_objects['YWIN_IMAGE'],
+            sex_objects['XWIN_IMAGE'],
+            sex_objects['YWIN_IMAGE'],
+            radius=match_radius
+        )
+        results['sep_vs_sextractor'] = {
+            'matched': len(index) / max(1, len(sex_objects)),
+            'offset': float(np.median(separation)),
+            'mag_offset': float(np.median(sep_objects['MAG_AUTO'][index] -
+                                          sex_objects['MAG_AUTO'][index_ref]
+                                          )),
+        }
+
+    return results
+
+
+def benchmark_footprint(work_dir: Union[str, Path],
+                        seed: int = 0
+                        ) -> Dict[str, Dict[str, float]]:
+    """
+    Measure the bytes written per CCD by each output profile, for a
+    synthetic calibrated CCD.
+
+    SExtractor is not run. Its BACKGROUND_RMS check image is emulated by a
+    float32 image of the same size, and the catalog is left out as it is the
+    same for all profiles.
+
+    Args:
+        work_dir: Directory to write the products to.
+        seed: Random seed.
+
+    Returns:
+        A dictionary of the bytes written, number of files and the time
+        taken to write them, for each output profile.
+    """
+    import time
+    import numpy as np
+    from astropy.io import fits
+    from dwfprepipe.products import OUTPUT_PROFILES, append_mask
+    from dwfprepipe.bin.prepipe_preprocess import write_calibrated
+
+    work_dir = Path(work_dir)
+    data, mask, header, truth = make_star_field(seed=seed)
+
+    results = {}
+    for name, profile in OUTPUT_PROFILES.items():
+        profile_dir = work_dir / name
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        frame = str(profile_dir / 'frame.fits')
+
+        start = time.perf_counter()
+        write_calibrated(frame, data, mask, header, profile=profile)
+        if profile.check_images:
+            noise = np.full(data.shape, np.sqrt(np.nanmedian(data)),
+                            dtype=np.float32
+                            )
+            fits.PrimaryHDU(noise).writeto(frame.replace('fits',
+                                                         'noise.fits'
+                                                         ))
+        if profile.mef:
+            append_mask(frame, mask, header, profile.mask_compression)
+        elapsed = time.perf_counter() - start
+
+        products = list(profile_dir.iterdir())
+        results[name] = {'bytes_written': sum(path.stat().st_size
+                                              for path in products
+                                              ),
+                         'files': len(products),
+                         'seconds': elapsed,
+                         }
+        logger.debug(f"{name}: {', '.join(path.name for path in products)}")
+
+    return results
+
+
+def make_calibration_inputs(shape: Tuple[int, int] = (4096, 2048),
+                            seed: int = 0):
+    """
+    Make a synthetic overscan corrected image and the calibration products
+    of a CCD, trimmed to the data section, with saturated, dead and bad
+    pixels. The products have the dtypes the pipeline gives them: the flat
+    is a raw uint16 frame normalised by `normalise_flat`.
+
+    Args:
+        shape: Shape of the images.
+        seed: Random seed.
+
+    Returns:
+        The image, bias, normalised flat, saturation mask and bad pixels.
+    """
+    import numpy as np
+    from dwfprepipe.bin.prepipe_preprocess import normalise_flat
+
+    rng = np.random.default_rng(seed)
+    data = rng.normal(1000, 30, size=shape).astype('float32')
+    bias = rng.normal(0, 5, size=shape).astype('float32')
+    raw_flat = rng.normal(20000, 400, size=shape).astype('uint16')
+
+    # Dead pixels in the flat, one of which is also empty in the image
+    rows = rng.integers(0, shape[0], 100)
+    cols = rng.integers(0, shape[1], 100)
+    raw_flat[rows, cols] = 0
+    flat = normalise_flat(raw_flat)
+    data[rows[0], cols[0]] = bias[rows[0], cols[0]]
+
+    mask = np.zeros(shape, dtype='uint8')
+    rows = rng.integers(0, shape[0], 100)
+    cols = rng.integers(0, shape[1], 100)
+    data[rows, cols] = 70000
+    mask[rows, cols] = 2 ** 0
+
+    bad_pixels = np.zeros(shape, dtype=bool)
+    bad_pixels[:, shape[1] // 3] = True
+
+    return data, bias, flat, mask, bad_pixels
+
+
+def benchmark_calibration(n_threads: int = 4,
+                          seed: int = 0
+                          ) -> Dict[str, Dict[str, float]]:
+    """
+    Compare each backend of the fused calibration kernel against the
+    whole-image reference calibration, for a synthetic CCD.
+
+    Args:
+        n_threads: Number of threads to also run each backend with.
+        seed: Random seed.
+
+    Returns:
+        A dictionary of the run time, peak memory in MiB and whether the
+        calibrated image and mask are bit-for-bit identical to the
+        reference, for the reference and each backend and thread count.
+    """
+    import time
+    import numpy as np
+    from dwfprepipe.kernels import (calibrate_image,
+                                    calibrate_image_reference,
+                                    available_backends
+                                    )
+
+    data, bias, flat, mask, bad_pixels = make_calibration_inputs(seed=seed)
+
+    def run(func, **kwargs):
+        run_mask = mask.copy()
+        run_data = data.copy()
+        start = time.perf_counter()
+        peak, calibpix = measure_peak_memory(func,
+                                             run_data,
+                                             bias,
+                                             flat,
+                                             run_mask,
+                                             bad_pixels,
+                                             **kwargs
+                                             )
+        elapsed = time.perf_counter() - start
+        return calibpix, run_mask, {'seconds': elapsed,
+                                    'peak_mib': peak / 2 ** 20,
+                                    }
+
+    reference, reference_mask, result = run(calibrate_image_reference)
+    result['identical'] = True
+    results = {'reference': result}
+
+    for backend in available_backends():
+        if backend == 'numba':
+            # Compile the kernel before timing it
+            calibrate_image(data[:1], bias[:1], flat[:1], mask[:1].copy(),
+                            bad_pixels[:1], backend=backend
+                            )
+        for threads in sorted({1, n_threads}):
+            calibpix, calib_mask, result = run(calibrate_image,
+                                               n_threads=threads,
+                                               backend=backend
+                                               )
+            result['identical'] = bool(
+                calibpix.dtype == reference.dtype and
+                np.array_equal(calibpix.view(f'u{calibpix.itemsize}'),
+                               reference.view(f'u{reference.itemsize}')
+                               ) and
+                np.array_equal(calib_mask, reference_mask)
+            )
+            results[f'{backend} ({threads} threads)'] = result
+
+    return results
+
+
+class _SlowStream:
+    """
+    A text stream that waits before each write, standing in for a slow
+    terminal (e.g. over ssh) or network file system.
+    """
+
+    def __init__(self, stream, write_latency: float):
+        """
+        Constructor method.
+
+        Args:
+            stream: Stream to write to.
+            write_latency: Time to wait before each write, in seconds.
+        """
+        self.stream = stream
+        self.write_latency = write_latency
+
+    def write(self, text: str) -> int:
+        import time
+
+        time.sleep(self.write_latency)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def benchmark_logging(work_dir: Union[str, Path],
+                      n_calls: int = 2000,
+                      n_files: int = 50,
+                      poll_time: float = 1e-3,
+                      write_latency: float = 0
+                      ) -> Dict[str, Dict[str, float]]:
+    """
+    Measure the time taken by the logging calls of the listen loops, with
+    the handlers run synchronously and from the log queue.
+
+    Each call logs the list of files in the watched directory, as
+    `Prepipe.listen` does every poll, to a log file and a stream standing in
+    for the terminal. The loop sleeps between calls, as the
+    listen loops do, so that only the time spent in the calls is measured.
+
+    Args:
+        work_dir: Directory to write the logs to.
+        n_calls: Number of logging calls.
+        n_files: Number of files in each logged list.
+        poll_time: Time to sleep between calls.
+        write_latency: Time taken by each write to the stream, in seconds.
+
+    Returns:
+        A dictionary of the time per call in microseconds, the time taken to
+        flush the queue in seconds, and the number of lines written to the
+        log file, for each logging setup.
+    """
+    import time
+    from dwfprepipe.utils import make_log_handlers, start_log_queue
+
+    work_dir = Path(work_dir)
+    files = [str(work_dir / f'c4d_{i:06d}_ori.fits.fz')
+             for i in range(n_files)
+             ]
+
+    results = {}
+    for name, queued, json_logs in (('synchronous', False, False),
+                                    ('queued', True, False),
+                                    ('queued json', True, True),
+                                    ):
+        logfile = work_dir / f"{name.replace(' ', '_')}.log"
+        stream_path = logfile.with_suffix('.stream')
+
+        bench_logger = logging.getLogger(f'dwf_prepipe.benchmark.{name}')
+        bench_logger.propagate = False
+        bench_logger.setLevel(logging.DEBUG)
+
+        with open(stream_path, 'w') as stream:
+            if write_latency > 0:
+                stream = _SlowStream(stream, write_latency)
+            handlers = make_log_handlers(False,
+                                         False,
+                                         logfile=logfile,
+                                         json_logs=json_logs,
+                                         stream=stream
+                                         )
+            if queued:
+                queue_handler, listener = start_log_queue(bench_logger,
+                                                          handlers
+                                                          )
+            else:
+                for handler in handlers:
+                    bench_logger.addHandler(handler)
+
+            elapsed = 0
+            for i in range(n_calls):
+                start = time.perf_counter()
+                bench_logger.info(f"Current files: {files}")
+                elapsed += time.perf_counter() - start
+                time.sleep(poll_time)
+
+            start = time.perf_counter()
+            if queued:
+                listener.stop()
+                bench_logger.removeHandler(queue_handler)
+            drain = time.perf_counter() - start
+
+            for handler in handlers:
+                bench_logger.removeHandler(handler)
+                handler.close()
+
+        with open(logfile) as f:
+            lines = sum(1 for line in f)
+
+        results[name] = {'us_per_call': 1e6 * elapsed / n_calls,
+                         'drain_seconds': drain,
+                         'lines': lines,
+                         }
+
+    return results
+
+
+def compare_fits(fits_bytes: bytes,
+                 reference: Union[str, Path]
+                 ) -> Dict[str, object]:
+    """
+    Compare a FITS file held in memory with one on disk, card for card and
+    stored pixel for stored pixel.
+
+    Args:
+        fits_bytes: The contents of the FITS file.
+        reference: Path to the FITS file to compare against.
+
+    Returns:
+        A dictionary of whether the headers and the stored data are
+        identical, the keywords of any cards that differ, and whether the
+        files are identical byte for byte.
+    """
+    import io
+    import numpy as np
+    from astropy.io import fits
+
+    with fits.open(io.BytesIO(fits_bytes),
+                   do_not_scale_image_data=True
+                   ) as hdul, \
+            fits.open(reference, do_not_scale_image_data=True) as ref_hdul:
+        header = hdul[0].header
+        ref_header = ref_hdul[0].header
+        cards = [(card.keyword, card.value) for card in header.cards]
+        ref_cards = [(card.keyword, card.value) for card in ref_header.cards]
+        different_cards = sorted({keyword for keyword, value
+                                  in set(cards) ^ set(ref_cards)
+                                  })
+        if not different_cards and cards != ref_cards:
+            different_cards = ['(order)']
+
+        data = hdul[0].data
+        ref_data = ref_hdul[0].data
+        data_identical = (data.dtype == ref_data.dtype
+                          and np.array_equal(data, ref_data)
+                          )
+
+    with open(reference, 'rb') as f:
+        bytes_identical = f.read() == fits_bytes
+
+    return {'header_identical': not different_cards,
+            'different_cards': different_cards,
+            'data_identical': bool(data_identical),
+            'bytes_identical': bytes_identical,
+            }
+
+
+def benchmark_jp2_decode(jp2_files: List[Union[str, Path]],
+                         work_dir: Union[str, Path]
+                         ) -> Dict[str, Dict[str, object]]:
+    """
+    Check the in-memory .jp2 decode against `j2f_DECam`, and compare their
+    speed. Needs glymur and `j2f_DECam`, and real DECam .jp2 files.
+
+    Args:
+        jp2_files: The .jp2 files to decode.
+        work_dir: Directory to write the `j2f_DECam` output to.
+
+    Returns:
+        A dictionary of the time taken by each decoder and the result of
+        `compare_fits` for each file. If the in-memory decode failed, the
+        entry has the error instead.
+    """
+    import time
+    from dwfprepipe.jp2 import decode_jp2_fits, JP2DecodeError
+
+    work_dir = Path(work_dir)
+
+    results = {}
+    for jp2_file in jp2_files:
+        jp2_file = Path(jp2_file)
+        out_path = work_dir / f'{jp2_file.stem}.fits'
+
+        start = time.perf_counter()
+        subprocess.run(['j2f_DECam',
+                        '-i',
+                        str(jp2_file),
+                        '-o',
+                        str(out_path),
+                        '-num_threads',
+                        str(1)
+                        ],
+                       check=True
+                       )
+        j2f_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            fits_bytes = decode_jp2_fits(jp2_file)
+        except JP2DecodeError as e:
+            results[jp2_file.name] = {'j2f_seconds': j2f_seconds,
+                                      'error': str(e),
+                                      }
+            out_path.unlink()
+            continue
+        decode_seconds = time.perf_counter() - start
+
+        result = {'j2f_seconds': j2f_seconds,
+                  'decode_seconds': decode_seconds,
+                  }
+        result.update(compare_fits(fits_bytes, out_path))
+        results[jp2_file.name] = result
+        out_path.unlink()
+
+    return results
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import os
+import logging
+import argparse
+import datetime
+
+from pathlib import Path
+
+from dwfprepipe.utils import get_logger
+from dwfprepipe.metadata import read_header, ExposureMetadata, ExposureIndex
+from dwfprepipe.trace import get_trace_log
+from dwfprepipe.bin.prepipe_preprocess import run_scamp, update_header
+
+logger = logging.getLogger('dwf_prepipe.bin.prepipe_astrometry')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d',
+                        '--input-date',
+                        type=str,
+                        required=True,
+                        help='UT date of the exposure, in the form '
+                             '`utYYMMDD`.'
+                        )
+
+    parser.add_argument('-e',
+                        '--expnum',
+                        type=int,
+                        required=True,
+                        help='Exposure number.'
+                        )
+
+    parser.add_argument('--photepipe-rawdir',
+                        metavar='DIRECTORY',
+                        type=str,
+                        default=None,
+                        help='Photepipe raw data directory. If not supplied, '
+                             'defaults to the PHOTEPIPE_RAWDIR environment '
+                             'variable.'
+                        )
+
+    parser.add_argument('--scamp-path',
+                        type=str,
+                        default=None,
+                        help='Path to scamp. If not supplied, defaults to '
+                             'the SCAMP_PATH environment variable.'
+                        )
+
+    parser.add_argument('--gaia-dir',
+                        metavar='DIRECTORY',
+                        type=str,
+                        default=None,
+                        help='Directory with Gaia data. If not supplied, '
+                             'defaults to the GAIA_DIR environment variable.'
+                        )
+
+    parser.add_argument('--mosaic-type',
+                        type=str,
+                        default='LOOSE',
+                        help='SCAMP MOSAIC_TYPE used to solve the CCDs of '
+                             'the exposure together. Defaults to LOOSE.'
+                        )
+
+    parser.add_argument('--trace-log',
+                        metavar='PATH',
+                        type=str,
+                        default=None,
+                        help='Shared latency trace log. If not supplied, '
+                             'defaults to the PREPIPE_TRACE_LOG environment '
+                             'variable, or no tracing if that is not set.'
+                        )
+
+    parser.add_argument('--debug',
+                        action="store_true",
+                        help='Turn on debug output.'
+                        )
+
+    parser.add_argument('--quiet',
+                        action="store_true",
+                        help='Turn off all non-essential debug output'
+                        )
+
+    args = parser.parse_args()
+
+    if args.photepipe_rawdir is None:
+        default_photepipe_rawdir = os.getenv("PHOTEPIPE_RAWDIR")
+        if default_photepipe_rawdir is None:
+            raise Exception("No Photepipe raw data directory provided. Please "
+                            "set it by passing the --photepipe-rawdir "
+                            "argument, or by setting the PHOTEPIPE_RAWDIR "
+                            "environment variable."
+                            )
+        else:
+            args.photepipe_rawdir = default_photepipe_rawdir
+
+    if args.scamp_path is None:
+        default_scamp_path = os.getenv("SCAMP_PATH")
+        if default_scamp_path is None:
+            raise Exception("No path to SCAMP provided. Please "
+                            "set it by passing the --scamp-path "
+                            "argument, or by setting the SCAMP_PATH "
+                            "environment variable."
+                            )
+        else:
+            args.scamp_path = default_scamp_path
+
+    if args.gaia_dir is None:
+        default_gaia_dir = os.getenv("GAIA_DIR")
+        if default_gaia_dir is None:
+            raise Exception("No path to Gaia data provided. Please "
+                            "set it by passing the --gaia-dir "
+                            "argument, or by setting the GAIA_DIR "
+                            "environment variable."
+                            )
+        else:
+            args.gaia_dir = default_gaia_dir
+
+    return args
+
+
+def exposure_frames(ut_dir, workspace_ut_dir, expnum):
+    """
+    Find the preprocessed science frames of an exposure that have a
+    SExtractor catalog.
+
+    Args:
+        ut_dir: Photepipe raw data directory of the night.
+        workspace_ut_dir: Photepipe workspace directory of the night.
+        expnum: Exposure number.
+
+    Returns:
+        The metadata of the exposure, and the paths to its frames in the
+        workspace, sorted by CCD.
+    """
+    exposure_index = ExposureIndex(ut_dir / 'exposure_index.jsonl')
+
+    metadata = None
+    frames = []
+    for record in exposure_index.query(expnum=expnum):
+        metadata = ExposureMetadata(**{key: record[key]
+                                       for key in ExposureMetadata._fields
+                                       })
+        if metadata.is_calibration:
+            continue
+
+        raw_frame = Path(record['filepath'])
+        frame = workspace_ut_dir / raw_frame.parent.name / raw_frame.name
+        if not Path(str(frame).replace('fits', 'cat')).is_file():
+            logger.warning(f"No catalog for {frame}. Skipping...")
+            continue
+        frames.append(frame)
+
+    return metadata, frames
+
+
+def main():
+    """
+    Run script
+    """
+
+    start = datetime.datetime.now()
+
+    args = parse_args()
+
+    logfile = "prepipe_astrometry_{}.log".format(
+        start.strftime("%Y%m%d_%H:%M:%S")
+    )
+
+    logger = get_logger(args.debug, args.quiet, logfile=logfile)
+
+    logger.debug("Running with arguments:")
+    for arg, value in sorted(vars(args).items()):
+        logger.debug(f"{arg}: {value}")
+
+    photepipe_rawdir = Path(args.photepipe_rawdir)
+    photepipe_workspace = Path(args.photepipe_rawdir.replace('rawdata',
+                                                             'workspace')
+                               )
+    ut_dir = photepipe_rawdir / args.input_date
+    workspace_ut_dir = photepipe_workspace / args.input_date
+
+    metadata, frames = exposure_frames(ut_dir,
+                                       workspace_ut_dir,
+                                       args.expnum
+                                       )
+    if not frames:
+        raise Exception(f"No catalogs found for exposure {args.expnum}")
+
+    trace = get_trace_log(args.trace_log)
+    trace_id = f"DECam_{args.expnum:08d}"
+
+    from dwfprepipe.astrometry import merge_catalogs, split_head
+    from dwfprepipe.gaia_tiles import select_tiles
+
+    # Pass SCAMP the reference tiles overlapping any CCD of the exposure, if
+    # the field catalog has been tiled with prepipe_prepare_gaia
+    tile_dir = Path(args.gaia_dir) / f'{metadata.field}_tiles'
+    headers = [read_header(frame) for frame in frames]
+    gaia_tiles = set()
+    for header in headers:
+        gaia_tiles.update(select_tiles(tile_dir, header) or [])
+    if gaia_tiles:
+        logger.info(f"Using {len(gaia_tiles)} Gaia tiles")
+        man_gaia = ','.join(str(tile) for tile in sorted(gaia_tiles))
+    else:
+        man_gaia = Path(args.gaia_dir) / f'{metadata.field}_gaia_dr2_LDAC.fits'
+        if not man_gaia.is_file():
+            raise Exception(f"Path to Gaia data ({man_gaia}) does not exist!")
+
+    astrometry_dir = workspace_ut_dir / 'astrometry'
+    astrometry_dir.mkdir(parents=True, exist_ok=True)
+
+    catalogs = [str(frame).replace('fits', 'cat') for frame in frames]
+    merged = merge_catalogs(catalogs, astrometry_dir / f'{trace_id}.cat')
+
+    logger.info(f"Solving {len(frames)} CCDs of exposure {args.expnum} "
+                f"together"
+                )
+    run_scamp(merged,
+              man_gaia,
+              scampbin=args.scamp_path,
+              trace=trace,
+              trace_id=trace_id,
+              mosaic_type=args.mosaic_type
+              )
+
+    split_head(merged.with_suffix('.head'), frames)
+
+    failed = []
+    for frame, header in zip(frames, headers):
+        try:
+            update_header(str(frame),
+                          trace=trace,
+                          trace_id=trace_id,
+                          ccdnum=header['CCDNUM']
+                          )
+        except Exception:
+            logger.exception(f"Updating the header of {frame} failed")
+            failed.append(str(frame))
+
+    total = (datetime.datetime.now() - start).total_seconds()
+    logger.info(f"Astrometry complete for {len(frames) - len(failed)} of "
+                f"{len(frames)} CCDs in {total:.1f}s"
+                )
+
+    if failed:
+        raise Exception(f"Astrometry failed for {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+import sys
+import argparse
+import tempfile
+
+from dwfprepipe.benchmark import (STARTUP_BUDGET,
+                                  entry_points,
+                                  benchmark_startup,
+                                  benchmark_overscan_memory,
+                                  benchmark_extraction,
+                                  benchmark_footprint,
+                                  benchmark_calibration,
+                                  benchmark_logging,
+                                  benchmark_jp2_decode
+                                  )
+from dwfprepipe.utils import get_logger
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--debug',
+                        action="store_true",
+                        help='Turn on debug output.'
+                        )
+
+    parser.add_argument('--quiet',
+                        action="store_true",
+                        help='Turn off all non-essential debug output'
+                        )
+
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    startup = subparsers.add_parser(
+        'startup',
+        help='Check the cold start-up time of the command line entry '
+             'points against a budget. Exits with a non-zero status if any '
+             'entry point is over budget.'
+    )
+
+    startup.add_argument('--modules',
+                         metavar='MODULE',
+                         type=str,
+                         nargs='+',
+                         default=None,
+                         help='Modules to check. If not supplied, defaults '
+                              'to all modules in dwfprepipe.bin.'
+                         )
+
+    startup.add_argument('--budget',
+                         type=float,
+                         default=STARTUP_BUDGET * 1e3,
+                         help='Maximum import time of each entry point in '
+                              f'milliseconds. Defaults to '
+                              f'{STARTUP_BUDGET * 1e3:.0f}.'
+                         )
+
+    startup.add_argument('--repeat',
+                         type=int,
+                         default=5,
+                         help='Number of fresh interpreters to import each '
+                              'entry point in. The fastest is compared to '
+                              'the budget. Defaults to 5.'
+                         )
+
+    overscan_memory = subparsers.add_parser(
+        'overscan-memory',
+        help='Measure the peak memory of the overscan correction and '
+             'saturation masking of a synthetic CCD, against the original '
+             'implementation. Exits with a non-zero status if the results '
+             'are not identical.'
+    )
+
+    overscan_memory.add_argument('--work-dir',
+                                 metavar='DIRECTORY',
+                                 type=str,
+                                 default=None,
+                                 help='Directory to write the synthetic '
+                                      'frames to. If not supplied, a '
+                                      'temporary directory is used.'
+                                 )
+
+    extraction = subparsers.add_parser(
+        'extraction',
+        help='Compare the SEP and SExtractor source extraction backends on '
+             'a synthetic star field. Exits with a non-zero status if the '
+             'SEP positions disagree with SExtractor.'
+    )
+
+    extraction.add_argument('--work-dir',
+                            metavar='DIRECTORY',
+                            type=str,
+                            default=None,
+                            help='Directory to write the images and catalogs '
+                                 'to. If not supplied, a temporary directory '
+                                 'is used.'
+                            )
+
+    extraction.add_argument('--n-stars',
+                            type=int,
+                            default=1000,
+                            help='Number of stars in the field. Defaults to '
+                                 '1000.'
+                            )
+
+    extraction.add_argument('--max-offset',
+                            type=float,
+                            default=0.1,
+                            help='Maximum median offset in pixels between '
+                                 'the SEP and SExtractor positions. Defaults '
+                                 'to 0.1.'
+                            )
+
+    footprint = subparsers.add_parser(
+        'footprint',
+        help='Measure the bytes written per CCD by each output profile.'
+    )
+
+    footprint.add_argument('--work-dir',
+                           metavar='DIRECTORY',
+                           type=str,
+                           default=None,
+                           help='Directory to write the products to. If not '
+                                'supplied, a temporary directory is used.'
+                           )
+
+    calibration = subparsers.add_parser(
+        'calibration',
+        help='Check each backend of the fused calibration kernel against '
+             'the whole-image calibration, and compare their speed. Exits '
+             'with a non-zero status if any result is not identical.'
+    )
+
+    calibration.add_argument('--threads',
+                             type=int,
+                             default=4,
+                             help='Number of threads to also run each '
+                                  'backend with. Defaults to 4.'
+                             )
+
+    logging_calls = subparsers.add_parser(
+        'logging',
+        help='Measure the time taken by each logging call of the listen '
+             'loops, with synchronous and queued log handlers.'
+    )
+
+    logging_calls.add_argument('--calls',
+                               type=int,
+                               default=2000,
+                               help='Number of logging calls. Defaults to '
+                                    '2000.'
+                               )
+
+    logging_calls.add_argument('--write-latency',
+                               type=float,
+                               default=0,
+                               help='Time taken by each write to the '
+                                    'terminal in milliseconds, to stand in '
+                                    'for a slow terminal or file system. '
+                                    'Defaults to 0.'
+                               )
+
+    logging_calls.add_argument('--work-dir',
+                               metavar='DIRECTORY',
+                               type=str,
+                               default=None,
+                               help='Directory to write the logs to. If not '
+                                    'supplied, a temporary directory is '
+                                    'used.'
+                               )
+
+    jp2_decode = subparsers.add_parser(
+        'jp2-decode',
+        help='Check the in-memory .jp2 decode (--in-memory-decode) against '
+             'j2f_DECam, and compare their speed. Exits with a non-zero '
+             'status unless every file is identical card for card and pixel '
+             'for pixel, or if glymur or j2f_DECam is not available.'
+    )
+
+    jp2_decode.add_argument('jp2_files',
+                            metavar='JP2',
+                            type=str,
+                            nargs='+',
+                            help='DECam CCD .jp2 files to decode.'
+                            )
+
+    jp2_decode.add_argument('--work-dir',
+                            metavar='DIRECTORY',
+                            type=str,
+                            default=None,
+                            help='Directory to write the j2f_DECam output '
+                                 'to. If not supplied, a temporary '
+                                 'directory is used.'
+                            )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def run_startup(args, logger):
+    modules = args.modules
+    if modules is None:
+        modules = entry_points()
+
+    over_budget = benchmark_startup(modules,
+                                    args.budget / 1e3,
+                                    repeat=args.repeat
+                                    )
+    if over_budget:
+        logger.error(f"{len(over_budget)} of {len(modules)} entry points "
+                     f"are over budget"
+                     )
+        return 1
+
+    logger.info(f"All {len(modules)} entry points are within budget")
+
+    return 0
+
+
+def run_overscan_memory(args, logger):
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        results = benchmark_overscan_memory(work_dir)
+
+    for name, result in results.items():
+        comparison = ''
+        if 'saved' in result:
+            comparison = (f", {100 * result['saved']:.0f}% less than the "
+                          f"reference"
+                          f"{'' if result['identical'] else ', NOT IDENTICAL'}"
+                          )
+        logger.info(f"{name}: peak {result['peak_mib']:.1f} MiB "
+                    f"({result['frames']:.2f} float32 frames){comparison}"
+                    )
+
+    different = [name for name, result in results.items()
+                 if not result.get('identical', True)
+                 ]
+    if different:
+        logger.error(f"{', '.join(different)} differ from the reference")
+        return 1
+
+    return 0
+
+
+def run_extraction(args, logger):
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        results = benchmark_extraction(work_dir, n_stars=args.n_stars)
+
+    for name in ('sep', 'sextractor'):
+        if name not in results:
+            continue
+        result = results[name]
+        logger.info(f"{name}: {result['seconds']:.2f}s, "
+                    f"{result['bytes_written'] / 2 ** 20:.1f} MiB written, "
+                    f"{result['sources']} sources, "
+                    f"{100 * result['completeness']:.1f}% complete, "
+                    f"median offset {result['offset']:.3f} pix, "
+                    f"median MAG_AUTO offset {result['mag_offset']:.3f}"
+                    )
+
+    comparison = results.get('sep_vs_sextractor')
+    if comparison is None:
+        logger.warning("Only one backend ran. Not validating SEP against "
+                       "SExtractor."
+                       )
+        return 0
+
+    logger.info(f"SEP found {100 * comparison['matched']:.1f}% of the "
+                f"SExtractor sources, median offset "
+                f"{comparison['offset']:.3f} pix, median MAG_AUTO offset "
+                f"{comparison['mag_offset']:.3f}"
+                )
+    if comparison['offset'] > args.max_offset:
+        logger.error(f"SEP positions are more than {args.max_offset} pix "
+                     f"from SExtractor"
+                     )
+        return 1
+
+    return 0
+
+
+def run_footprint(args, logger):
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        results = benchmark_footprint(work_dir)
+
+    full = results['full']['bytes_written']
+    for name, result in results.items():
+        logger.info(f"{name}: {result['bytes_written'] / 2 ** 20:.1f} MiB "
+                    f"in {result['files']} files per CCD "
+                    f"({100 * result['bytes_written'] / full:.0f}% of full), "
+                    f"written in {result['seconds']:.2f}s"
+                    )
+
+    return 0
+
+
+def run_calibration(args, logger):
+    results = benchmark_calibration(n_threads=args.threads)
+
+    for name, result in results.items():
+        logger.info(f"{name}: {result['seconds']:.3f}s, peak "
+                    f"{result['peak_mib']:.1f} MiB"
+                    f"{'' if result['identical'] else ', NOT IDENTICAL'}"
+                    )
+
+    different = [name for name, result in results.items()
+                 if not result['identical']
+                 ]
+    if different:
+        logger.error(f"{', '.join(different)} differ from the reference")
+        return 1
+
+    logger.info("All backends are identical to the reference")
+
+    return 0
+
+
+def run_logging(args, logger):
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        results = benchmark_logging(work_dir,
+                                    n_calls=args.calls,
+                                    write_latency=args.write_latency / 1e3
+                                    )
+
+    for name, result in results.items():
+        logger.info(f"{name}: {result['us_per_call']:.1f} us per call, "
+                    f"{result['drain_seconds']:.3f}s to flush, "
+                    f"{result['lines']} lines written"
+                    )
+
+    lost = [name for name, result in results.items()
+            if result['lines'] != args.calls
+            ]
+    if lost:
+        logger.error(f"{', '.join(lost)} did not write every record")
+        return 1
+
+    return 0
+
+
+def run_jp2_decode(args, logger):
+    import shutil
+    from dwfprepipe.jp2 import use_glymur
+
+    if not use_glymur:
+        logger.error("glymur is not installed. Cannot check the in-memory "
+                     "decode."
+                     )
+        return 1
+    if shutil.which('j2f_DECam') is None:
+        logger.error("j2f_DECam is not on the PATH. Cannot check the "
+                     "in-memory decode."
+                     )
+        return 1
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        results = benchmark_jp2_decode(args.jp2_files, work_dir)
+
+    failed = []
+    for name, result in results.items():
+        if 'error' in result:
+            logger.error(f"{name}: could not decode in memory: "
+                         f"{result['error']}"
+                         )
+            failed.append(name)
+            continue
+
+        logger.info(f"{name}: j2f_DECam {result['j2f_seconds']:.2f}s, "
+                    f"in memory {result['decode_seconds']:.2f}s"
+                    f"{'' if result['bytes_identical'] else ', files differ'}"
+                    )
+        if not result['header_identical']:
+            logger.error(f"{name}: header differs in "
+                         f"{', '.join(result['different_cards'])}"
+                         )
+        if not result['data_identical']:
+            logger.error(f"{name}: data differ")
+        if not (result['header_identical'] and result['data_identical']):
+            failed.append(name)
+
+    if failed:
+        logger.error(f"{len(failed)} of {len(results)} files do not match "
+                     f"j2f_DECam. Do not use --in-memory-decode."
+                     )
+        return 1
+
+    logger.info(f"All {len(results)} files match j2f_DECam")
+
+    return 0
+
+
+def main():
+    """
+    Run script
+    """
+
+    args = parse_args()
+
+    logger = get_logger(args.debug, args.quiet)
+
+    logger.debug("Running with arguments:")
+    for arg, value in sorted(vars(args).items()):
+        logger.debug(f"{arg}: {value}")
+
+    benchmarks = {'startup': run_startup,
+                  'overscan-memory': run_overscan_memory,
+                  'extraction': run_extraction,
+                  'footprint': run_footprint,
+                  'calibration': run_calibration,
+                  'logging': run_logging,
+                  'jp2-decode': run_jp2_decode,
+                  }
+
+    sys.exit(benchmarks[args.benchmark](args, logger))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+
+from pathlib import Path
+
+from dwfprepipe.utils import get_logger
+from dwfprepipe.calibration import N_CCDS, BadPixelStore
+from dwfprepipe.bin.prepipe_preprocess import BPM_FILE_FORMAT, get_bpm_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--bpm-dir',
+                        metavar='DIRECTORY',
+                        type=str,
+                        default=None,
+                        help='Directory with the bad pixel masks. If not '
+                             'supplied, defaults to the masks packaged '
+                             'with dwfprepipe, which are the ones '
+                             'prepipe_preprocess uses.'
+                        )
+
+    parser.add_argument('--store-dir',
+                        metavar='DIRECTORY',
+                        type=str,
+                        default=None,
+                        help='Directory to write the store to. If not '
+                             'supplied, defaults to the `bpm` directory in '
+                             'the dwfprepipe cache directory, which is where '
+                             'prepipe_preprocess looks for it.'
+                        )
+
+    parser.add_argument('--debug',
+                        action="store_true",
+                        help='Turn on debug output.'
+                        )
+
+    parser.add_argument('--quiet',
+                        action="store_true",
+                        help='Turn off all non-essential debug output'
+                        )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Run script
+    """
+
+    start = datetime.datetime.now()
+
+    args = parse_args()
+
+    logfile = "prepipe_build_bpm_{}.log".format(
+        start.strftime("%Y%m%d_%H:%M:%S")
+    )
+
+    logger = get_logger(args.debug, args.quiet, logfile=logfile)
+
+    logger.debug("Running with arguments:")
+    for arg, value in sorted(vars(args).items()):
+        logger.debug(f"{arg}: {value}")
+
+    sources = {}
+    for ccdnum in range(1, N_CCDS + 1):
+        if args.bpm_dir is None:
+            source = Path(get_bpm_path(ccdnum))
+        else:
+            source = Path(args.bpm_dir) / BPM_FILE_FORMAT.format(ccdnum=ccdnum)
+
+        if not source.is_file():
+            logger.warning(f"No bad pixel mask for CCD {ccdnum} ({source})")
+            continue
+        sources[ccdnum] = source
+
+    if not sources:
+        raise Exception("No bad pixel masks found!")
+
+    store = BadPixelStore(args.store_dir)
+    store.build(sources)
+
+    total = (datetime.datetime.now() - start).total_seconds()
+    logger.info(f"Built the bad pixel store for {len(sources)} CCDs in "
+                f"{total:.1f}s"
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import os
+import logging
+import argparse
+import datetime
+import concurrent.futures
+
+from pathlib import Path
+
+from dwfprepipe.utils import get_logger
+from dwfprepipe.calibration import CalibrationRegistry, master_name
+
+logger = logging.getLogger('dwf_prepipe.bin.prepipe_build_masters')
+
+DEFAULT_MAX_MEMORY = 4 * 2 ** 30
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d',
+                        '--input-date',
+                        type=str,
+                        required=True,
+                        help='UT date of the night, in the form `utYYMMDD`.'
+                        )
+
+    parser.add_argument('--photepipe-rawdir',
+                        metavar='DIRECTORY',
+                        type=str,
+                        default=None,
+                        help='Photepipe raw data directory. If not supplied, '
+                             'defaults to the PHOTEPIPE_RAWDIR environment '
+                             'variable.'
+                        )
+
+    parser.add_argument('--ccds',
+                        metavar='CCD',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='CCDs to build masters for, as named in the '
+                             'raw data directory. If not supplied, defaults '
+                             'to all CCDs with calibration frames.'
+                        )
+
+    parser.add_argument('--min-frames',
+                        type=int,
+                        default=3,
+                        help='Minimum number of frames to median combine. '
+                             'Defaults to 3.'
+                        )
+
+    parser.add_argument('--max-memory',
+                        type=float,
+                        default=DEFAULT_MAX_MEMORY / 2 ** 20,
+                        help='Memory budget in MiB for the frame stacks of '
+                             'all workers together. Each worker combines '
+                             'as many rows at a time as fit in its share. '
+                             'Defaults to 4096.'
+                        )
+
+    parser.add_argument('-n',
+                        '--ntasks',
+                        type=int,
+                        default=None,
+                        help='Number of CCDs to build masters for in '
+                             'parallel. If not supplied, defaults to the '
+                             'SLURM_NTASKS_PER_NODE environment variable, '
+                             'or 1 if that is not set.'
+                        )
+
+    parser.add_argument('--overwrite',
+                        action="store_true",
+                        help='Rebuild masters that already exist.'
+                        )
+
+    parser.add_argument('--debug',
+                        action="store_true",
+                        help='Turn on debug output.'
+                        )
+
+    parser.add_argument('--quiet',
+                        action="store_true",
+                        help='Turn off all non-essential debug output'
+                        )
+
+    args = parser.parse_args()
+
+    if args.photepipe_rawdir is None:
+        default_photepipe_rawdir = os.getenv("PHOTEPIPE_RAWDIR")
+        if default_photepipe_rawdir is None:
+            raise Exception("No Photepipe raw data directory provided. Please "
+                            "set it by passing the --photepipe-rawdir "
+                            "argument, or by setting the PHOTEPIPE_RAWDIR "
+                            "environment variable."
+                            )
+        else:
+            args.photepipe_rawdir = default_photepipe_rawdir
+
+    if args.ntasks is None:
+        args.ntasks = int(os.getenv("SLURM_NTASKS_PER_NODE", 1))
+
+    return args
+
+
+def group_calibration_frames(registry, ccds=None):
+    """
+    Group the individual calibration frames in a registry by CCD, type and
+    band.
+
+    Args:
+        registry: Calibration registry of the night.
+        ccds: CCDs to include. If None, all CCDs are included.
+
+    Returns:
+        A dictionary of the paths to the frames of each (CCD, type, band),
+        where the CCD is the name of the directory the frames are in.
+    """
+    groups = {}
+    for record in registry.records():
+        filepath = Path(record['filepath'])
+        if record['master'] or not filepath.is_file():
+            continue
+
+        ccd = filepath.parent.name
+        if ccds is not None and ccd not in ccds:
+            continue
+
+        key = (ccd, record['type'], record['band'])
+        groups.setdefault(key, []).append(filepath)
+
+    return {key: sorted(frames) for key, frames in groups.items()}
+
+
+def build_master(frames, out_path, max_memory, normalise):
+    """
+    Build a master frame, returning the time taken.
+    """
+    from timeit import default_timer as timer
+    from dwfprepipe.calibration import combine_median
+
+    start = timer()
+    combine_median(frames, out_path, max_memory, normalise=normalise)
+
+    return timer() - start
+
+
+def main():
+    """
+    Run script
+    """
+
+    start = datetime.datetime.now()
+
+    args = parse_args()
+
+    logfile = "prepipe_build_masters_{}.log".format(
+        start.strftime("%Y%m%d_%H:%M:%S")
+    )
+
+    logger = get_logger(args.debug, args.quiet, logfile=logfile)
+
+    logger.debug("Running with arguments:")
+    for arg, value in sorted(vars(args).items()):
+        logger.debug(f"{arg}: {value}")
+
+    ut_dir = Path(args.photepipe_rawdir) / args.input_date
+    if not ut_dir.is_dir():
+        raise Exception(f"{ut_dir} does not exist!")
+
+    registry = CalibrationRegistry(ut_dir / 'calibration_registry.jsonl')
+    registry.build(ut_dir)
+
+    groups = group_calibration_frames(registry, ccds=args.ccds)
+
+    tasks = {}
+    for (ccd, calib_type, band), frames in groups.items():
+        name = master_name(calib_type, args.input_date, ccd, band=band)
+        out_path = frames[0].parent / name
+        if len(frames) < args.min_frames:
+            logger.warning(f"Only {len(frames)} frames for {name}. "
+                           f"Skipping..."
+                           )
+            continue
+        if out_path.is_file() and not args.overwrite:
+            logger.info(f"{out_path} already exists. Skipping...")
+            continue
+        tasks[out_path] = (ccd, calib_type, band, frames)
+
+    n_workers = max(1, min(args.ntasks, len(tasks)))
+    max_memory = int(args.max_memory * 2 ** 20 / n_workers)
+    logger.info(f"Building {len(tasks)} masters with {n_workers} workers")
+
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(n_workers) as pool:
+        futures = {pool.submit(build_master,
+                               frames,
+                               out_path,
+                               max_memory,
+                               calib_type == 'domeflat'
+                               ): out_path
+                   for out_path, (ccd, calib_type, band, frames)
+                   in tasks.items()
+                   }
+        for future in concurrent.futures.as_completed(futures):
+            out_path = futures[future]
+            ccd, calib_type, band, frames = tasks[out_path]
+            try:
+                elapsed = future.result()
+            except Exception:
+                logger.exception(f"Building {out_path} failed")
+                failed.append(str(out_path))
+                continue
+
+            logger.info(f"Built {out_path} from {len(frames)} frames in "
+                        f"{elapsed:.1f}s"
+                        )
+            registry.register_file(out_path, ccd)
+
+    total = (datetime.datetime.now() - start).total_seconds()
+    logger.info(f"Built {len(tasks) - len(failed)} of {len(tasks)} masters "
+                f"in {total:.1f}s"
+                )
+
+    if failed:
+        raise Exception(f"Building masters failed for {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
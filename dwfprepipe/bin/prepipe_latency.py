@@ -0,0 +1,125 @@
+import os
+import argparse
+import datetime
+
+from dwfprepipe.trace import (read_trace_logs,
+                              build_timelines,
+                              summarise_latencies
+                              )
+from dwfprepipe.utils import get_logger
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('trace_logs',
+                        metavar='TRACE_LOG',
+                        type=str,
+                        nargs='*',
+                        help='Trace logs to read, e.g. the CTIO and OzSTAR '
+                             'logs. If not supplied, defaults to the '
+                             'PREPIPE_TRACE_LOG environment variable.'
+                        )
+
+    parser.add_argument('--night',
+                        type=str,
+                        default=None,
+                        help='Only report on this night, in the form '
+                             '`utYYMMDD`.'
+                        )
+
+    parser.add_argument('--timelines',
+                        action="store_true",
+                        help='Print the timeline of every exposure.'
+                        )
+
+    parser.add_argument('--debug',
+                        action="store_true",
+                        help='Turn on debug output.'
+                        )
+
+    parser.add_argument('--quiet',
+                        action="store_true",
+                        help='Turn off all non-essential debug output'
+                        )
+
+    args = parser.parse_args()
+
+    if not args.trace_logs:
+        default_trace_log = os.getenv("PREPIPE_TRACE_LOG")
+        if default_trace_log is None:
+            raise Exception("No trace log provided. Please pass one or more "
+                            "trace logs as arguments, or set the "
+                            "PREPIPE_TRACE_LOG environment variable."
+                            )
+        else:
+            args.trace_logs = [default_trace_log]
+
+    return args
+
+
+def _format_time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+def main():
+    """
+    Run script
+    """
+
+    args = parse_args()
+
+    logger = get_logger(args.debug, args.quiet)
+
+    logger.debug("Running with arguments:")
+    for arg, value in sorted(vars(args).items()):
+        logger.debug(f"{arg}: {value}")
+
+    events = read_trace_logs(args.trace_logs)
+    logger.info(f"Read {len(events)} events from "
+                f"{', '.join(args.trace_logs)}"
+                )
+
+    timelines = build_timelines(events)
+    if args.night is not None:
+        timelines = {trace_id: timeline
+                     for trace_id, timeline in timelines.items()
+                     if timeline['night'] == args.night
+                     }
+
+    if not timelines:
+        logger.warning("No exposures found!")
+        return
+
+    if args.timelines:
+        for trace_id, timeline in sorted(timelines.items()):
+            logger.info(f"{trace_id} ({timeline['ccds_done']} CCDs reduced, "
+                        f"{timeline['ccds_failed']} failed, "
+                        f"{timeline['latency']:.1f}s total):"
+                        )
+            for stage, times in timeline['stages'].items():
+                logger.info(f"    {_format_time(times['start'])} "
+                            f"{stage:<22s} "
+                            f"{times['end'] - times['start']:8.1f}s"
+                            )
+
+    for night, summary in sorted(summarise_latencies(timelines).items()):
+        latency = summary['latency']
+        logger.info(f"{night}: {latency['n']} exposures, latency "
+                    f"min/p50/p90/max = {latency['min']:.1f}/"
+                    f"{latency['p50']:.1f}/{latency['p90']:.1f}/"
+                    f"{latency['max']:.1f}s"
+                    )
+        for stage, stats in sorted(summary['stages'].items(),
+                                   key=lambda s: -s[1]['p50']
+                                   ):
+            logger.info(f"    {stage:<40s} p50={stats['p50']:8.1f}s "
+                        f"p90={stats['p90']:8.1f}s"
+                        )
+        logger.info(f"    Slowest stage: {summary['slowest_stage']}")
+
+
+if __name__ == '__main__':
+    main()
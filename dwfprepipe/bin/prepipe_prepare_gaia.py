@@ -0,0 +1,114 @@
+import os
+import argparse
+import datetime
+
+from pathlib import Path
+
+from dwfprepipe.utils import get_logger
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--field',
+                        type=str,
+                        required=True,
+                        help='Name of the field to prepare tiles for.'
+                        )
+
+    parser.add_argument('--catalogs',
+                        metavar='CATALOG',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='Reference catalogs to split into tiles. If not '
+                             'supplied, defaults to the field catalog '
+                             '`<GAIA_DIR>/<field>_gaia_dr2_LDAC.fits`.'
+                        )
+
+    parser.add_argument('--gaia-dir',
+                        metavar='DIRECTORY',
+                        type=str,
+                        default=None,
+                        help='Directory with Gaia data. If not supplied, '
+                             'defaults to the GAIA_DIR environment variable. '
+                             'Tiles are written to `<gaia-dir>/<field>_tiles`.'
+                        )
+
+    parser.add_argument('--tile-size',
+                        type=float,
+                        default=0.5,
+                        help='Tile size in degrees. Defaults to 0.5.'
+                        )
+
+    parser.add_argument('--debug',
+                        action="store_true",
+                        help='Turn on debug output.'
+                        )
+
+    parser.add_argument('--quiet',
+                        action="store_true",
+                        help='Turn off all non-essential debug output'
+                        )
+
+    args = parser.parse_args()
+
+    if args.gaia_dir is None:
+        default_gaia_dir = os.getenv("GAIA_DIR")
+        if default_gaia_dir is None:
+            raise Exception("No path to Gaia data provided. Please "
+                            "set it by passing the --gaia-dir "
+                            "argument, or by setting the GAIA_DIR "
+                            "environment variable."
+                            )
+        else:
+            args.gaia_dir = default_gaia_dir
+
+    return args
+
+
+def main():
+    """
+    Run script
+    """
+
+    start = datetime.datetime.now()
+
+    args = parse_args()
+
+    logfile = "prepipe_prepare_gaia_{}.log".format(
+        start.strftime("%Y%m%d_%H:%M:%S")
+    )
+
+    logger = get_logger(args.debug, args.quiet, logfile=logfile)
+
+    logger.debug("Running with arguments:")
+    for arg, value in sorted(vars(args).items()):
+        logger.debug(f"{arg}: {value}")
+
+    gaia_dir = Path(args.gaia_dir)
+    catalogs = args.catalogs
+    if catalogs is None:
+        catalogs = [gaia_dir / f'{args.field}_gaia_dr2_LDAC.fits']
+
+    for catalog in catalogs:
+        if not Path(catalog).is_file():
+            raise Exception(f"{catalog} does not exist!")
+
+    from dwfprepipe.gaia_tiles import build_tiles
+
+    tile_dir = gaia_dir / f'{args.field}_tiles'
+    index = build_tiles(catalogs,
+                        tile_dir,
+                        tile_size=args.tile_size,
+                        prefix=f'{args.field}_gaia'
+                        )
+
+    n_stars = sum(tile['nstars'] for tile in index['tiles'].values())
+    logger.info(f"Split {n_stars} stars into {len(index['tiles'])} tiles "
+                f"in {tile_dir}"
+                )
+
+
+if __name__ == '__main__':
+    main()
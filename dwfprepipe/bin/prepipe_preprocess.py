@@ -1,21 +1,54 @@
 #!/usr/bin/env python3
 import os
+import time
+import logging
 import subprocess
 import argparse
 import datetime
+import contextlib
 import importlib.resources
 
-import numpy as np
-
-from astropy.io import fits
+# NumPy and astropy are imported where they are first needed, so that
+# importing this module (e.g. from prepipe_process_ccd) stays cheap.
 from dwfprepipe.utils import get_logger
+from dwfprepipe.trace import get_trace_log
+from dwfprepipe.calibration import CalibrationCache, get_bad_pixel_store
+from dwfprepipe.metadata import read_header
+from dwfprepipe.workqueue import run_local, run_mpi, summarise_utilisation
+from dwfprepipe.pipeline import StagedPipeline
+from dwfprepipe.products import (OUTPUT_PROFILES,
+                                 get_output_profile,
+                                 mask_path,
+                                 mask_hdu,
+                                 append_mask
+                                 )
 
 __whatami__ = 'Bias-correct, flat-field, astrometically calibrate, '\
               'and mask DECam images.'
 __author__ = 'Danny Goldstein <danny@caltech.edu>'
 
+logger = logging.getLogger('dwf_prepipe.bin.prepipe_preprocess')
+
+# Memory needed to calibrate a frame: the float32 image and calibrated
+# image, and the uint8 mask. The calibrated image is float32 because the
+# bias and flat are float32 too (see `normalise_flat`); the calibration
+# products are shared by the frames of a CCD and are not counted here.
+FRAME_BYTES_PER_PIXEL = 9
+DEFAULT_BATCH_MEMORY = 2 * 2 ** 30
+
+# Minimum number of tasks per worker when distributing frames
+TASKS_PER_WORKER = 4
+
+PIPELINE_STAGES = ('calibrate', 'extract', 'scamp', 'header')
+EXTRACTORS = ('sextractor', 'sep')
+
+# Name of the packaged bad pixel mask of a CCD
+BPM_FILE_FORMAT = "DECam_Master_20140209v2_cd_{ccdnum:02.0f}.fits"
+
 
 def _read_clargs(val):
+    import numpy as np
+
     if val[0].startswith('@'):
         # then its a list
         val = np.genfromtxt(val[0][1:], dtype=None, encoding='ascii')
@@ -33,11 +66,73 @@ def _parse_doubleslice(header, key, overscan=False):
     return slices[::-1]
 
 
+def _float32_data(hdu, block_rows=256):
+    """
+    Get a new native float32 copy of the data of an HDU.
+
+    The data of an HDU read from a file are converted straight from the
+    (memory-mapped) file in blocks of rows, so that no full-size scaled or
+    byte-swapped intermediate copy is made on the way. The data of an HDU
+    built in memory (e.g. by the in-memory decoder) are copied, as they
+    may be shared with another writer such as the raw archive copy.
+    """
+    import numpy as np
+
+    if hdu.fileinfo() is None:
+        return hdu.data.astype('float32')
+
+    data = np.empty(hdu.shape, dtype='float32')
+    section = hdu.section
+    for start in range(0, data.shape[0], block_rows):
+        data[start:start + block_rows] = section[start:start + block_rows]
+
+    return data
+
+
 def overscan_and_mask_single(hdu):
     # Correct an image for overscan and create bad pixel masks based on
-    # saturated pixels
+    # saturated pixels. All operations work in place on views of the float32
+    # image, so the only full-frame allocations are the image and the mask.
+    import numpy as np
+    from astropy.io import fits
+
+    hdu.data = _float32_data(hdu)
+
+    for amp in ['A', 'B']:
+        over1, over2 = _parse_doubleslice(hdu.header,
+                                          f'BIASSEC{amp}',
+                                          overscan=True
+                                          )
+        data1, data2 = _parse_doubleslice(hdu.header, f'DATASEC{amp}')
+        overbias = hdu.data[over1, over2].mean(axis=1)
+        hdu.data[data1, data2] -= overbias[:, None]
+
+    # do the saturation correction. Unlike np.zeros_like, np.zeros does not
+    # touch the pages of the mask until they are written.
+    image = hdu.data
+    mask = np.zeros(image.shape, dtype='uint8')
 
-    # create some data structures to store the output masks
+    # The amplifier sections do not overlap, so the saturation bit (2 ** 0)
+    # can be written straight into the empty mask
+    for amp in ['A', 'B']:
+        saturval = hdu.header[f'SATURAT{amp}']
+        amp1, amp2 = _parse_doubleslice(hdu.header, f'CCDSEC{amp}')
+        np.greater_equal(image[amp1, amp2], saturval, out=mask[amp1, amp2])
+
+    # create an HDUList object for the masks
+    maskhdu = fits.ImageHDU(data=mask, header=hdu.header)
+
+    return hdu, maskhdu
+
+
+def overscan_and_mask_reference(hdu):
+    """
+    Overscan correct and mask an HDU with full-size temporary arrays, as
+    the pipeline originally did. Used to check the memory use and output of
+    `overscan_and_mask_single` with `prepipe_benchmark overscan-memory`.
+    """
+    import numpy as np
+    from astropy.io import fits
 
     hdu.data = hdu.data.astype('float32')
 
@@ -50,7 +145,6 @@ def overscan_and_mask_single(hdu):
         overbias = hdu.data[over1, over2].mean(axis=1)
         hdu.data[data1, data2] -= overbias[:, None]
 
-    # do the saturation correction
     image = hdu.data
     mask = np.zeros_like(image, dtype='uint8')
 
@@ -59,16 +153,857 @@ def overscan_and_mask_single(hdu):
         amp1, amp2 = _parse_doubleslice(hdu.header, f'CCDSEC{amp}')
         mask[amp1, amp2][image[amp1, amp2] >= saturval] += 2 ** 0
 
-    # create an HDUList object for the masks
     maskhdu = fits.ImageHDU(data=mask, header=hdu.header)
 
     return hdu, maskhdu
 
 
-# recursively partition an iterable into subgroups
-def _split(iterable, n):
-    return [iterable[:len(iterable) // n]] + \
-        _split(iterable[len(iterable) // n:], n - 1) if n != 0 else []
+def get_astromatic_config():
+    """
+    Get the astromatic configuration files packaged with dwfprepipe.
+
+    Returns:
+        A dictionary of paths to the configuration files.
+    """
+    config_files = {'sexconf': 'scamp.sex',
+                    'nnwname': 'default.nnw',
+                    'filtname': 'default.conv',
+                    'paramname': 'scamp.param',
+                    'scampconf': 'scamp.conf',
+                    }
+
+    config = {}
+    for key, config_file in config_files.items():
+        with importlib.resources.path(
+            "dwfprepipe.data.config", config_file
+        ) as path:
+            config[key] = path
+
+    return config
+
+
+def get_bpm_path(ccdnum):
+    """
+    Get the packaged bad pixel mask of a CCD.
+
+    Args:
+        ccdnum: CCD number.
+
+    Returns:
+        The path to the bad pixel mask.
+    """
+    bpm_file = BPM_FILE_FORMAT.format(ccdnum=ccdnum)
+    with importlib.resources.path(
+        "dwfprepipe.data.bpm", bpm_file
+    ) as path:
+        bpm_name = path
+
+    return bpm_name
+
+
+def _overscan_bias(bias):
+    """
+    Overscan correct a bias frame.
+    """
+    from astropy.io import fits
+
+    with fits.open(bias) as b:
+        bhdu, mbhdu = overscan_and_mask_single(b[0])
+
+    return bhdu.data
+
+
+def normalise_flat(flfield):
+    """
+    Normalise the data section of a flat frame by its median.
+
+    The flat is float32, as are the overscan corrected image and bias, so
+    that the compiled calibration kernels can be used (see
+    `dwfprepipe.kernels.calibrate_image`).
+    """
+    import numpy as np
+
+    flfield = flfield.astype('float32')
+    flfield /= np.median(flfield)
+
+    return flfield
+
+
+def _normalised_flat(flat):
+    """
+    Trim a flat frame to its data section and normalise it by its median.
+    """
+    from astropy.io import fits
+
+    with fits.open(flat) as fl:
+        fhdu = fl[0]
+        fl1, fl2 = _parse_doubleslice(fhdu.header, 'DATASEC')
+
+        return normalise_flat(fhdu.data[fl1, fl2])
+
+
+def _bad_pixels(bpm_name):
+    """
+    Get the bad pixels of a bad pixel mask as a boolean array.
+    """
+    from astropy.io import fits
+
+    with fits.open(bpm_name) as bp:
+        return bp[0].data != 0
+
+
+def _calibration_product(calib_cache, kind, source, build):
+    """
+    Get a calibration product from the cache, or build it directly if there
+    is no cache.
+    """
+    if calib_cache is None:
+        return build(source)
+
+    return calib_cache.get(kind, source, build)
+
+
+def load_calibration(flat, bias, ccdnum, calib_cache=None):
+    """
+    Load the products derived from the flat, bias and bad pixel mask of a
+    CCD, which are the same for every science frame that uses them.
+
+    Args:
+        flat: Path to the flat frame.
+        bias: Path to the bias frame.
+        ccdnum: CCD number.
+        calib_cache: Cache of the derived calibration products. If None,
+            they are derived from the calibration frames.
+
+    Returns:
+        A dictionary of the overscan corrected bias (`bias`), normalised
+        flat (`flat`) and bad pixels (`bpm`).
+    """
+    bpm_name = get_bpm_path(ccdnum)
+
+    # Use the memory-mapped bad pixel store if it has been built with
+    # prepipe_build_bpm
+    bad_pixels = get_bad_pixel_store().get(ccdnum, bpm_name)
+    if bad_pixels is None:
+        bad_pixels = _calibration_product(calib_cache,
+                                          'bpm',
+                                          bpm_name,
+                                          _bad_pixels
+                                          )
+
+    return {'bias': _calibration_product(calib_cache,
+                                         'bias',
+                                         bias,
+                                         _overscan_bias
+                                         ),
+            # Cached as 'flat32', so that the float64 flats cached by older
+            # versions are not used
+            'flat': _calibration_product(calib_cache,
+                                         'flat32',
+                                         flat,
+                                         _normalised_flat
+                                         ),
+            'bpm': bad_pixels,
+            }
+
+
+def calibrate_frame(ihdu,
+                    flat,
+                    bias,
+                    calib_cache=None,
+                    calibration=None,
+                    n_threads=1
+                    ):
+    """
+    Overscan correct, bias subtract, flat field and mask a raw science
+    frame. The bias subtraction, flat fielding and masking are done in a
+    single pass over tiles of the image, see
+    `dwfprepipe.kernels.calibrate_image`.
+
+    Args:
+        ihdu: Raw science HDU. Its data and header are modified.
+        flat: Path to the flat frame.
+        bias: Path to the bias frame.
+        calib_cache: Cache of the products derived from the flat, bias and
+            bad pixel mask, which are the same for every science frame of
+            a CCD. If None, they are derived from the frames every time.
+        calibration: Calibration products already loaded with
+            `load_calibration`. If None, they are loaded.
+        n_threads: Number of threads to calibrate the image with.
+
+    Returns:
+        The calibrated image, the mask and the updated header.
+    """
+    from dwfprepipe.kernels import calibrate_image
+
+    # Overscan
+    ihdu, mhdu = overscan_and_mask_single(ihdu)
+
+    TRIM1, TRIM2 = _parse_doubleslice(ihdu.header, 'DATASEC')
+
+    if calibration is None:
+        calibration = load_calibration(flat,
+                                       bias,
+                                       ihdu.header["CCDNUM"],
+                                       calib_cache=calib_cache
+                                       )
+    bias_data = calibration['bias']
+    normflat = calibration['flat']
+    bad_pixels = calibration['bpm']
+
+    # do the bias correction and flat fielding, mask any resulting pixels
+    # that are invalid or bad from the badcol mask, and set the masked
+    # pixels of the science image to NaN
+    finalmask = mhdu.data[TRIM1, TRIM2]
+    calibpix = calibrate_image(ihdu.data[TRIM1, TRIM2],
+                               bias_data[TRIM1, TRIM2],
+                               normflat,
+                               finalmask,
+                               bad_pixels,
+                               n_threads=n_threads
+                               )
+
+    # update the header
+    delkwds = []
+    for card in ihdu.header.cards:
+        if 'SEC' in card.keyword and card.keyword != 'DETSEC':
+            delkwds.append(card.keyword)
+
+    for kwd in delkwds:
+        del ihdu.header[kwd]
+
+    return calibpix, finalmask, ihdu.header
+
+
+def _writeto_new(hdu, filepath):
+    """
+    Write an HDU to a new file and move it into place, so that an existing
+    file at `filepath` (which may be hardlinked to the raw frame) is
+    replaced rather than modified.
+    """
+    tmp_path = f'{filepath}.tmp{os.getpid()}'
+    hdu.writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, filepath)
+
+
+def write_calibrated(frame, calibpix, finalmask, header, profile=None):
+    """
+    Write the calibrated science image and its mask as new files. The
+    header of the science image has blank cards reserved for the SCAMP
+    solution.
+
+    Args:
+        frame: Path to the science frame.
+        calibpix: Calibrated image.
+        finalmask: Mask.
+        header: Header to write with both images.
+        profile: Output profile. Defaults to the `full` profile.
+
+    Returns:
+        The paths to the science image and mask. The mask path is None if
+        the profile appends the mask to the science image, which is left
+        to the caller once sources have been extracted (see
+        `append_mask`).
+    """
+    from astropy.io import fits
+    from dwfprepipe.astrometry import HEADER_RESERVE_CARDS
+
+    if profile is None:
+        profile = OUTPUT_PROFILES['full']
+
+    # save the flat-fielded and bias-corrected image to a new fits
+    # image
+    sciname = frame
+    mskname = None
+
+    if not profile.mef:
+        mskname = mask_path(frame, profile)
+        mskhdul = mask_hdu(finalmask, header, profile.mask_compression)
+        if profile.mask_compression is not None:
+            mskhdul = fits.HDUList([fits.PrimaryHDU(), mskhdul])
+        _writeto_new(mskhdul, mskname)
+
+    sciheader = header.copy()
+    for i in range(HEADER_RESERVE_CARDS):
+        sciheader.append()
+    hdul = fits.PrimaryHDU(calibpix.astype('float32', copy=False),
+                           header=sciheader
+                           )
+    _writeto_new(hdul, sciname)
+
+    return sciname, mskname
+
+
+def run_sextractor(frame,
+                   sciname,
+                   trace=None,
+                   trace_id=None,
+                   ccdnum=None,
+                   check_images=True
+                   ):
+    """
+    Run SExtractor on a calibrated science frame.
+
+    Args:
+        frame: Path to the science frame.
+        sciname: Path to the calibrated science image.
+        trace: Latency trace log.
+        trace_id: Trace id of the exposure.
+        ccdnum: CCD number of the frame.
+        check_images: If False, do not write the noise check image.
+
+    Returns:
+        The path to the SExtractor catalog.
+    """
+    if trace is None:
+        trace = get_trace_log()
+
+    config = get_astromatic_config()
+
+    # pass these constant options to sextractor
+    clargs = ' -PARAMETERS_NAME %s -FILTER_NAME %s -STARNNW_NAME %s' % (
+        config['paramname'], config['filtname'], config['nnwname'])
+
+    # now prepare to run source extractor
+    syscall = 'sex -c %s -CATALOG_NAME %s -CHECKIMAGE_NAME %s %s'
+    catname = frame.replace('fits', 'cat')
+    chkname = frame.replace('fits', 'noise.fits')
+    syscall = syscall % (config['sexconf'], catname, chkname, sciname)
+    syscall += clargs
+    if not check_images:
+        syscall += ' -CHECKIMAGE_TYPE NONE'
+    logger.info(f"Running sextractor with {syscall}")
+
+    # call it
+    with trace.span(trace_id, 'preprocess.sextractor', ccd=ccdnum):
+        subprocess.check_call(syscall.split())
+    logger.info(f'sextractor complete for {sciname}')
+
+    return catname
+
+
+def run_scamp(catname,
+              gaia_source,
+              scampbin=None,
+              trace=None,
+              trace_id=None,
+              ccdnum=None,
+              mosaic_type=None
+              ):
+    """
+    Run SCAMP on the SExtractor catalog of a science frame, or on the
+    merged catalog of all CCDs of an exposure.
+
+    Args:
+        catname: Path to the SExtractor catalog.
+        gaia_source: Path to the Gaia reference catalog, or a comma
+            separated list of reference catalog tiles.
+        scampbin: Path to the scamp executable. Defaults to `scamp`.
+        trace: Latency trace log.
+        trace_id: Trace id of the exposure.
+        ccdnum: CCD number of the frame. None for a merged catalog.
+        mosaic_type: SCAMP MOSAIC_TYPE to use for a merged catalog.
+            Defaults to the one in the SCAMP config.
+
+    Returns:
+        None
+    """
+    if trace is None:
+        trace = get_trace_log()
+
+    config = get_astromatic_config()
+
+    # now run scamp
+    syscall = (f'scamp -c {config["scampconf"]} {catname} '
+               f'-ASTREF_CATALOG FILE '
+               f'-ASTREFCAT_NAME {gaia_source} -ASTREFCENT_KEYS '
+               f'RA_ICRS,DE_ICRS -ASTREFERR_KEYS e_RA_ICRS,e_DE_ICRS '
+               f'-ASTREFMAG_KEY Gmag'
+               )
+    if mosaic_type is not None:
+        syscall += f' -MOSAIC_TYPE {mosaic_type}'
+    if scampbin is not None:
+        syscall = scampbin + syscall[5:]
+    logger.info(f"Running scamp with {syscall}")
+    with trace.span(trace_id, 'preprocess.scamp', ccd=ccdnum):
+        subprocess.check_call(syscall.split())
+
+
+def update_header(frame,
+                  trace=None,
+                  trace_id=None,
+                  ccdnum=None
+                  ):
+    """
+    Merge the SCAMP header of a science frame into the frame. Only the
+    header blocks are rewritten if the frame has enough blank cards left.
+
+    Args:
+        frame: Path to the science frame.
+        trace: Latency trace log.
+        trace_id: Trace id of the exposure.
+        ccdnum: CCD number of the frame.
+
+    Returns:
+        None
+    """
+    from dwfprepipe.astrometry import merge_head
+
+    if trace is None:
+        trace = get_trace_log()
+
+    # fix the header
+    with trace.span(trace_id, 'preprocess.header', ccd=ccdnum):
+        merge_head(frame, frame.replace(".fits", ".head"))
+
+
+def run_sep(frame,
+            calibpix,
+            finalmask,
+            header,
+            trace=None,
+            trace_id=None,
+            ccdnum=None
+            ):
+    """
+    Extract the sources of a calibrated science frame in-process with SEP,
+    instead of running SExtractor on the written image. No noise check
+    image is written.
+
+    Args:
+        frame: Path to the science frame.
+        calibpix: Calibrated image.
+        finalmask: Mask.
+        header: Header of the calibrated image.
+        trace: Latency trace log.
+        trace_id: Trace id of the exposure.
+        ccdnum: CCD number of the frame.
+
+    Returns:
+        The path to the FITS_LDAC catalog.
+    """
+    from dwfprepipe.extraction import extract_catalog
+
+    if trace is None:
+        trace = get_trace_log()
+
+    catname = frame.replace('fits', 'cat')
+    with trace.span(trace_id, 'preprocess.sep', ccd=ccdnum):
+        extract_catalog(calibpix, finalmask, header, catname)
+    logger.info(f'sep complete for {frame}')
+
+    return catname
+
+
+def run_astrometry(frame,
+                   catname,
+                   gaia_source,
+                   scampbin=None,
+                   trace=None,
+                   trace_id=None,
+                   ccdnum=None
+                   ):
+    """
+    Run SCAMP on the catalog of a calibrated science frame, and merge the
+    astrometric solution into its header.
+
+    Args:
+        frame: Path to the science frame.
+        catname: Path to the catalog of the frame.
+        gaia_source: Path to the Gaia reference catalog, or a comma
+            separated list of reference catalog tiles.
+        scampbin: Path to the scamp executable. Defaults to `scamp`.
+        trace: Latency trace log.
+        trace_id: Trace id of the exposure.
+        ccdnum: CCD number of the frame.
+
+    Returns:
+        None
+    """
+    run_scamp(catname,
+              gaia_source,
+              scampbin=scampbin,
+              trace=trace,
+              trace_id=trace_id,
+              ccdnum=ccdnum
+              )
+    update_header(frame,
+                  trace=trace,
+                  trace_id=trace_id,
+                  ccdnum=ccdnum
+                  )
+
+    logger.info(f'scamp complete for {frame}')
+
+
+def preprocess_frame(frame,
+                     flat,
+                     bias,
+                     gaia_source,
+                     scampbin=None,
+                     trace=None,
+                     hdu=None,
+                     calib_cache=None,
+                     astrometry=True,
+                     extractor='sextractor',
+                     output_profile='full',
+                     calib_threads=1
+                     ):
+    """
+    Fully preprocess a single science frame.
+
+    Args:
+        frame: Path to the science frame. All products are written next to
+            it, and it is replaced by the calibrated image. The original
+            file is never modified, so it may be a link to the raw frame.
+        flat: Path to the flat frame.
+        bias: Path to the bias frame.
+        gaia_source: Path to the Gaia reference catalog, or a comma
+            separated list of reference catalog tiles.
+        scampbin: Path to the scamp executable. Defaults to `scamp`.
+        trace: Latency trace log.
+        hdu: Raw science HDU already in memory. If None, it is read from
+            `frame`.
+        calib_cache: Cache of the derived calibration products. If None,
+            they are derived from the calibration frames.
+        astrometry: If False, stop after source extraction, leaving the
+            catalog for the exposure-level astrometry of prepipe_astrometry.
+        extractor: Source extraction backend, `sextractor` or `sep`.
+        output_profile: Name of the output profile, see
+            `dwfprepipe.products.OUTPUT_PROFILES`.
+        calib_threads: Number of threads to calibrate the frame with.
+
+    Returns:
+        None
+    """
+    from astropy.io import fits
+
+    if trace is None:
+        trace = get_trace_log()
+
+    frame = str(frame)
+    profile = get_output_profile(output_profile)
+
+    with contextlib.ExitStack() as stack:
+        if hdu is None:
+            hdu = stack.enter_context(fits.open(frame))[0]
+
+        trace_id = f"DECam_{hdu.header['EXPNUM']:08d}"
+        ccdnum = hdu.header['CCDNUM']
+
+        with trace.span(trace_id, 'preprocess.calibrate', ccd=ccdnum):
+            calibpix, finalmask, header = calibrate_frame(
+                hdu,
+                flat,
+                bias,
+                calib_cache=calib_cache,
+                n_threads=calib_threads
+            )
+            sciname, mskname = write_calibrated(frame,
+                                                calibpix,
+                                                finalmask,
+                                                header,
+                                                profile=profile
+                                                )
+
+    if extractor == 'sep':
+        catname = run_sep(frame,
+                          calibpix,
+                          finalmask,
+                          header,
+                          trace=trace,
+                          trace_id=trace_id,
+                          ccdnum=ccdnum
+                          )
+    else:
+        catname = run_sextractor(frame,
+                                 sciname,
+                                 trace=trace,
+                                 trace_id=trace_id,
+                                 ccdnum=ccdnum,
+                                 check_images=profile.check_images
+                                 )
+    if profile.mef:
+        append_mask(frame, finalmask, header, profile.mask_compression)
+    del calibpix, finalmask
+
+    if not astrometry:
+        return
+
+    run_astrometry(frame,
+                   catname,
+                   gaia_source,
+                   scampbin=scampbin,
+                   trace=trace,
+                   trace_id=trace_id,
+                   ccdnum=ccdnum
+                   )
+
+
+def group_frames(flats, biases, frames):
+    """
+    Group science frames by the calibration frames and CCD they use.
+
+    Args:
+        flats: Flat frame of each science frame.
+        biases: Bias frame of each science frame.
+        frames: Science frames.
+
+    Returns:
+        A dictionary of the science frames of each (flat, bias, CCD number)
+        calibration set, in the order they were given.
+    """
+    groups = {}
+    for flat, bias, frame in zip(flats, biases, frames):
+        ccdnum = read_header(frame)['CCDNUM']
+        groups.setdefault((str(flat), str(bias), ccdnum), []).append(frame)
+
+    return groups
+
+
+def chunk_frames(frames, max_memory, max_frames=None):
+    """
+    Split science frames into chunks whose calibrated images and masks fit
+    within a memory budget.
+
+    Args:
+        frames: Science frames.
+        max_memory: Memory budget in bytes.
+        max_frames: Maximum number of frames in a chunk.
+
+    Returns:
+        A list of chunks of frames. Every chunk contains at least one frame.
+    """
+    chunks = []
+    chunk = []
+    chunk_memory = 0
+    for frame in frames:
+        header = read_header(frame)
+        frame_memory = header['NAXIS1'] * header['NAXIS2'] * \
+            FRAME_BYTES_PER_PIXEL
+        full = max_frames is not None and len(chunk) >= max_frames
+        if chunk and (full or chunk_memory + frame_memory > max_memory):
+            chunks.append(chunk)
+            chunk = []
+            chunk_memory = 0
+        chunk.append(frame)
+        chunk_memory += frame_memory
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def preprocess_batch(frames,
+                     flat,
+                     bias,
+                     gaia_source,
+                     scampbin=None,
+                     trace=None,
+                     calib_cache=None,
+                     max_memory=DEFAULT_BATCH_MEMORY,
+                     stage_workers=None,
+                     extractor='sextractor',
+                     output_profile='full',
+                     calib_threads=1
+                     ):
+    """
+    Fully preprocess a batch of science frames of a single CCD that share
+    the same flat and bias.
+
+    The calibration products are loaded once for the whole batch. The
+    frames then go through a staged pipeline, so that one frame is
+    calibrated while the previous ones are in source extraction and SCAMP.
+
+    Args:
+        frames: Paths to the science frames. See `preprocess_frame`.
+        flat: Path to the flat frame.
+        bias: Path to the bias frame.
+        gaia_source: Path to the Gaia reference catalog, or a comma
+            separated list of reference catalog tiles.
+        scampbin: Path to the scamp executable. Defaults to `scamp`.
+        trace: Latency trace log.
+        calib_cache: Cache of the derived calibration products. If None,
+            they are derived from the calibration frames once per batch.
+        max_memory: Memory budget in bytes for the frames being calibrated
+            at the same time. With the `sep` extractor, the calibrated
+            images are also held until they are extracted.
+        stage_workers: Number of threads of each pipeline stage
+            (`calibrate`, `extract`, `scamp` and `header`). Stages that are
+            not given have one thread.
+        extractor: Source extraction backend, `sextractor` or `sep`.
+        output_profile: Name of the output profile, see
+            `dwfprepipe.products.OUTPUT_PROFILES`. With the `mef` profile,
+            the masks are also held until the frames are extracted.
+        calib_threads: Number of threads to calibrate each frame with.
+
+    Returns:
+        The busy, idle and blocked time of each pipeline stage.
+
+    Raises:
+        Exception: Any frame failed. All other frames are still
+            processed.
+    """
+    from astropy.io import fits
+
+    if trace is None:
+        trace = get_trace_log()
+
+    frames = [str(frame) for frame in frames]
+    profile = get_output_profile(output_profile)
+    header = read_header(frames[0])
+    ccdnum = header['CCDNUM']
+    calibration = load_calibration(flat,
+                                   bias,
+                                   ccdnum,
+                                   calib_cache=calib_cache
+                                   )
+
+    workers = {stage: 1 for stage in PIPELINE_STAGES}
+    workers.update(stage_workers or {})
+
+    # Only calibrate as many frames at once as fit in the memory budget
+    frame_memory = header['NAXIS1'] * header['NAXIS2'] * \
+        FRAME_BYTES_PER_PIXEL
+    workers['calibrate'] = max(1, min(workers['calibrate'],
+                                      int(max_memory // frame_memory)
+                                      ))
+
+    def calibrate(frame):
+        with fits.open(frame) as hdul:
+            hdu = hdul[0]
+            trace_id = f"DECam_{hdu.header['EXPNUM']:08d}"
+            with trace.span(trace_id, 'preprocess.calibrate', ccd=ccdnum):
+                calibpix, finalmask, header = calibrate_frame(
+                    hdu,
+                    flat,
+                    bias,
+                    calibration=calibration,
+                    n_threads=calib_threads
+                )
+                sciname, mskname = write_calibrated(frame,
+                                                    calibpix,
+                                                    finalmask,
+                                                    header,
+                                                    profile=profile
+                                                    )
+
+        job = {'frame': frame, 'trace_id': trace_id, 'sciname': sciname}
+        if extractor == 'sep' or profile.mef:
+            job['calibrated'] = (calibpix, finalmask, header)
+
+        return job
+
+    def extract(job):
+        calibrated = job.pop('calibrated', None)
+        if extractor == 'sep':
+            job['catname'] = run_sep(job['frame'],
+                                     *calibrated,
+                                     trace=trace,
+                                     trace_id=job['trace_id'],
+                                     ccdnum=ccdnum
+                                     )
+        else:
+            job['catname'] = run_sextractor(
+                job['frame'],
+                job['sciname'],
+                trace=trace,
+                trace_id=job['trace_id'],
+                ccdnum=ccdnum,
+                check_images=profile.check_images
+            )
+        if profile.mef:
+            calibpix, finalmask, header = calibrated
+            append_mask(job['frame'],
+                        finalmask,
+                        header,
+                        profile.mask_compression
+                        )
+        return job
+
+    def scamp(job):
+        run_scamp(job['catname'],
+                  gaia_source,
+                  scampbin=scampbin,
+                  trace=trace,
+                  trace_id=job['trace_id'],
+                  ccdnum=ccdnum
+                  )
+        return job
+
+    def merge_header(job):
+        update_header(job['frame'],
+                      trace=trace,
+                      trace_id=job['trace_id'],
+                      ccdnum=ccdnum
+                      )
+        logger.info(f"Preprocessing complete for {job['frame']}")
+        return job
+
+    stage_funcs = {'calibrate': calibrate,
+                   'extract': extract,
+                   'scamp': scamp,
+                   'header': merge_header,
+                   }
+
+    logger.info(f"Preprocessing {len(frames)} frames of CCD {ccdnum} with "
+                f"flat={flat}, bias={bias}"
+                )
+
+    pipeline = StagedPipeline([(stage, stage_funcs[stage], workers[stage])
+                               for stage in PIPELINE_STAGES
+                               ])
+    pipeline.run(frames)
+
+    for stage, stats in pipeline.stats.items():
+        logger.info(f"{stage}: {stats['items']} frames on "
+                    f"{stats['workers']} threads, {stats['busy']:.1f}s "
+                    f"busy, {stats['idle']:.1f}s idle, "
+                    f"{stats['blocked']:.1f}s blocked "
+                    f"({100 * stats['utilisation']:.0f}% utilisation)"
+                    )
+
+    if pipeline.errors:
+        failed = [item if stage == 'calibrate' else item['frame']
+                  for stage, item, error in pipeline.errors
+                  ]
+        raise Exception(f"Preprocessing failed for {', '.join(failed)}")
+
+    return pipeline.stats
+
+
+_worker = {}
+
+
+def _init_worker(settings):
+    """
+    Set up the state shared by all tasks of a worker, so that e.g. the
+    calibration products stay loaded between tasks.
+    """
+    _worker.update(settings)
+    _worker['trace'] = get_trace_log(settings['trace_log'])
+    _worker['calib_cache'] = CalibrationCache(settings['calib_cache_dir'])
+
+
+def _preprocess_task(task):
+    """
+    Preprocess a chunk of frames that share the same calibration frames.
+    """
+    flat, bias, frames = task
+    preprocess_batch(frames,
+                     flat,
+                     bias,
+                     _worker['gaia_source'],
+                     scampbin=_worker['scampbin'],
+                     trace=_worker['trace'],
+                     calib_cache=_worker['calib_cache'],
+                     max_memory=_worker['max_memory'],
+                     stage_workers=_worker['stage_workers'],
+                     extractor=_worker['extractor'],
+                     output_profile=_worker['output_profile'],
+                     calib_threads=_worker['calib_threads']
+                     )
 
 
 def parse_args():
@@ -124,11 +1059,100 @@ def parse_args():
     parser.add_argument('--use-mpi',
                         required=False,
                         default=False,
-                        help='Parallelize with MPI.',
+                        help='Parallelize with MPI. Rank 0 hands out the '
+                             'frames and all other ranks process them. '
+                             'Falls back to a local process pool if mpi4py '
+                             'is not installed.',
                         dest='mpi',
                         action='store_true'
                         )
 
+    parser.add_argument('-n',
+                        '--ntasks',
+                        required=False,
+                        type=int,
+                        default=None,
+                        help='Number of local worker processes when not '
+                             'using MPI. Defaults to the '
+                             'SLURM_NTASKS_PER_NODE environment variable, '
+                             'or 1 if that is not set.',
+                        dest='ntasks'
+                        )
+
+    parser.add_argument('--trace-log',
+                        required=False,
+                        default=None,
+                        help='Shared latency trace log. Defaults to the '
+                             'PREPIPE_TRACE_LOG environment variable, or no '
+                             'tracing if that is not set.',
+                        dest='trace_log'
+                        )
+
+    parser.add_argument('--batch-memory',
+                        required=False,
+                        type=float,
+                        default=DEFAULT_BATCH_MEMORY / 2 ** 20,
+                        help='Memory budget in MiB for calibrating a chunk '
+                             'of frames that share the same calibration '
+                             'frames. Defaults to 2048.',
+                        dest='batch_memory'
+                        )
+
+    parser.add_argument('--extractor',
+                        required=False,
+                        default='sextractor',
+                        choices=EXTRACTORS,
+                        help='Source extraction backend. `sep` extracts the '
+                             'calibrated image in-process (requires sep) and '
+                             'writes no noise check image. Defaults to '
+                             'sextractor.',
+                        dest='extractor'
+                        )
+
+    parser.add_argument('--calib-threads',
+                        required=False,
+                        type=int,
+                        default=1,
+                        help='Number of threads to calibrate each frame '
+                             'with. The fused calibration kernel uses numba '
+                             'or numexpr if installed. Defaults to 1.',
+                        dest='calib_threads'
+                        )
+
+    parser.add_argument('--output-profile',
+                        required=False,
+                        default='full',
+                        choices=list(OUTPUT_PROFILES),
+                        help='Products written for each frame. `compact` '
+                             'writes no check images and RICE compressed '
+                             'masks, and `mef` also appends the mask to the '
+                             'science frame instead of writing a mask file. '
+                             'Defaults to full.',
+                        dest='output_profile'
+                        )
+
+    parser.add_argument('--stage-workers',
+                        required=False,
+                        default=[],
+                        metavar='STAGE=N',
+                        help='Number of threads of a preprocessing stage, '
+                             'e.g. `extract=2 scamp=2`. The stages are '
+                             f'{", ".join(PIPELINE_STAGES)}, and each has '
+                             'one thread by default.',
+                        dest='stage_workers',
+                        nargs='+'
+                        )
+
+    parser.add_argument('--calib-cache-dir',
+                        required=False,
+                        default=None,
+                        help='Directory to cache the products derived from '
+                             'the flats, biases and bad pixel masks in. '
+                             'Defaults to the `calibration` directory in '
+                             'PREPIPE_CACHE_DIR.',
+                        dest='calib_cache_dir'
+                        )
+
     parser.add_argument('--debug',
                         action="store_true",
                         help='Turn on debug output.'
@@ -141,6 +1165,20 @@ def parse_args():
 
     args = parser.parse_args()
 
+    if args.ntasks is None:
+        args.ntasks = int(os.getenv("SLURM_NTASKS_PER_NODE", 1))
+
+    stage_workers = {}
+    for stage_arg in args.stage_workers:
+        stage, sep, n_workers = stage_arg.partition('=')
+        if stage not in PIPELINE_STAGES or not n_workers.isdigit():
+            raise Exception(f"Invalid --stage-workers value {stage_arg}. "
+                            f"Should be STAGE=N, with STAGE one of "
+                            f"{', '.join(PIPELINE_STAGES)}."
+                            )
+        stage_workers[stage] = max(1, int(n_workers))
+    args.stage_workers = stage_workers
+
     return args
 
 
@@ -159,21 +1197,26 @@ def main():
 
     logger = get_logger(args.debug, args.quiet, logfile=logfile)
 
-    missfits_path = os.getenv("MISSFITS")
-    if missfits_path is None:
-        raise Exception("Path to MISSFITS is not specified")
-
     logger.debug("Running with arguments:")
     for arg, value in sorted(vars(args).items()):
         logger.debug(f"{arg}: {value}")
 
+    comm = None
     if args.mpi:
-        from mpi4py import MPI
-
-        # set up mpi
-        comm = MPI.COMM_WORLD
+        try:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+        except ImportError:
+            logger.warning("mpi4py is not installed. Using a local process "
+                           "pool instead."
+                           )
+
+    if comm is None:
+        rank = 0
+        n_workers = args.ntasks
+    else:
         rank = comm.Get_rank()
-        size = comm.Get_size()
+        n_workers = max(1, comm.Get_size() - 1)
 
     # read the argparse input
     flats = _read_clargs(args.flats)
@@ -181,162 +1224,72 @@ def main():
     frames = _read_clargs(args.frames)
     gaia_source = _read_clargs(args.gaia_source)
 
-    # distribute the work to the worker processes
-
-    if args.mpi:
-        ind = np.arange(len(flats))
-        myind = _split(ind, size)[rank]
-
-        myflats = flats[myind]
-        mybiases = biases[myind]
-        myframes = frames[myind]
-
+    scampbin = None if args.scampbin is None else args.scampbin[0]
+
+    settings = {'gaia_source': gaia_source,
+                'scampbin': scampbin,
+                'trace_log': args.trace_log,
+                'calib_cache_dir': args.calib_cache_dir,
+                'max_memory': args.batch_memory * 2 ** 20,
+                'stage_workers': args.stage_workers,
+                'extractor': args.extractor,
+                'output_profile': args.output_profile,
+                'calib_threads': args.calib_threads,
+                }
+
+    # Frames that share calibration frames are kept together, so that the
+    # calibration products are loaded once per chunk. Chunks are kept small
+    # enough that every worker gets several, so the queue stays balanced
+    # even though SExtractor and SCAMP times vary widely between frames.
+    tasks = []
+    if rank == 0:
+        groups = group_frames(flats, biases, frames)
+        max_frames = max(1, len(frames) // (n_workers * TASKS_PER_WORKER))
+        for (flat, bias, ccdnum), group in groups.items():
+            for chunk in chunk_frames(group,
+                                      settings['max_memory'],
+                                      max_frames=max_frames
+                                      ):
+                tasks.append((flat, bias, chunk))
+
+        logger.info(f"Preprocessing {len(frames)} frames with "
+                    f"{len(groups)} sets of calibration frames in "
+                    f"{len(tasks)} tasks on {n_workers} workers"
+                    )
+
+    queue_start = time.time()
+    if comm is None:
+        reports = run_local(_preprocess_task,
+                            tasks,
+                            n_workers=n_workers,
+                            initializer=_init_worker,
+                            initargs=(settings,)
+                            )
     else:
-        myflats = flats
-        mybiases = biases
-        myframes = frames
-
-    # list a few astromatic config files
-    with importlib.resources.path(
-        "dwfprepipe.data.config", "scamp.sex"
-    ) as path:
-        sexconf = path
-
-    with importlib.resources.path(
-        "dwfprepipe.data.config", "default.nnw"
-    ) as path:
-        nnwname = path
-
-    with importlib.resources.path(
-        "dwfprepipe.data.config", "default.conv"
-    ) as path:
-        filtname = path
-
-    with importlib.resources.path(
-        "dwfprepipe.data.config", "scamp.param"
-    ) as path:
-        paramname = path
-
-    with importlib.resources.path(
-        "dwfprepipe.data.config", "scamp.conf"
-    ) as path:
-        scampconf = path
-
-    with importlib.resources.path(
-        "dwfprepipe.data.config", "missfits.conf"
-    ) as path:
-        missfitsconf = path
-
-    # pass these constant options to sextractor
-    clargs = ' -PARAMETERS_NAME %s -FILTER_NAME %s -STARNNW_NAME %s' % (
-        paramname, filtname, nnwname)
-
-    for flat, bias, frame in zip(myflats, mybiases, myframes):
-        # Overscan
-        with fits.open(frame) as hdul:
-            ihdu, mhdu = overscan_and_mask_single(hdul[0])
-            ccdnum_header = hdul[0].header["CCDNUM"]
-            ccd_str = '{ccdnum_header:.0f}'.zfill(2)
-            bpm_file = f"DECam_Master_20140209v2_cd_{ccd_str}.fits"
-            with importlib.resources.path(
-                "dwfprepipe.data.bpm", bpm_file
-            ) as path:
-                bpm_name = path
-
-        with \
-                fits.open(flat) as fl, \
-                fits.open(bias) as b, \
-                fits.open(bpm_name) as bp:
-
-            fhdu = fl[0]
-            bhdu = b[0]
-            bphdu = bp[0]
-            TRIM1, TRIM2 = _parse_doubleslice(ihdu.header, 'DATASEC')
-
-            # Overscan the bias
-            bhdu, mbhdu = overscan_and_mask_single(bhdu)
-            # do the bias correction
-            ccdnum = '%02d' % ihdu.header['CCDNUM']
-
-            with np.errstate(divide='ignore', invalid='ignore'):
-                ihdu.data[TRIM1, TRIM2] -= bhdu.data[TRIM1, TRIM2]
-
-            # do the flat fielding
-            fl1, fl2 = _parse_doubleslice(fhdu.header, 'DATASEC')
-            flfield = fhdu.data[fl1, fl2]
-
-            with np.errstate(divide='ignore', invalid='ignore'):
-                calibpix = ihdu.data[TRIM1, TRIM2] / \
-                    (flfield / np.median(flfield))
-
-            # mask any resulting pixels that are invalid from the previous
-            # operation
-            mhdu.data[TRIM1, TRIM2][~np.isfinite(calibpix)] += 2 ** 1
-
-            # and mask any that are bad from the badcol mask
-            mhdu.data[TRIM1, TRIM2][bphdu.data != 0] += 2 ** 2
-
-            # get the final mask
-            finalmask = mhdu.data[TRIM1, TRIM2]
-
-            # change the values of the science image to 1e-30 where there is a
-            # bad pixel
-            index_bad = np.where(finalmask != 0)
-            calibpix[index_bad] = np.nan
-
-            # save the flat-fielded and bias-corrected image to a new fits
-            # image
-            sciname = frame
-            mskname = frame.replace('.fits', f'.mask.fits').replace('.fz', '')
-
-            # update the header
-            delkwds = []
-            for card in ihdu.header.cards:
-                if 'SEC' in card.keyword and card.keyword != 'DETSEC':
-                    delkwds.append(card.keyword)
-
-            for kwd in delkwds:
-                del ihdu.header[kwd]
-
-            hdul = fits.PrimaryHDU(
-                calibpix.astype('float32'),
-                header=ihdu.header)
-            hdul.writeto(sciname, overwrite=True)
-            mskhdul = fits.PrimaryHDU(finalmask, header=ihdu.header)
-            mskhdul.writeto(mskname, overwrite=True)
-
-            # now prepare to run source extractor
-            syscall = 'sex -c %s -CATALOG_NAME %s -CHECKIMAGE_NAME %s %s'
-            catname = frame.replace('fits', 'cat')
-            chkname = frame.replace('fits', 'noise.fits')
-            syscall = syscall % (sexconf, catname, chkname, sciname)
-            syscall += clargs
-            logger.info(f"Running sextractor with {syscall}")
-
-            # call it
-            subprocess.check_call(syscall.split())
-            logger.info(f'sextractor complete for {sciname}')
-
-            # now run scamp
-            syscall = (f'scamp -c {scampconf} {catname} -ASTREF_CATALOG FILE '
-                       f'-ASTREFCAT_NAME {gaia_source} -ASTREFCENT_KEYS '
-                       f'RA_ICRS,DE_ICRS -ASTREFERR_KEYS e_RA_ICRS,e_DE_ICRS '
-                       f'-ASTREFMAG_KEY Gmag'
-                       )
-            if args.scampbin is not None:
-                syscall = args.scampbin[0] + syscall[5:]
-            logger.info(f"Running scamp with {syscall}")
-            subprocess.check_call(syscall.split())
-
-            # fix the header
-            subprocess.check_call([missfits_path,
-                                   frame,
-                                   frame.replace(".fits", ".head"),
-                                   f"-c {missfitsconf}"
-                                   ]
-                                  )
-
-            logger.info(f'scamp complete for {sciname}')
+        _init_worker(settings)
+        reports = run_mpi(_preprocess_task, tasks, comm)
+
+    if reports is None:
+        # MPI worker rank. Rank 0 reports for everyone.
+        return
+
+    wall_time = time.time() - queue_start
+    utilisation = summarise_utilisation(reports, wall_time)
+    for worker, stats in sorted(utilisation.items()):
+        logger.info(f"{worker}: {stats['tasks']} tasks, "
+                    f"{stats['busy']:.1f}s busy, "
+                    f"{100 * stats['utilisation']:.0f}% utilisation"
+                    )
+
+    failed = [frame for report in reports if report['error'] is not None
+              for frame in report['task'][2]
+              ]
+    logger.info(f"Preprocessed {len(frames) - len(failed)} of {len(frames)} "
+                f"frames in {wall_time:.1f}s"
+                )
+
+    if failed:
+        raise Exception(f"Preprocessing failed for {', '.join(failed)}")
 
 
 if __name__ == '__main__':
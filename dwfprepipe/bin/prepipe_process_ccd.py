@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 import os
+import sys
+import logging
 import datetime
 import shutil
 import argparse
 import subprocess
-import glob
-import importlib.resources
+import concurrent.futures
 # ~/.astropy/config/astropy.cfg was getting messed up -
 # seperate default (used by pipeloop?) and this
 # os.environ['XDG_CONFIG_HOME']='/home/fstars/.python3_config/'
 
-import astropy.io.fits as pyfits
-
-from dwfprepipe.utils import get_logger
+# astropy, NumPy and the modules that use them are imported where they are
+# first needed, so that jobs that stop early (e.g. calibration frames) do not
+# pay for them. Check with `prepipe_benchmark startup`.
+from dwfprepipe.utils import get_logger, link_or_copy
+from dwfprepipe.metadata import (read_header,
+                                 metadata_from_header,
+                                 ExposureIndex
+                                 )
+from dwfprepipe.calibration import CalibrationRegistry, CalibrationCache
+from dwfprepipe.trace import get_trace_id, get_trace_log
+from dwfprepipe.products import OUTPUT_PROFILES
 from pathlib import Path
+from timeit import default_timer as timer
+
+logger = logging.getLogger('dwf_prepipe.bin.prepipe_process_ccd')
 
 
 def check_path(path):
@@ -43,152 +55,6 @@ def check_path(path):
     return path
 
 
-def check_wcs(ut, ccd, expnum):
-    pipeloop_out = subprocess.check_output(['pipeview.pl',
-                                            '-red',
-                                            ut,
-                                            ccd,
-                                            '-stage',
-                                            'WCSNON',
-                                            '-id', str(expnum)
-                                            ],
-                                           stderr=subprocess.STDOUT,
-                                           universal_newlines=True)
-
-    wcs_val = pipeloop_out.splitlines()[9].strip(' \t\n\r').split(' ')[-1]
-    return (wcs_val == 'X')
-
-
-def get_shift_ccd(ut, ccd, Field, expnum):
-    pipeview_out = subprocess.check_output(['pipeview.pl',
-                                            '-red',
-                                            ut,
-                                            ccd,
-                                            '-stage',
-                                            'WCSNON',
-                                            '-wcs',
-                                            '-im',
-                                            Field
-                                            ],
-                                           stderr=subprocess.STDOUT,
-                                           universal_newlines=True
-                                           )
-
-    pipeview_out = pipeview_out.splitlines()[2:]
-
-    rashift = []
-    decshift = []
-
-    ra_close = []
-    dec_close = []
-
-    for line in pipeview_out:
-        # Checks Valid Line
-        if((line.split()[0].split('.')[0] == Field) and
-                (line.split()[1] == '1')):
-
-            rashift.append(float(line.strip(' \t\n\r').split()[5]))
-            decshift.append(float(line.strip(' \t\n\r').split()[6]))
-            line_exp = line.split()[0].split('_')[0].split('.')[-1]
-            if(abs(int(line_exp) - int(expnum)) < 7):
-                ra_close.append(float(line.strip(' \t\n\r').split()[5]))
-                dec_close.append(float(line.strip(' \t\n\r').split()[6]))
-
-    if((len(rashift) == 0) or (len(decshift) == 0)):
-        return [0, 0]
-    if((len(ra_close) != 0) or (len(dec_close) != 0)):
-        return[sum(ra_close) / len(ra_close), sum(dec_close) / len(dec_close)]
-    else:
-        return[sum(rashift) / len(rashift), sum(decshift) / len(decshift)]
-
-
-def get_shift_exp(ut, ccd, exp, Field):
-    pipeview_out = subprocess.check_output(['pipeview.pl',
-                                            '-red',
-                                            ut,
-                                            '1-60',
-                                            '-stage',
-                                            'WCSNON',
-                                            '-wcs',
-                                            '-id',
-                                            exp
-                                            ],
-                                           stderr=subprocess.STDOUT,
-                                           universal_newlines=True
-                                           )
-
-    pipeview_out = pipeview_out.splitlines()[1:]
-
-    rashift = []
-    decshift = []
-
-    ra_close = []
-    dec_close = []
-
-    for line in pipeview_out:
-        # Checks Valid Line
-        if((line.split()[0].split('.')[0] == Field) and
-                (line.split()[1] == '1')):
-
-            rashift.append(float(line.strip(' \t\n\r').split()[5]))
-            decshift.append(float(line.strip(' \t\n\r').split()[6]))
-
-            line_ccd = line.split()[0].split('_')[1]
-            if(abs(int(line_ccd) - int(ccd)) < 3):
-                ra_close.append(float(line.strip(' \t\n\r').split()[5]))
-                dec_close.append(float(line.strip(' \t\n\r').split()[6]))
-
-    if((len(rashift) == 0) or (len(decshift) == 0)):
-        return [0, 0]
-    if((len(ra_close) != 0) or (len(dec_close) != 0)):
-        return[sum(ra_close) / len(ra_close), sum(dec_close) / len(dec_close)]
-    else:
-        return[sum(rashift) / len(rashift), sum(decshift) / len(decshift)]
-
-
-def get_shift_field(ut, ccd, exp, Field):
-    pipeview_out = subprocess.check_output(['pipeview.pl',
-                                            '-red',
-                                            ut,
-                                            '1-60',
-                                            '-stage',
-                                            'WCSNON',
-                                            '-wcs',
-                                            '-im',
-                                            Field],
-                                           stderr=subprocess.STDOUT,
-                                           universal_newlines=True
-                                           )
-
-    pipeview_out = pipeview_out.splitlines()[2:]
-
-    rashift = []
-    decshift = []
-
-    ra_close = []
-    dec_close = []
-
-    for line in pipeview_out:
-        # Checks Valid Line
-        if((line.split()[0].split('.')[0] == Field) and
-                (line.split()[1] == '1')):
-
-            rashift.append(float(line.strip(' \t\n\r').split()[5]))
-            decshift.append(float(line.strip(' \t\n\r').split()[6]))
-
-            line_ccd = line.split()[0].split('_')[1]
-            if(abs(int(line_ccd) - int(ccd)) < 3):
-                ra_close.append(float(line.strip(' \t\n\r').split()[5]))
-                dec_close.append(float(line.strip(' \t\n\r').split()[6]))
-
-    if((len(rashift) == 0) or (len(decshift) == 0)):
-        return [0, 0]
-    if((len(ra_close) != 0) or (len(dec_close) != 0)):
-        return[sum(ra_close) / len(ra_close), sum(dec_close) / len(dec_close)]
-    else:
-        return[sum(rashift) / len(rashift), sum(decshift) / len(decshift)]
-
-
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p',
@@ -212,7 +78,21 @@ def parse_args():
                         type=str,
                         default=None,
                         help='Local directory to untar to. If None, defaults '
-                             'to push_dir / untar.'
+                             'to push_dir / untar, or with --tar-file to the '
+                             'node local scratch directory of the job (the '
+                             'JOBFS environment variable, or TMPDIR if that '
+                             'is not set).'
+                        )
+
+    parser.add_argument('--tar-file',
+                        metavar='PATH',
+                        type=str,
+                        default=None,
+                        help='Tarball of the exposure. If supplied, each '
+                             '.jp2 file is read straight from it (using the '
+                             'index written by run_prepipe --tar-index) '
+                             'into the local directory, instead of from the '
+                             'untar directory.'
                         )
 
     parser.add_argument('--photepipe-rawdir',
@@ -225,7 +105,18 @@ def parse_args():
     parser.add_argument('-i',
                         '--input-file',
                         type=str,
-                        help='input .jp2 file'
+                        nargs='+',
+                        help='input .jp2 file(s)'
+                        )
+
+    parser.add_argument('-n',
+                        '--ntasks',
+                        type=int,
+                        default=None,
+                        help='Number of CCDs to process in parallel. If not '
+                             'supplied, defaults to the '
+                             'SLURM_NTASKS_PER_NODE environment variable, '
+                             'or 1 if that is not set.'
                         )
 
     parser.add_argument('-d',
@@ -256,6 +147,62 @@ def parse_args():
                         help='Directory with Gaia data'
                         )
 
+    parser.add_argument('--in-memory-decode',
+                        action="store_true",
+                        help='Decode the .jp2 file in-process (requires '
+                             'glymur) and calibrate it directly, instead of '
+                             'writing and re-reading an intermediate FITS '
+                             'file. Falls back to j2f_DECam on failure. '
+                             'Experimental and off by default: only enable '
+                             'it once `prepipe_benchmark jp2-decode` passes '
+                             'on this night\'s data.'
+                        )
+
+    parser.add_argument('--extractor',
+                        type=str,
+                        default='sextractor',
+                        choices=('sextractor', 'sep'),
+                        help='Source extraction backend. `sep` extracts the '
+                             'calibrated image in-process (requires sep) and '
+                             'writes no noise check image. Defaults to '
+                             'sextractor.'
+                        )
+
+    parser.add_argument('--calib-threads',
+                        type=int,
+                        default=1,
+                        help='Number of threads to calibrate each CCD with. '
+                             'The fused calibration kernel uses numba or '
+                             'numexpr if installed. Defaults to 1.'
+                        )
+
+    parser.add_argument('--output-profile',
+                        type=str,
+                        default='full',
+                        choices=list(OUTPUT_PROFILES),
+                        help='Products written for each CCD. `compact` '
+                             'writes no check images and RICE compressed '
+                             'masks, and `mef` also appends the mask to the '
+                             'science frame instead of writing a mask file. '
+                             'Defaults to full.'
+                        )
+
+    parser.add_argument('--exposure-astrometry',
+                        action="store_true",
+                        help='Only extract the sources of each CCD, and '
+                             'leave SCAMP to a single prepipe_astrometry job '
+                             'for the whole exposure.'
+                        )
+
+    parser.add_argument('--trace-log',
+                        metavar='PATH',
+                        type=str,
+                        default=None,
+                        help='Shared latency trace log. If not supplied, '
+                             'defaults to the PREPIPE_TRACE_LOG environment '
+                             'variable, or no tracing if that is not set.'
+                        )
+
     args = parser.parse_args()
 
     if args.push_dir is None:
@@ -301,6 +248,17 @@ def parse_args():
         else:
             args.gaia_dir = default_gaia_dir
 
+    if args.local_dir is None:
+        if args.tar_file is not None:
+            # The sbatch --tmp request is provided on JOBFS
+            import tempfile
+            args.local_dir = os.getenv("JOBFS", tempfile.gettempdir())
+        else:
+            args.local_dir = str(Path(args.push_dir) / 'untar')
+
+    if args.ntasks is None:
+        args.ntasks = int(os.getenv("SLURM_NTASKS_PER_NODE", 1))
+
     return args
 
 
@@ -328,7 +286,7 @@ def main():
     # Set local Directory and check to see if it exists
     local_dir = Path(args.local_dir)
 
-    if args.local:
+    if args.local or args.tar_file is not None:
         if not local_dir.is_dir():
             logger.info(f'Creating Directory: {local_dir}')
             local_dir.mkdir()
@@ -353,11 +311,114 @@ def main():
     push_dir = Path(args.push_dir)
     untar_path = push_dir / 'untar'
 
-    file_name = args.input_file
+    dirs = {'untar_path': untar_path,
+            'local_dir': local_dir,
+            'photepipe_rawdir': photepipe_rawdir,
+            'photepipe_workspace': photepipe_workspace,
+            }
+
+    n_workers = max(1, min(args.ntasks, len(args.input_file)))
+    logger.info(f"Processing {len(args.input_file)} CCDs with "
+                f"{n_workers} workers"
+                )
+
+    timings = {}
+    if n_workers == 1:
+        for file_name in args.input_file:
+            timings[file_name] = _process_ccd_timed(file_name, args, dirs)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as pool:
+            futures = {pool.submit(_process_ccd_timed, file_name, args, dirs):
+                       file_name for file_name in args.input_file
+                       }
+            for future in concurrent.futures.as_completed(futures):
+                timings[futures[future]] = future.result()
+
+    failed = []
+    for file_name, (elapsed, error) in sorted(timings.items()):
+        if error is None:
+            logger.info(f"{file_name} processed in {elapsed:.1f}s")
+        else:
+            logger.error(f"{file_name} failed after {elapsed:.1f}s: {error}")
+            failed.append(file_name)
+
+    total = (datetime.datetime.now() - start).total_seconds()
+    logger.info(f"Processed {len(timings) - len(failed)} of {len(timings)} "
+                f"CCDs in {total:.1f}s"
+                )
+
+    if failed:
+        raise Exception(f"Processing failed for {', '.join(failed)}")
+
+
+def _process_ccd_timed(file_name, args, dirs):
+    """
+    Run `process_ccd`, catching and timing any failure so that one bad CCD
+    does not stop the rest of the batch.
+
+    Returns:
+        The elapsed time in seconds and the error message, which is None
+        if processing succeeded.
+    """
+    trace = get_trace_log(args.trace_log)
+    trace_id = get_trace_id(file_name)
+    ccd_num = file_name.split('.')[0].split('_')[2]
+
+    ccd_start = timer()
+    try:
+        # The span records the end of the CCD, and whether it failed, on
+        # every path out of process_ccd
+        with trace.span(trace_id, 'ccd', ccd=ccd_num, night=args.input_date):
+            process_ccd(file_name, args, **dirs)
+        error = None
+    except Exception as e:
+        logger.exception(f"Processing {file_name} failed")
+        error = str(e)
+
+    return timer() - ccd_start, error
+
+
+def process_ccd(file_name,
+                args,
+                untar_path,
+                local_dir,
+                photepipe_rawdir,
+                photepipe_workspace
+                ):
+    """
+    Uncompress, rename and preprocess a single CCD .jp2 file.
+
+    Args:
+        file_name: Name of the .jp2 file.
+        args: Parsed command line arguments.
+        untar_path: Directory containing the .jp2 file, if it is not read
+            from the tarball.
+        local_dir: Node local directory to uncompress in, if `args.local`,
+            or to extract the .jp2 file to, if it is read from the tarball.
+        photepipe_rawdir: Photepipe raw data directory.
+        photepipe_workspace: Photepipe workspace directory.
+
+    Returns:
+        None
+    """
     DECam_Root = file_name.split('.')[0]
     ccd_num = DECam_Root.split('_')[2]
 
-    if args.local:
+    trace = get_trace_log(args.trace_log)
+    trace_id = get_trace_id(file_name)
+
+    if args.tar_file is not None:
+        from dwfprepipe.tarindex import extract_member
+
+        # Copy the .jp2 out of the tarball, which was never unpacked, into
+        # node local storage rather than the shared untar directory
+        logger.info(f'Extracting {file_name} from {args.tar_file} to '
+                    f'{local_dir}'
+                    )
+        with trace.span(trace_id, 'ccd.extract', ccd=ccd_num):
+            extract_member(args.tar_file, file_name, local_dir / file_name)
+        untar_path = local_dir
+    elif args.local:
         # Move .jp2 to local directory
         logger.info(
             f'Moving {untar_path / file_name} to {local_dir / file_name}'
@@ -365,28 +426,55 @@ def main():
         shutil.move(untar_path / file_name, local_dir / file_name)
         untar_path = local_dir
 
-    # Uncompress Fits on local Directory
-    fits_file = DECam_Root + '.fits'
-    uncompressed_fits = untar_path / fits_file
-    logger.info('--------*****')
-    logger.info(uncompressed_fits)
-    logger.info(f'Uncompressing: {file_name} in path: {untar_path}')
-    logger.info('--------*****')
-    uncompress_call = ['j2f_DECam',
-                       '-i',
-                       str(untar_path / file_name),
-                       '-o',
-                       str(uncompressed_fits),
-                       '-num_threads',
-                       str(1)
-                       ]
-    logger.info(f'Running {" ".join(uncompress_call)}')
-    subprocess.run(uncompress_call)
-
-    # Extract nescessary information from file for naming scheme
-    exp = pyfits.getval(uncompressed_fits, "EXPNUM")
-    Field = pyfits.getval(uncompressed_fits, "OBJECT")
-    Filter = pyfits.getval(uncompressed_fits, "FILTER")[0]
+    raw_hdu = None
+    if args.in_memory_decode:
+        from astropy.io import fits
+        from dwfprepipe.jp2 import (decode_jp2_fits,
+                                    write_fits_bytes,
+                                    JP2DecodeError
+                                    )
+
+        # Decode straight into memory, skipping the intermediate FITS file.
+        # The bytes are the raw integer frame as j2f_DECam would write it,
+        # and are archived as they are; the HDU scales them for calibration.
+        logger.info(f'Decoding {file_name} in memory')
+        try:
+            with trace.span(trace_id, 'ccd.decompress', ccd=ccd_num):
+                raw_fits = decode_jp2_fits(untar_path / file_name)
+            raw_hdu = fits.HDUList.fromstring(raw_fits)[0]
+        except JP2DecodeError as e:
+            logger.warning(f"{e}. Falling back to j2f_DECam.")
+
+    if raw_hdu is None:
+        # Uncompress Fits on local Directory
+        fits_file = DECam_Root + '.fits'
+        uncompressed_fits = untar_path / fits_file
+        logger.info('--------*****')
+        logger.info(uncompressed_fits)
+        logger.info(f'Uncompressing: {file_name} in path: {untar_path}')
+        logger.info('--------*****')
+        uncompress_call = ['j2f_DECam',
+                           '-i',
+                           str(untar_path / file_name),
+                           '-o',
+                           str(uncompressed_fits),
+                           '-num_threads',
+                           str(1)
+                           ]
+        logger.info(f'Running {" ".join(uncompress_call)}')
+        with trace.span(trace_id, 'ccd.decompress', ccd=ccd_num):
+            subprocess.run(uncompress_call)
+
+        # Extract nescessary information from file for naming scheme
+        header = read_header(uncompressed_fits)
+    else:
+        header = raw_hdu.header
+
+    metadata = metadata_from_header(header)
+
+    exp = metadata.expnum
+    Field = metadata.field
+    Filter = metadata.band
 
     # FOR Chile!
     # FIX THIS.  So the problem is in a night's observations can straddle two
@@ -401,14 +489,12 @@ def main():
     # else:
     # ut='ut'+pyfits.getval(uncompressed_fits,"OBSID")[6:12]
 
-    obstype = pyfits.getval(uncompressed_fits, "OBSTYPE")
-
     newname = f"{Field}.{Filter}.{ut}.{exp}_{ccd_num}.fits"
     calib_file = False
-    if((obstype == 'dome flat') or (obstype == 'domeflat')):
+    if metadata.is_flat:
         newname = f"domeflat.{Filter}.{ut}.{exp}_{ccd_num}.fits"
         calib_file = True
-    if((obstype == 'zero') or (obstype == 'bias')):
+    if metadata.is_bias:
         newname = f"bias.{ut}.{exp}_{ccd_num}.fits"
         calib_file = True
 
@@ -427,75 +513,133 @@ def main():
         logger.info(f'Creating Directory: {workspace_dest_dir}')
         workspace_dest_dir.mkdir(parents=True)
 
-    # Move Uncompressed Fits File
-    logger.info(f'Moving {uncompressed_fits} to {dest_dir / newname}')
-    shutil.move(uncompressed_fits, dest_dir / newname)
-
-    if calib_file:
-        logger.info("File is a calibration file. No further processing required.")
-        exit()
-    # Check for and prepare the calibration file lists
-    flats_glob_str = str(dest_dir / f"domeflat.{Filter}.master.*")
-    checkflats = glob.glob(flats_glob_str)
-
-    if checkflats == []:
-        logger.warning(
-            "No master flat detected! "
-            "Looking for an individual flat.."
+    archive_pool = None
+    if raw_hdu is None:
+        # Move Uncompressed Fits File
+        logger.info(f'Moving {uncompressed_fits} to {dest_dir / newname}')
+        shutil.move(uncompressed_fits, dest_dir / newname)
+    elif calib_file:
+        logger.info(f'Writing {dest_dir / newname}')
+        write_fits_bytes(raw_fits, dest_dir / newname)
+    else:
+        # Write the raw archive copy in the background while the frame is
+        # calibrated. The bytes are not touched by the calibration.
+        logger.info(f'Writing {dest_dir / newname} in the background')
+        archive_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        archive_future = archive_pool.submit(write_fits_bytes,
+                                             raw_fits,
+                                             dest_dir / newname
+                                             )
+
+    try:
+        # Record the metadata so that later stages and reprocessing do not need
+        # to re-read the header
+        if metadata.ccdnum is None:
+            metadata = metadata._replace(ccdnum=int(ccd_num))
+        exposure_index = ExposureIndex(ut_dir / 'exposure_index.jsonl')
+        exposure_index.add(metadata, dest_dir / newname)
+
+        calib_registry = CalibrationRegistry(
+            ut_dir / 'calibration_registry.jsonl'
         )
-        checkflats = glob.glob(str(dest_dir / f"domeflat.{Filter}*"))
-        if checkflats == []:
+        if not calib_registry.path.is_file():
+            calib_registry.build(ut_dir)
+
+        if calib_file:
+            calib_registry.register_file(dest_dir / newname, ccd_num)
+            logger.info("File is a calibration file. No further processing required.")
+            return
+
+        from dwfprepipe.gaia_tiles import select_tiles
+        from dwfprepipe.bin.prepipe_preprocess import preprocess_frame
+
+        # Look up the calibration frames
+        flat_record = calib_registry.lookup(ccd_num, 'domeflat', Filter)
+        if flat_record is None:
             raise Exception("Prepipe Error: No flats detected! Exiting...")
-        else:
-            logger.info("Found individual flats")
-    # Use the first in the list
-    flat = checkflats[0]
-
-    checkbias = glob.glob(str(dest_dir / "bias.master.*"))
-    if checkbias == []:
-        logger.warning(
-            "No master bias detected! "
-            "Looking for an individual bias.."
-        )
-        checkbias = glob.glob(str(dest_dir / "bias.*"))
-        if checkbias == []:
+        elif not flat_record['master']:
+            logger.warning("No master flat detected! Using an individual "
+                           "flat. Masters can be built with "
+                           "prepipe_build_masters."
+                           )
+        flat = flat_record['filepath']
+        logger.info(f"Using flat {flat}")
+
+        bias_record = calib_registry.lookup(ccd_num, 'bias')
+        if bias_record is None:
             raise Exception("Prepipe Error: No bias detected! Exiting...")
-        else:
-            logger.info("Found individual bias")
-    # Use the first in the list
-    bias = checkbias[0]
-
-    # Copy the raw image to the workspace, so that all the products
-    # will be generated there.
-    input_frames = workspace_dest_dir / newname
+        elif not bias_record['master']:
+            logger.warning("No master bias detected! Using an individual "
+                           "bias. Masters can be built with "
+                           "prepipe_build_masters."
+                           )
+        bias = bias_record['filepath']
+        logger.info(f"Using bias {bias}")
+
+        # Only pass SCAMP the reference tiles overlapping this CCD, if the
+        # field catalog has been tiled with prepipe_prepare_gaia
+        man_gaia = None
+        if not args.exposure_astrometry:
+            gaia_tiles = select_tiles(Path(args.gaia_dir) / f'{Field}_tiles',
+                                      header
+                                      )
+            if gaia_tiles:
+                logger.info(f"Using {len(gaia_tiles)} Gaia tiles")
+                man_gaia = ','.join(str(tile) for tile in gaia_tiles)
+            else:
+                man_gaia = Path(args.gaia_dir) / f'{Field}_gaia_dr2_LDAC.fits'
+                if not man_gaia.is_file():
+                    raise Exception(f"Path to Gaia data ({man_gaia}) does not "
+                                    f"exist!"
+                                    )
+
+        # All the products will be generated in the workspace.
+        input_frames = workspace_dest_dir / newname
+
+        # The products derived from the flat, bias and bad pixel mask are
+        # shared by every science frame of the CCD, so only build them once
+        # per night
+        calib_cache = CalibrationCache(workspace_ut_dir / 'calibration_cache')
+
+        if raw_hdu is None:
+            # Hand the raw image over to the workspace without duplicating it
+            # where possible. Preprocessing replaces rather than modifies it,
+            # so the raw frame is never changed.
+            handoff = link_or_copy(dest_dir / newname, input_frames)
+            logger.info(f'Linked {dest_dir / newname} to {input_frames} '
+                        f'({handoff})'
+                        )
 
-    subprocess.check_call(['cp',
-                           dest_dir / newname,
-                           input_frames
-                           ]
-                          )
-
-    # Call Danny's preprocess code for CCD reduction
-    with (
-        importlib.resources.path("dwfprepipe.bin",
-                                 "prepipe_preprocess.py")
-    ) as path:
-        preprocess_path = path
-
-    man_gaia = Path(args.gaia_dir) / f'{Field}_gaia_dr2_LDAC.fits'
-    if not man_gaia.is_file():
-        raise Exception(f"Path to Gaia data ({man_gaia}) does not exist!")
-
-    subprocess_call = [f"python",
-                       f"{preprocess_path}",
-                       f"--input-frames={input_frames}",
-                       f"--flat-frames={flat}",
-                       f"--bias-frames={bias}",
-                       f"--with-scamp-exec={args.scamp_path}",
-                       f"--man-gaia={man_gaia}"
-                       ]
-    logger.info(f"Running {' '.join(subprocess_call)}")
-    subprocess.check_call(subprocess_call)
+        # Call Danny's preprocess code for CCD reduction, in-process
+        logger.info(f"Preprocessing {input_frames} with flat={flat}, "
+                    f"bias={bias}, gaia={man_gaia}"
+                    )
+        with trace.span(trace_id, 'ccd.preprocess', ccd=ccd_num):
+            preprocess_frame(input_frames,
+                             flat,
+                             bias,
+                             man_gaia,
+                             scampbin=args.scamp_path,
+                             trace=trace,
+                             hdu=raw_hdu,
+                             calib_cache=calib_cache,
+                             astrometry=not args.exposure_astrometry,
+                             extractor=args.extractor,
+                             output_profile=args.output_profile,
+                             calib_threads=args.calib_threads
+                             )
+    finally:
+        # Always wait for the raw archive copy, so that an error writing it
+        # is not lost behind an error in the preprocessing
+        if archive_pool is not None:
+            archive_pool.shutdown()
+            archive_error = archive_future.exception()
+            if archive_error is not None:
+                logger.error(f"Could not write {dest_dir / newname}: "
+                             f"{archive_error}"
+                             )
+                if sys.exc_info()[0] is None:
+                    raise archive_error
 
     # Remove unescessary .jp2
     jp2_path = untar_path / file_name
@@ -5,6 +5,7 @@ import os
 from pathlib import Path
 
 from dwfprepipe.prepipe import Prepipe
+from dwfprepipe.products import OUTPUT_PROFILES
 from dwfprepipe.utils import get_logger
 
 
@@ -22,6 +23,11 @@ def parse_args():
                         help='Turn off all non-essential debug output'
                         )
 
+    parser.add_argument('--log-json',
+                        action="store_true",
+                        help='Write the log file as JSON lines.'
+                        )
+
     parser.add_argument('--push-dir',
                         metavar='DIRECTORY',
                         type=str,
@@ -42,6 +48,37 @@ def parse_args():
                         help='Ozstar reservation name.'
                         )
 
+    parser.add_argument('--trace-log',
+                        metavar='PATH',
+                        type=str,
+                        default=None,
+                        help='Shared latency trace log. If not supplied, '
+                             'defaults to the PREPIPE_TRACE_LOG environment '
+                             'variable, or no tracing if that is not set.'
+                        )
+
+    parser.add_argument('--exposure-astrometry',
+                        action="store_true",
+                        help='Solve the astrometry of all CCDs of an '
+                             'exposure with a single SCAMP run, in a job '
+                             'that runs after the CCD jobs.'
+                        )
+
+    parser.add_argument('--tar-index',
+                        action="store_true",
+                        help='Index each tarball instead of unpacking it, '
+                             'and have the CCD jobs read their .jp2 files '
+                             'straight from the tarball.'
+                        )
+
+    parser.add_argument('--output-profile',
+                        type=str,
+                        default='full',
+                        choices=list(OUTPUT_PROFILES),
+                        help='Products written for each CCD, see '
+                             'prepipe_process_ccd. Defaults to full.'
+                        )
+
     args = parser.parse_args()
 
     if args.push_dir is None:
@@ -70,7 +107,11 @@ def main():
         start.strftime("%Y%m%d_%H:%M:%S")
     )
 
-    logger = get_logger(args.debug, args.quiet, logfile=logfile)
+    logger = get_logger(args.debug,
+                        args.quiet,
+                        logfile=logfile,
+                        json_logs=args.log_json
+                        )
 
     logger.debug("Running with arguments:")
     for arg, value in sorted(vars(args).items()):
@@ -84,7 +125,11 @@ def main():
                       path_to_untar,
                       path_to_sbatch,
                       args.run_date,
-                      args.res_name
+                      args.res_name,
+                      trace_log=args.trace_log,
+                      exposure_astrometry=args.exposure_astrometry,
+                      output_profile=args.output_profile,
+                      tar_index=args.tar_index
                       )
 
     prepipe.listen()
@@ -59,6 +59,30 @@ def parse_args():
                              'Defaults to -1, i.e. all.'
                         )
 
+    parser.add_argument('--max-compress',
+                        metavar='NUMBER',
+                        type=int,
+                        default=2,
+                        help='Number of files to unpack and compress at '
+                             'once. Defaults to 2.'
+                        )
+
+    parser.add_argument('--max-transfers',
+                        metavar='NUMBER',
+                        type=int,
+                        default=2,
+                        help='Number of transfers to run at once. Defaults '
+                             'to 2.'
+                        )
+
+    parser.add_argument('--transfer-timeout',
+                        metavar='SECONDS',
+                        type=float,
+                        default=1200,
+                        help='Time after which a transfer is abandoned. '
+                             'Defaults to 1200.'
+                        )
+
     parser.add_argument('--debug',
                         action="store_true",
                         help='Turn on debug output.'
@@ -69,6 +93,20 @@ def parse_args():
                         help='Turn off all non-essential debug output.'
                         )
 
+    parser.add_argument('--log-json',
+                        action="store_true",
+                        help='Write the log file as JSON lines.'
+                        )
+
+    parser.add_argument('--trace-log',
+                        metavar='PATH',
+                        type=str,
+                        default=None,
+                        help='Shared latency trace log. If not supplied, '
+                             'defaults to the PREPIPE_TRACE_LOG environment '
+                             'variable, or no tracing if that is not set.'
+                        )
+
     args = parser.parse_args()
 
     if args.data_dir is None:
@@ -107,15 +145,30 @@ def main():
         start.strftime("%Y%m%d_%H:%M:%S")
     )
 
-    logger = get_logger(args.debug, args.quiet, logfile=logfile)
+    logger = get_logger(args.debug,
+                        args.quiet,
+                        logfile=logfile,
+                        json_logs=args.log_json
+                        )
 
     logger.debug("Running with arguments:")
     for arg, value in sorted(vars(args).items()):
         logger.debug(f"{arg}: {value}")
 
-    Push = CTIOPush(args.data_dir, args.Qs, args.method, args.nbundle)
-
-    if Push.method == 'end of night':
+    Push = CTIOPush(args.data_dir,
+                    args.Qs,
+                    args.method,
+                    args.nbundle,
+                    trace_log=args.trace_log,
+                    stage_limits={'unpack': args.max_compress,
+                                  'compress': args.max_compress,
+                                  'package': args.max_compress,
+                                  'transfer': args.max_transfers,
+                                  },
+                    timeouts={'transfer': args.transfer_timeout}
+                    )
+
+    if Push.push_method == 'end of night':
         Push.process_endofnight(args.exp_min)
     else:
         Push.listen()
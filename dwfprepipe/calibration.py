@@ -0,0 +1,703 @@
+import os
+import time
+import hashlib
+import contextlib
+import logging
+
+from pathlib import Path
+from typing import Union, List, Optional, Dict, Callable
+from dwfprepipe.utils import append_jsonl, read_jsonl, get_cache_dir
+
+
+def parse_calibration_name(file_name: Union[str, Path]) -> Optional[dict]:
+    """
+    Parse the name of a calibration frame in the photepipe raw data
+    directory.
+
+    Recognised names are `bias.<ut>.<expnum>_<ccd>.fits`,
+    `domeflat.<band>.<ut>.<expnum>_<ccd>.fits`, `bias.master.*` and
+    `domeflat.<band>.master.*`.
+
+    Args:
+        file_name: Name of (or path to) the frame.
+
+    Returns:
+        A dictionary containing the calibration type, band, exposure number
+        and whether the frame is a master, or None if the name is not that
+        of a calibration frame.
+    """
+    parts = Path(file_name).name.split('.')
+
+    if parts[0] == 'bias':
+        calib_type = 'bias'
+        band = None
+        rest = parts[1:]
+    elif parts[0] == 'domeflat' and len(parts) > 2:
+        calib_type = 'domeflat'
+        band = parts[1]
+        rest = parts[2:]
+    else:
+        return None
+
+    if not rest:
+        return None
+
+    master = rest[0] == 'master'
+    expnum = None
+    if not master and len(rest) > 1:
+        try:
+            expnum = int(rest[1].split('_')[0])
+        except ValueError:
+            pass
+
+    return {'type': calib_type,
+            'band': band,
+            'master': master,
+            'expnum': expnum,
+            }
+
+
+class CalibrationRegistry:
+    def __init__(self, path: Union[str, Path]):
+        """
+        Constructor method.
+
+        The registry is an append-only JSON-lines file that maps
+        (CCD, band, calibration type) to the calibration frames available
+        for a night. It is built once per night with `build` and then
+        updated with `register` as new calibration frames arrive, so that
+        science frames can look up their calibrations without scanning the
+        raw data directories.
+
+        Args:
+            path: Path to the registry file.
+
+        Returns:
+            None
+        """
+
+        self.logger = logging.getLogger(
+            'dwf_prepipe.calibration.CalibrationRegistry'
+        )
+
+        self.path = Path(path)
+        self._frames = None
+
+    def register(self,
+                 filepath: Union[str, Path],
+                 ccd: Union[str, int],
+                 calib_type: str,
+                 band: Optional[str] = None,
+                 expnum: Optional[int] = None,
+                 master: bool = False
+                 ):
+        """
+        Add a calibration frame to the registry.
+
+        Args:
+            filepath: Path to the calibration frame.
+            ccd: CCD number of the frame.
+            calib_type: Type of calibration frame, `bias` or `domeflat`.
+            band: Band of the frame. Ignored for biases.
+            expnum: Exposure number of the frame. None for masters.
+            master: Whether the frame is a master.
+
+        Returns:
+            None
+        """
+
+        record = {'filepath': str(filepath),
+                  'ccd': int(ccd),
+                  'type': calib_type,
+                  'band': None if calib_type == 'bias' else band,
+                  'expnum': expnum,
+                  'master': master,
+                  'registered': time.time(),
+                  }
+
+        self.logger.debug(f"Registering {filepath} in {self.path}")
+        append_jsonl(self.path, record)
+
+        if self._frames is not None:
+            self._add(record)
+
+    def register_file(self, filepath: Union[str, Path], ccd: Union[str, int]):
+        """
+        Add a calibration frame to the registry based on its name.
+
+        Args:
+            filepath: Path to the calibration frame.
+            ccd: CCD number of the frame.
+
+        Returns:
+            None
+        """
+
+        parsed = parse_calibration_name(filepath)
+        if parsed is None:
+            self.logger.warning(f"{filepath} is not a calibration frame! "
+                                f"Not registering."
+                                )
+            return
+
+        self.register(filepath,
+                      ccd,
+                      parsed['type'],
+                      band=parsed['band'],
+                      expnum=parsed['expnum'],
+                      master=parsed['master']
+                      )
+
+    def build(self, ut_dir: Union[str, Path]):
+        """
+        Register all calibration frames already present in the raw data
+        directory of a night, which contains one subdirectory per CCD.
+
+        Args:
+            ut_dir: Raw data directory of the night.
+
+        Returns:
+            None
+        """
+
+        ut_dir = Path(ut_dir)
+        self.logger.info(f"Building calibration registry for {ut_dir}")
+
+        known = set(self._load_records())
+        for glob_str in ('*/bias.*', '*/domeflat.*'):
+            for filepath in sorted(ut_dir.glob(glob_str)):
+                if str(filepath) in known:
+                    continue
+                self.register_file(filepath, filepath.parent.name)
+
+    def _load_records(self) -> Dict[str, dict]:
+        return {record['filepath']: record
+                for record in read_jsonl(self.path)
+                }
+
+    def _add(self, record: dict):
+        key = (record['ccd'], record['band'], record['type'])
+        frames = self._frames.setdefault(key, {})
+        frames[record['filepath']] = record
+
+    def load(self):
+        """
+        Load the registry, replacing any previously loaded state.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self._frames = {}
+        for record in self._load_records().values():
+            self._add(record)
+
+    def records(self) -> List[dict]:
+        """
+        Get all registered frames.
+
+        Args:
+            None
+
+        Returns:
+            A list of registry records.
+        """
+
+        if self._frames is None:
+            self.load()
+
+        return [record for frames in self._frames.values()
+                for record in frames.values()
+                ]
+
+    def candidates(self,
+                   ccd: Union[str, int],
+                   calib_type: str,
+                   band: Optional[str] = None
+                   ) -> List[dict]:
+        """
+        Get all registered frames of a calibration type, best first.
+
+        Masters are preferred over individual frames, and more recent
+        exposures over older ones, so the choice does not depend on the
+        order in which files were written.
+
+        Args:
+            ccd: CCD number.
+            calib_type: Type of calibration frame, `bias` or `domeflat`.
+            band: Band of the frame. Ignored for biases.
+
+        Returns:
+            A list of registry records.
+        """
+
+        if self._frames is None:
+            self.load()
+
+        if calib_type == 'bias':
+            band = None
+        key = (int(ccd), band, calib_type)
+
+        return sorted(self._frames.get(key, {}).values(),
+                      key=lambda r: (r['master'],
+                                     r['expnum'] or -1,
+                                     r['registered'],
+                                     ),
+                      reverse=True
+                      )
+
+    def lookup(self,
+               ccd: Union[str, int],
+               calib_type: str,
+               band: Optional[str] = None
+               ) -> Optional[dict]:
+        """
+        Get the best existing frame of a calibration type.
+
+        Args:
+            ccd: CCD number.
+            calib_type: Type of calibration frame, `bias` or `domeflat`.
+            band: Band of the frame. Ignored for biases.
+
+        Returns:
+            The registry record of the best frame, or None if there are no
+            frames available.
+        """
+
+        for record in self.candidates(ccd, calib_type, band):
+            if Path(record['filepath']).is_file():
+                return record
+            self.logger.warning(f"Registered frame {record['filepath']} "
+                                f"no longer exists!"
+                                )
+
+        return None
+
+
+class CalibrationCache:
+    def __init__(self, cache_dir: Optional[Union[str, Path]] = None):
+        """
+        Constructor method.
+
+        The cache stores products derived from calibration frames, such as
+        the overscan corrected bias or the normalised flat, as `.npy` files
+        that can be memory-mapped by every science frame of a CCD. A
+        product is rebuilt whenever the size or modification time of its
+        source frame changes.
+
+        Args:
+            cache_dir: Directory to store the products in. Defaults to the
+                `calibration` directory in the dwfprepipe cache directory.
+
+        Returns:
+            None
+        """
+
+        self.logger = logging.getLogger(
+            'dwf_prepipe.calibration.CalibrationCache'
+        )
+
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / 'calibration'
+        self.cache_dir = Path(cache_dir)
+
+        self._loaded = {}
+
+    def _path(self, kind: str, source: Union[str, Path]) -> Path:
+        source = Path(source).resolve()
+        stat = source.stat()
+
+        source_key = hashlib.blake2b(str(source).encode(),
+                                     digest_size=8
+                                     ).hexdigest()
+        version_key = hashlib.blake2b(
+            f'{stat.st_size}:{stat.st_mtime_ns}'.encode(),
+            digest_size=8
+        ).hexdigest()
+
+        return self.cache_dir / f'{kind}.{source_key}.{version_key}.npy'
+
+    def get(self,
+            kind: str,
+            source: Union[str, Path],
+            build: Callable
+            ):
+        """
+        Get a calibration product, building it if it is not in the cache or
+        its source frame has changed.
+
+        Args:
+            kind: Name of the product, e.g. `bias`.
+            source: Path to the calibration frame it is derived from.
+            build: Function that builds the product array from `source`.
+
+        Returns:
+            The product, as a read-only memory-mapped array.
+        """
+        import numpy as np
+
+        path = self._path(kind, source)
+        if path in self._loaded:
+            return self._loaded[path]
+
+        if not path.is_file():
+            self.logger.info(f"Building {kind} product of {source}")
+            product = build(source)
+
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f'.tmp{os.getpid()}')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, product)
+            os.replace(tmp_path, path)
+
+            # Remove the products of older versions of the source frame
+            source_prefix = '.'.join(path.name.split('.')[:2])
+            for old_path in self.cache_dir.glob(f'{source_prefix}.*.npy'):
+                if old_path != path:
+                    self.logger.debug(f"Removing outdated {old_path}")
+                    old_path.unlink(missing_ok=True)
+
+        self.logger.debug(f"Loading {kind} product of {source} from {path}")
+        product = np.load(path, mmap_mode='r')
+        self._loaded[path] = product
+
+        return product
+
+
+# Number of CCDs in DECam
+N_CCDS = 62
+
+
+class BadPixelStore:
+    def __init__(self, store_dir: Optional[Union[str, Path]] = None):
+        """
+        Constructor method.
+
+        The store holds the bad pixels of every CCD in a single boolean
+        `.npy` array of shape (N_CCDS, rows, columns), indexed by CCD
+        number - 1, and an index file with the bad pixel mask each CCD was
+        built from. The array is memory-mapped, so a lookup is a view with
+        no copy and no FITS parsing, and all CCD workers on a node share
+        the same pages. It is built once with `build`, e.g. by
+        prepipe_build_bpm.
+
+        Bit-packing the masks would make the store 8 times smaller, but
+        every lookup would then unpack a full copy of the mask.
+
+        Args:
+            store_dir: Directory of the store. Defaults to the `bpm`
+                directory in the dwfprepipe cache directory.
+
+        Returns:
+            None
+        """
+
+        self.logger = logging.getLogger(
+            'dwf_prepipe.calibration.BadPixelStore'
+        )
+
+        if store_dir is None:
+            store_dir = get_cache_dir() / 'bpm'
+        self.store_dir = Path(store_dir)
+        self.index_path = self.store_dir / 'bpm_index.json'
+
+        self._index = None
+        self._masks = None
+
+    @staticmethod
+    def _source_version(source: Path) -> str:
+        stat = source.stat()
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+    def build(self, sources: Dict[int, Union[str, Path]]):
+        """
+        Build the store from the bad pixel masks of the CCDs, replacing any
+        existing store.
+
+        Args:
+            sources: Path to the bad pixel mask of each CCD number.
+
+        Returns:
+            None
+        """
+        import json
+        import numpy as np
+        from astropy.io import fits
+
+        sources = {int(ccd): Path(source).resolve()
+                   for ccd, source in sources.items()
+                   }
+        versions = {ccd: self._source_version(source)
+                    for ccd, source in sources.items()
+                    }
+        store_key = hashlib.blake2b(
+            json.dumps(sorted((ccd, str(sources[ccd]), versions[ccd])
+                              for ccd in sources
+                              )).encode(),
+            digest_size=8
+        ).hexdigest()
+        store_path = self.store_dir / f'bpm.{store_key}.npy'
+
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = store_path.with_suffix(f'.tmp{os.getpid()}')
+
+        masks = None
+        for ccd, source in sorted(sources.items()):
+            if not 1 <= ccd <= N_CCDS:
+                raise ValueError(f"Invalid CCD number {ccd} for {source}")
+
+            with fits.open(source) as bp:
+                bad_pixels = bp[0].data != 0
+
+            if masks is None:
+                # Written one CCD at a time, so only one mask is in memory
+                masks = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode='w+',
+                    dtype=bool,
+                    shape=(N_CCDS,) + bad_pixels.shape
+                )
+            masks[ccd - 1] = bad_pixels
+            self.logger.debug(f"Added CCD {ccd} from {source}")
+
+        if masks is None:
+            raise ValueError("No bad pixel masks to build the store from")
+
+        masks.flush()
+        del masks
+        os.replace(tmp_path, store_path)
+
+        index = {'store': store_path.name,
+                 'ccds': {str(ccd): {'source': str(sources[ccd]),
+                                     'version': versions[ccd],
+                                     }
+                          for ccd in sorted(sources)
+                          },
+                 }
+        tmp_path = self.index_path.with_suffix(f'.tmp{os.getpid()}')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+        # Remove any previous stores. Processes that still have one mapped
+        # keep reading it until they exit.
+        for old_path in self.store_dir.glob('bpm.*.npy'):
+            if old_path != store_path:
+                self.logger.debug(f"Removing outdated {old_path}")
+                old_path.unlink(missing_ok=True)
+
+        self._index = None
+        self._masks = None
+
+        self.logger.info(f"Built bad pixel store {store_path} for "
+                         f"{len(sources)} CCDs"
+                         )
+
+    def load(self) -> bool:
+        """
+        Load the index and memory-map the store, if it has been built.
+
+        Args:
+            None
+
+        Returns:
+            Whether the store exists.
+        """
+        import json
+        import numpy as np
+
+        if self._masks is not None:
+            return True
+
+        if not self.index_path.is_file():
+            return False
+
+        with open(self.index_path) as f:
+            index = json.load(f)
+
+        self._masks = np.load(self.store_dir / index['store'], mmap_mode='r')
+        self._index = index['ccds']
+
+        return True
+
+    def get(self, ccdnum: Union[str, int], source: Union[str, Path]):
+        """
+        Get the bad pixels of a CCD.
+
+        Args:
+            ccdnum: CCD number.
+            source: Path to the bad pixel mask of the CCD. The store is only
+                used if it was built from this version of the file.
+
+        Returns:
+            A read-only boolean view of the bad pixels, or None if the CCD
+            is not in the store or its bad pixel mask has changed since the
+            store was built.
+        """
+        if not self.load():
+            return None
+
+        entry = self._index.get(str(int(ccdnum)))
+        if entry is None:
+            self.logger.debug(f"CCD {ccdnum} is not in the bad pixel store")
+            return None
+
+        source = Path(source).resolve()
+        if entry['source'] != str(source) or \
+                entry['version'] != self._source_version(source):
+            self.logger.warning(f"Bad pixel store is out of date for "
+                                f"{source}. Rebuild it with "
+                                f"prepipe_build_bpm."
+                                )
+            return None
+
+        return self._masks[int(ccdnum) - 1]
+
+
+_bad_pixel_stores = {}
+
+
+def get_bad_pixel_store(store_dir: Optional[Union[str, Path]] = None
+                        ) -> BadPixelStore:
+    """
+    Get the bad pixel store of a directory, shared by everything in the
+    process so that it is only mapped once.
+
+    Args:
+        store_dir: Directory of the store. Defaults to the `bpm` directory
+            in the dwfprepipe cache directory.
+
+    Returns:
+        The store.
+    """
+    if store_dir is None:
+        store_dir = get_cache_dir() / 'bpm'
+    store_dir = Path(store_dir)
+
+    if store_dir not in _bad_pixel_stores:
+        _bad_pixel_stores[store_dir] = BadPixelStore(store_dir)
+
+    return _bad_pixel_stores[store_dir]
+
+
+def master_name(calib_type: str,
+                ut: str,
+                ccd: str,
+                band: Optional[str] = None
+                ) -> str:
+    """
+    Get the name of the master calibration frame of a night, as recognised
+    by `parse_calibration_name`.
+
+    Args:
+        calib_type: Type of calibration frame, `bias` or `domeflat`.
+        ut: UT date of the night in the form `utYYMMDD`.
+        ccd: CCD number, as used in the names of the individual frames.
+        band: Band of the frame. Ignored for biases.
+
+    Returns:
+        The name, e.g. `bias.master.ut230101_01.fits` or
+        `domeflat.g.master.ut230101_01.fits`.
+    """
+    if calib_type == 'bias':
+        return f"bias.master.{ut}_{ccd}.fits"
+
+    return f"domeflat.{band}.master.{ut}_{ccd}.fits"
+
+
+def _data_median(hdu) -> float:
+    """
+    Get the median of the data section of a raw frame.
+    """
+    import numpy as np
+
+    rows, cols = (tuple(map(int, s.split(':')))
+                  for s in hdu.header['DATASEC'][1:-1].split(',')[::-1])
+
+    return float(np.median(hdu.section[rows[0] - 1:rows[1],
+                                       cols[0] - 1:cols[1]
+                                       ]))
+
+
+def combine_median(frames: List[Union[str, Path]],
+                   out_path: Union[str, Path],
+                   max_memory: int,
+                   normalise: bool = False
+                   ) -> Path:
+    """
+    Median combine raw calibration frames into a master frame with the
+    same layout and header keywords, so that it is calibrated in the same
+    way as an individual frame.
+
+    The frames are combined in chunks of rows, read from the memory-mapped
+    files, so that the stack of a chunk stays within `max_memory`.
+
+    Args:
+        frames: Paths to the frames.
+        out_path: Path to write the master frame to.
+        max_memory: Memory budget in bytes for the stack of a chunk.
+        normalise: Whether to scale each frame by the median of its data
+            section before combining, as for flats taken at different
+            levels.
+
+    Returns:
+        The path to the master frame.
+    """
+    import numpy as np
+    from astropy.io import fits
+
+    out_path = Path(out_path)
+
+    with contextlib.ExitStack() as stack:
+        hdus = [stack.enter_context(fits.open(frame))[0] for frame in frames]
+
+        shape = hdus[0].shape
+        for frame, hdu in zip(frames, hdus):
+            if hdu.shape != shape:
+                raise ValueError(f"{frame} has shape {hdu.shape}, but "
+                                 f"{frames[0]} has shape {shape}"
+                                 )
+
+        if normalise:
+            scales = [_data_median(hdu) for hdu in hdus]
+        else:
+            scales = [1.0 for hdu in hdus]
+
+        chunk_rows = max(1, int(max_memory // (len(hdus) * shape[1] * 4)))
+        master = np.empty(shape, dtype='float32')
+        chunk = np.empty((len(hdus), min(chunk_rows, shape[0]), shape[1]),
+                         dtype='float32'
+                         )
+        for start in range(0, shape[0], chunk_rows):
+            stop = min(start + chunk_rows, shape[0])
+            rows = stop - start
+            for i, (hdu, scale) in enumerate(zip(hdus, scales)):
+                chunk[i, :rows] = hdu.section[start:stop]
+                if scale != 1.0:
+                    chunk[i, :rows] /= scale
+            # The chunk is overwritten, so no sorted copy is made
+            np.median(chunk[:, :rows],
+                      axis=0,
+                      out=master[start:stop],
+                      overwrite_input=True
+                      )
+
+        header = hdus[0].header.copy()
+
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    header['NCOMBINE'] = (len(frames), 'Number of frames combined')
+    header.add_history(f"Median of {len(frames)} frames by "
+                       f"prepipe_build_masters"
+                       )
+    for frame in frames:
+        header.add_history(f"Input: {Path(frame).name}")
+
+    tmp_path = out_path.with_name(f'{out_path.name}.tmp{os.getpid()}')
+    fits.PrimaryHDU(master, header=header).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, out_path)
+
+    return out_path
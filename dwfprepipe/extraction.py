@@ -0,0 +1,322 @@
+import logging
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from pathlib import Path
+from typing import Union, Optional
+
+from dwfprepipe.astrometry import write_ldac
+
+try:
+    import sep
+    use_sep = True
+except ImportError:
+    use_sep = False
+
+logger = logging.getLogger('dwf_prepipe.extraction')
+
+# Settings matching the SExtractor configuration in data/config/scamp.sex
+MAG_ZEROPOINT = 27.5
+DETECT_THRESH = 3.0
+DETECT_MINAREA = 5
+DEBLEND_NTHRESH = 32
+DEBLEND_MINCONT = 0.005
+BACK_SIZE = 64
+BACK_FILTERSIZE = 3
+# SExtractor defaults for MAG_AUTO
+KRON_FACT = 2.5
+KRON_MINRADIUS = 3.5
+
+# SExtractor FLAGS bits
+FLAG_DEBLENDED = 2
+FLAG_TRUNCATED = 8
+FLAG_APERTURE = 16
+
+
+class ExtractionError(Exception):
+    """
+    A defined error for an image that cannot be extracted in-process.
+    """
+    pass
+
+
+def _error_ellipse(var_x: np.ndarray,
+                   var_y: np.ndarray,
+                   cov_xy: np.ndarray):
+    """
+    Convert a position covariance matrix to the semi-major axis,
+    semi-minor axis and position angle (in degrees) of its error ellipse,
+    as SExtractor does.
+    """
+    mean = (var_x + var_y) / 2
+    diff = np.sqrt(((var_x - var_y) / 2) ** 2 + cov_xy ** 2)
+    erra = np.sqrt(mean + diff)
+    errb = np.sqrt(np.clip(mean - diff, 0, None))
+    theta = np.degrees(np.arctan2(2 * cov_xy, var_x - var_y) / 2)
+
+    return erra, errb, theta
+
+
+def extract_sources(data: np.ndarray,
+                    mask: Optional[np.ndarray] = None,
+                    thresh: float = DETECT_THRESH,
+                    minarea: int = DETECT_MINAREA
+                    ) -> np.ndarray:
+    """
+    Detect and measure the sources in a calibrated image with SEP, in the
+    same way as the SExtractor configuration used by the pipeline.
+
+    Windowed centroids, AUTO fluxes and FLUX_RADIUS are measured as in
+    SExtractor. The windowed centroid errors are approximated by the
+    isophotal ones.
+
+    Args:
+        data: Calibrated image. Not modified.
+        mask: Mask of the image. Pixels that are non-zero here or not
+            finite in `data` are ignored.
+        thresh: Detection threshold in units of the background RMS.
+        minarea: Minimum number of pixels above threshold.
+
+    Returns:
+        A record array of the measurements of each source, with SExtractor
+        column names and 1-based pixel coordinates.
+
+    Raises:
+        ExtractionError: SEP is not installed.
+    """
+    if not use_sep:
+        raise ExtractionError("sep is not installed, cannot extract "
+                              "sources in-process."
+                              )
+
+    bad = ~np.isfinite(data)
+    if mask is not None:
+        bad |= mask != 0
+
+    image = np.where(bad, 0, data).astype(np.float32)
+
+    bkg = sep.Background(image,
+                         mask=bad,
+                         bw=BACK_SIZE,
+                         bh=BACK_SIZE,
+                         fw=BACK_FILTERSIZE,
+                         fh=BACK_FILTERSIZE
+                         )
+    bkg.subfrom(image)
+    image[bad] = 0
+    rms = bkg.globalrms
+
+    # A full DECam CCD needs more than the default pixel stack
+    sep.set_extract_pixstack(max(sep.get_extract_pixstack(),
+                                 image.size // 4
+                                 ))
+    objects = sep.extract(image,
+                          thresh,
+                          err=rms,
+                          mask=bad,
+                          minarea=minarea,
+                          deblend_nthresh=DEBLEND_NTHRESH,
+                          deblend_cont=DEBLEND_MINCONT
+                          )
+    # Degenerate shapes break the aperture measurements
+    objects = objects[(objects['a'] > 0) & (objects['b'] > 0)]
+    x = objects['x']
+    y = objects['y']
+    a = objects['a']
+    b = objects['b']
+    theta = np.clip(objects['theta'], -np.pi / 2, np.pi / 2)
+
+    # AUTO photometry: Kron ellipse, or a circle for compact sources
+    kronrad, kron_flag = sep.kron_radius(image, x, y, a, b, theta, 6.0,
+                                         mask=bad
+                                         )
+    kronrad = np.where(np.isfinite(kronrad) & (kronrad > 0), kronrad, 0)
+    flux, fluxerr, aper_flag = sep.sum_ellipse(image, x, y, a, b, theta,
+                                               KRON_FACT * kronrad,
+                                               err=rms,
+                                               mask=bad,
+                                               subpix=1
+                                               )
+    compact = kronrad * np.sqrt(a * b) < KRON_MINRADIUS
+    if compact.any():
+        cflux, cfluxerr, cflag = sep.sum_circle(image,
+                                                x[compact],
+                                                y[compact],
+                                                KRON_MINRADIUS,
+                                                err=rms,
+                                                mask=bad,
+                                                subpix=1
+                                                )
+        flux[compact] = cflux
+        fluxerr[compact] = cfluxerr
+        aper_flag[compact] = cflag
+
+    flux_radius, radius_flag = sep.flux_radius(image, x, y, 6 * a, 0.5,
+                                               normflux=flux,
+                                               mask=bad,
+                                               subpix=5
+                                               )
+
+    # Windowed centroids, with the same window as SExtractor
+    sig = 2 * np.clip(flux_radius, 0.5, None) / 2.35
+    xwin, ywin, win_flag = sep.winpos(image, x, y, sig, mask=bad)
+    failed = win_flag != 0
+    xwin[failed] = x[failed]
+    ywin[failed] = y[failed]
+
+    flags = np.zeros(len(objects), dtype=np.int16)
+    flags[(objects['flag'] & sep.OBJ_MERGED) != 0] |= FLAG_DEBLENDED
+    flags[(objects['flag'] & sep.OBJ_TRUNC) != 0] |= FLAG_TRUNCATED
+    aper_flag |= kron_flag
+    flags[(aper_flag & (sep.APER_TRUNC | sep.APER_HASMASKED)) != 0] |= \
+        FLAG_APERTURE
+
+    erra, errb, errtheta = _error_ellipse(objects['errx2'],
+                                          objects['erry2'],
+                                          objects['errxy']
+                                          )
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positive = flux > 0
+        mag = np.where(positive,
+                       MAG_ZEROPOINT - 2.5 * np.log10(flux),
+                       99.0
+                       )
+        magerr = np.where(positive, 1.0857 * fluxerr / flux, 99.0)
+
+    return np.rec.fromarrays(
+        [np.arange(1, len(objects) + 1, dtype=np.int32),
+         xwin + 1,
+         ywin + 1,
+         erra,
+         errb,
+         errtheta,
+         a,
+         b,
+         np.degrees(theta),
+         a / b,
+         2 * flux_radius,
+         flux,
+         fluxerr,
+         mag,
+         magerr,
+         flags,
+         np.zeros(len(objects), dtype=np.int16),
+         flux_radius,
+         objects['peak'],
+         ],
+        names=['NUMBER',
+               'XWIN_IMAGE',
+               'YWIN_IMAGE',
+               'ERRAWIN_IMAGE',
+               'ERRBWIN_IMAGE',
+               'ERRTHETAWIN_IMAGE',
+               'AWIN_IMAGE',
+               'BWIN_IMAGE',
+               'THETAWIN_IMAGE',
+               'ELONGATION',
+               'FWHM_IMAGE',
+               'FLUX_AUTO',
+               'FLUXERR_AUTO',
+               'MAG_AUTO',
+               'MAGERR_AUTO',
+               'FLAGS',
+               'FLAGS_WEIGHT',
+               'FLUX_RADIUS',
+               'FLUX_MAX',
+               ]
+    )
+
+
+def _world_columns(sources: np.ndarray, header: fits.Header) -> dict:
+    """
+    Sky positions and position errors of the sources, from the initial WCS
+    of the image.
+    """
+    wcs = WCS(header)
+    ra, dec = wcs.all_pix2world(sources['XWIN_IMAGE'],
+                                sources['YWIN_IMAGE'],
+                                1
+                                )
+    # deg/pixel
+    scale = np.sqrt(np.abs(np.linalg.det(wcs.pixel_scale_matrix)))
+
+    return {'X_WORLD': ra,
+            'Y_WORLD': dec,
+            'ERRA_WORLD': sources['ERRAWIN_IMAGE'] * scale,
+            'ERRB_WORLD': sources['ERRBWIN_IMAGE'] * scale,
+            'ERRTHETA_WORLD': sources['ERRTHETAWIN_IMAGE'],
+            }
+
+
+# Column formats and units of the LDAC_OBJECTS table
+LDAC_COLUMNS = {'NUMBER': ('1J', ''),
+                'XWIN_IMAGE': ('1D', 'pixel'),
+                'YWIN_IMAGE': ('1D', 'pixel'),
+                'ERRAWIN_IMAGE': ('1E', 'pixel'),
+                'ERRBWIN_IMAGE': ('1E', 'pixel'),
+                'ERRTHETAWIN_IMAGE': ('1E', 'deg'),
+                'X_WORLD': ('1D', 'deg'),
+                'Y_WORLD': ('1D', 'deg'),
+                'ERRA_WORLD': ('1E', 'deg'),
+                'ERRB_WORLD': ('1E', 'deg'),
+                'ERRTHETA_WORLD': ('1E', 'deg'),
+                'AWIN_IMAGE': ('1E', 'pixel'),
+                'BWIN_IMAGE': ('1E', 'pixel'),
+                'THETAWIN_IMAGE': ('1E', 'deg'),
+                'ELONGATION': ('1E', ''),
+                'FWHM_IMAGE': ('1E', 'pixel'),
+                'FLUX_AUTO': ('1E', 'count'),
+                'FLUXERR_AUTO': ('1E', 'count'),
+                'MAG_AUTO': ('1E', 'mag'),
+                'MAGERR_AUTO': ('1E', 'mag'),
+                'FLAGS': ('1I', ''),
+                'FLAGS_WEIGHT': ('1I', ''),
+                'FLUX_RADIUS': ('1E', 'pixel'),
+                'FLUX_MAX': ('1E', 'count'),
+                }
+
+
+def extract_catalog(data: np.ndarray,
+                    mask: Optional[np.ndarray],
+                    header: fits.Header,
+                    catalog_path: Union[str, Path]
+                    ) -> Path:
+    """
+    Extract the sources of a calibrated image with SEP and write them to a
+    FITS_LDAC catalog that SCAMP can use in place of a SExtractor catalog.
+
+    Args:
+        data: Calibrated image.
+        mask: Mask of the image. See `extract_sources`.
+        header: Header of the image, with its initial WCS.
+        catalog_path: Path to write the catalog to.
+
+    Returns:
+        The path to the catalog.
+
+    Raises:
+        ExtractionError: SEP is not installed.
+    """
+    sources = extract_sources(data, mask)
+    values = _world_columns(sources, header)
+
+    header = header.copy()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = data.shape[1]
+    header['NAXIS2'] = data.shape[0]
+
+    columns = []
+    for name, (fmt, unit) in LDAC_COLUMNS.items():
+        array = values[name] if name in values else sources[name]
+        columns.append(fits.Column(name=name,
+                                   format=fmt,
+                                   unit=unit or None,
+                                   array=array
+                                   ))
+
+    logger.debug(f"Extracted {len(sources)} sources to {catalog_path}")
+
+    return write_ldac(catalog_path, header, columns)
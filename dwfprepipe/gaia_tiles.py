@@ -0,0 +1,223 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.wcs import WCS
+from pathlib import Path
+from typing import Union, List, Optional, Tuple
+from dwfprepipe.astrometry import ldac_imhead
+
+logger = logging.getLogger('dwf_prepipe.gaia_tiles')
+
+INDEX_NAME = 'tiles.json'
+
+
+def _n_ra_tiles(band: np.ndarray, tile_size: float) -> np.ndarray:
+    """
+    Number of RA tiles in each declination band, chosen so that tiles are
+    roughly `tile_size` wide on the sky.
+    """
+    dec_centre = -90 + (band + 0.5) * tile_size
+    n_ra = np.floor(360 * np.cos(np.radians(dec_centre)) / tile_size)
+
+    return np.maximum(n_ra, 1).astype(int)
+
+
+def tile_ids(ra: np.ndarray,
+             dec: np.ndarray,
+             tile_size: float
+             ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the tile containing each position.
+
+    The sky is split into declination bands of height `tile_size`, and each
+    band is split into equal RA tiles that are roughly `tile_size` wide.
+
+    Args:
+        ra: Right ascensions in degrees.
+        dec: Declinations in degrees.
+        tile_size: Tile size in degrees.
+
+    Returns:
+        The declination band and RA tile index of each position.
+    """
+    n_bands = int(np.ceil(180 / tile_size))
+    band = np.clip(np.floor((np.asarray(dec) + 90) / tile_size),
+                   0,
+                   n_bands - 1
+                   ).astype(int)
+    n_ra = _n_ra_tiles(band, tile_size)
+    ra_idx = np.floor(np.mod(ra, 360) / 360 * n_ra).astype(int) % n_ra
+
+    return band, ra_idx
+
+
+def _tile_name(band: int, ra_idx: int) -> str:
+    return f'd{band:04d}_r{ra_idx:04d}'
+
+
+def _read_catalog(catalog_path: Union[str, Path]):
+    """
+    Read a reference catalog, which is either an LDAC catalog or a plain
+    FITS table (e.g. a larger Gaia dump).
+
+    Returns:
+        The LDAC_IMHEAD HDU and the table of objects.
+    """
+    with fits.open(catalog_path) as hdul:
+        if 'LDAC_OBJECTS' in hdul:
+            imhead = hdul['LDAC_IMHEAD'].copy()
+            objects = hdul['LDAC_OBJECTS'].data.copy()
+        else:
+            imhead = ldac_imhead(fits.Header())
+            objects = hdul[1].data.copy()
+
+    return imhead, objects
+
+
+def build_tiles(catalog_paths: List[Union[str, Path]],
+                out_dir: Union[str, Path],
+                tile_size: float = 0.5,
+                prefix: str = 'gaia',
+                ra_key: str = 'RA_ICRS',
+                dec_key: str = 'DE_ICRS'
+                ) -> dict:
+    """
+    Split one or more reference catalogs into LDAC tiles and write a
+    spatial index of the tiles.
+
+    Args:
+        catalog_paths: Catalogs to split.
+        out_dir: Directory to write the tiles and index to.
+        tile_size: Tile size in degrees.
+        prefix: Prefix of the tile file names.
+        ra_key: Name of the RA column.
+        dec_key: Name of the Dec column.
+
+    Returns:
+        The tile index.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    imhead = None
+    objects = []
+    for catalog_path in catalog_paths:
+        logger.info(f"Reading {catalog_path}")
+        cat_imhead, cat_objects = _read_catalog(catalog_path)
+        if imhead is None:
+            imhead = cat_imhead
+        objects.append(cat_objects)
+    objects = np.concatenate(objects) if len(objects) > 1 else objects[0]
+
+    band, ra_idx = tile_ids(objects[ra_key], objects[dec_key], tile_size)
+    n_ra = _n_ra_tiles(band, tile_size)
+
+    # Sort by tile so each tile is a contiguous slice of the catalog
+    order = np.lexsort((ra_idx, band))
+    tile_key = band[order].astype(np.int64) * 100000 + ra_idx[order]
+    bounds = np.flatnonzero(np.diff(tile_key)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(order)]])
+
+    index = {'tile_size': tile_size, 'tiles': {}}
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+        tile_band = int(band[rows[0]])
+        tile_ra = int(ra_idx[rows[0]])
+        name = _tile_name(tile_band, tile_ra)
+        tile_file = f'{prefix}_{name}_LDAC.fits'
+
+        ra_width = 360 / n_ra[rows[0]]
+        index['tiles'][name] = {
+            'file': tile_file,
+            'nstars': int(len(rows)),
+            'ra_min': tile_ra * ra_width,
+            'ra_max': (tile_ra + 1) * ra_width,
+            'dec_min': -90 + tile_band * tile_size,
+            'dec_max': -90 + (tile_band + 1) * tile_size,
+        }
+
+        tile_objects = fits.BinTableHDU(data=objects[rows])
+        tile_objects.header['EXTNAME'] = 'LDAC_OBJECTS'
+        fits.HDUList([fits.PrimaryHDU(), imhead, tile_objects]).writeto(
+            out_dir / tile_file, overwrite=True
+        )
+
+    logger.info(f"Wrote {len(index['tiles'])} tiles to {out_dir}")
+
+    tmp_path = out_dir / f'{INDEX_NAME}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, out_dir / INDEX_NAME)
+
+    return index
+
+
+def select_tiles(tile_dir: Union[str, Path],
+                 header: Union[fits.Header, dict],
+                 margin: float = 0.05
+                 ) -> Optional[List[Path]]:
+    """
+    Select the tiles that overlap the footprint of a CCD.
+
+    Args:
+        tile_dir: Directory containing the tiles and their index.
+        header: Header of the CCD frame, containing its WCS, either as an
+            astropy header or as a dictionary from `read_header`.
+        margin: Margin around the footprint in degrees, to allow for
+            errors in the initial WCS.
+
+    Returns:
+        The paths to the overlapping tiles, or None if there is no tile
+        index or the footprint cannot be determined.
+    """
+    tile_dir = Path(tile_dir)
+    index_path = tile_dir / INDEX_NAME
+    if not index_path.is_file():
+        return None
+
+    with open(index_path) as f:
+        index = json.load(f)
+    tile_size = index['tile_size']
+
+    try:
+        footprint = WCS(header).calc_footprint()
+    except Exception as e:
+        logger.warning(f"Could not determine the CCD footprint: {e}")
+        return None
+
+    ra = footprint[:, 0]
+    dec = footprint[:, 1]
+
+    dec_min = max(dec.min() - margin, -90)
+    dec_max = min(dec.max() + margin, 90)
+    ra_margin = margin / max(np.cos(np.radians(max(abs(dec_min),
+                                                   abs(dec_max)))),
+                             1e-3
+                             )
+
+    # Unwrap the RA range relative to the first corner of the footprint
+    ra_centre = ra[0]
+    ra_offsets = (ra - ra_centre + 180) % 360 - 180
+    ra_lo = ra_centre + ra_offsets.min() - ra_margin
+    ra_hi = ra_centre + ra_offsets.max() + ra_margin
+
+    # Look up the tiles directly from the tiling scheme
+    band_lo, _ = tile_ids(ra_centre, dec_min, tile_size)
+    band_hi, _ = tile_ids(ra_centre, dec_max, tile_size)
+
+    selected = set()
+    for band in range(int(band_lo), int(band_hi) + 1):
+        n_ra = int(_n_ra_tiles(np.array(band), tile_size))
+        idx_lo = int(np.floor(ra_lo / 360 * n_ra))
+        idx_hi = int(np.floor(ra_hi / 360 * n_ra))
+        for ra_idx in range(idx_lo, min(idx_hi, idx_lo + n_ra - 1) + 1):
+            tile = index['tiles'].get(_tile_name(band, ra_idx % n_ra))
+            if tile is not None:
+                selected.add(tile_dir / tile['file'])
+
+    return sorted(selected)
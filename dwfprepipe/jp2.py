@@ -0,0 +1,203 @@
+import os
+import logging
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from astropy.io import fits
+from pathlib import Path
+from typing import Union, Optional
+
+try:
+    import glymur
+    use_glymur = True
+except ImportError:
+    use_glymur = False
+
+logger = logging.getLogger('dwf_prepipe.jp2')
+
+FITS_BLOCK_SIZE = 2880
+
+# Big-endian dtype of the stored pixel values for each FITS BITPIX
+BITPIX_DTYPES = {8: 'u1',
+                 16: '>i2',
+                 32: '>i4',
+                 64: '>i8',
+                 -32: '>f4',
+                 -64: '>f8',
+                 }
+
+
+class JP2DecodeError(Exception):
+    """
+    A defined error for a .jp2 file that cannot be decoded in-process.
+    """
+    pass
+
+
+def _box_payloads(boxes):
+    """
+    Yield the raw contents of all (nested) boxes of a JPEG2000 file that
+    could hold the embedded FITS header.
+    """
+    for box in boxes:
+        xml = getattr(box, 'xml', None)
+        if xml is not None:
+            if hasattr(xml, 'getroot'):
+                xml = xml.getroot()
+            yield ET.tostring(xml)
+        for attr in ('raw_data', 'data', 'text'):
+            payload = getattr(box, attr, None)
+            if isinstance(payload, str):
+                payload = payload.encode('ascii', errors='ignore')
+            if isinstance(payload, bytes):
+                yield payload
+        yield from _box_payloads(getattr(box, 'box', []) or [])
+
+
+def _find_fits_header(jp2) -> Optional[fits.Header]:
+    """
+    Find the FITS header that f2j_DECam embeds in the .jp2 file.
+
+    Args:
+        jp2: The opened JPEG2000 file.
+
+    Returns:
+        The FITS header, or None if no header was found.
+    """
+    for payload in _box_payloads(jp2.box):
+        start = payload.find(b'SIMPLE  =')
+        if start < 0:
+            continue
+        cards = payload[start:].decode('ascii', errors='ignore')
+        try:
+            return fits.Header.fromstring(cards)
+        except Exception:
+            continue
+
+    return None
+
+
+def _stored_values(data: np.ndarray, header: fits.Header) -> np.ndarray:
+    """
+    Convert the decoded pixels to the values stored in the FITS file that
+    f2j_DECam encoded, as given by the BITPIX of its header.
+
+    Unsigned pixels with the BZERO offset of the FITS unsigned integer
+    convention (e.g. 32768 for BITPIX 16) are taken to be the physical
+    values, and have the offset removed. Any other pixels are taken to be
+    the stored values.
+
+    Raises:
+        JP2DecodeError: The pixels do not fit the BITPIX of the header.
+    """
+    bitpix = header.get('BITPIX')
+    if bitpix not in BITPIX_DTYPES:
+        raise JP2DecodeError(f"Unsupported BITPIX {bitpix}")
+    dtype = np.dtype(BITPIX_DTYPES[bitpix])
+
+    bzero = header.get('BZERO', 0)
+    bscale = header.get('BSCALE', 1)
+    if data.dtype.kind == 'u' and dtype.kind == 'i' and \
+            data.dtype.itemsize == dtype.itemsize and bscale == 1 and \
+            bzero == 2 ** (8 * dtype.itemsize - 1):
+        return (data.astype('i8') - bzero).astype(dtype)
+
+    stored = data.astype(dtype)
+    if not np.array_equal(stored, data):
+        raise JP2DecodeError(f"Decoded {data.dtype} pixels do not fit "
+                             f"BITPIX {bitpix}"
+                             )
+
+    return stored
+
+
+def decode_jp2_fits(filepath: Union[str, Path]) -> bytes:
+    """
+    Decode a DECam CCD .jp2 file in memory into the FITS file that
+    `j2f_DECam` would write, without writing it to disk.
+
+    The image is decoded with OpenJPEG (via glymur), and the FITS header is
+    read from the metadata boxes of the .jp2 file. The pixels are stored
+    with the BITPIX, BZERO and BSCALE of that header, so the raw archive
+    copy keeps the integer format of the original frame.
+
+    Args:
+        filepath: Path to the .jp2 file.
+
+    Returns:
+        The contents of the FITS file.
+
+    Raises:
+        JP2DecodeError: The file could not be decoded in-process, e.g.
+            because glymur is not installed or the file does not contain
+            a FITS header. The caller should fall back to `j2f_DECam`.
+    """
+    if not use_glymur:
+        raise JP2DecodeError("glymur is not installed, cannot decode "
+                             ".jp2 files in-process."
+                             )
+
+    try:
+        jp2 = glymur.Jp2k(str(filepath))
+        data = jp2[:]
+    except Exception as e:
+        raise JP2DecodeError(f"Could not decode {filepath}: {e}")
+
+    header = _find_fits_header(jp2)
+    if header is None:
+        raise JP2DecodeError(f"No FITS header found in {filepath}")
+
+    if data.ndim == 3:
+        data = data[:, :, 0]
+
+    shape = (header.get('NAXIS2'), header.get('NAXIS1'))
+    if header.get('NAXIS') != 2 or data.shape != shape:
+        raise JP2DecodeError(f"Decoded image of {filepath} has shape "
+                             f"{data.shape}, but its header gives {shape}"
+                             )
+
+    stored = _stored_values(data, header)
+
+    # Pad the data to a whole number of FITS blocks
+    data_bytes = stored.tobytes()
+    data_bytes += b'\0' * (-len(data_bytes) % FITS_BLOCK_SIZE)
+
+    logger.debug(f"Decoded {filepath} in memory with shape {data.shape}")
+
+    return header.tostring().encode('ascii') + data_bytes
+
+
+def decode_jp2(filepath: Union[str, Path]) -> fits.PrimaryHDU:
+    """
+    Decode a DECam CCD .jp2 file in memory, see `decode_jp2_fits`.
+
+    Args:
+        filepath: Path to the .jp2 file.
+
+    Returns:
+        A primary HDU of the decoded FITS file. Its data are scaled to the
+        physical pixel values when accessed, as for a file read from disk.
+
+    Raises:
+        JP2DecodeError: The file could not be decoded in-process.
+    """
+    return fits.HDUList.fromstring(decode_jp2_fits(filepath))[0]
+
+
+def write_fits_bytes(fits_bytes: bytes, out_path: Union[str, Path]):
+    """
+    Write the FITS file returned by `decode_jp2_fits` to disk, unchanged.
+
+    Args:
+        fits_bytes: The contents of the FITS file.
+        out_path: Path to write the file to.
+
+    Returns:
+        None
+    """
+    out_path = Path(out_path)
+    tmp_path = out_path.with_name(f'{out_path.name}.tmp{os.getpid()}')
+    with open(tmp_path, 'wb') as f:
+        f.write(fits_bytes)
+    os.replace(tmp_path, out_path)
@@ -0,0 +1,234 @@
+import logging
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+try:
+    import numexpr
+    use_numexpr = True
+except ImportError:
+    use_numexpr = False
+
+try:
+    import numba
+    use_numba = True
+except ImportError:
+    use_numba = False
+
+logger = logging.getLogger('dwf_prepipe.kernels')
+
+# Pixels per tile. With the science, bias, flat, output and mask tiles this
+# keeps the working set of each thread within a typical L2 cache.
+TILE_PIXELS = 2 ** 16
+
+# Mask bits set by the calibration
+MASK_INVALID = 2 ** 1
+MASK_BAD_PIXEL = 2 ** 2
+
+BACKENDS = ('numba', 'numexpr', 'numpy')
+
+
+if use_numba:
+    # error_model='numpy' makes a division by zero give inf/nan, as in
+    # NumPy, rather than raise
+    @numba.njit(nogil=True, cache=True, error_model='numpy')
+    def _calibrate_tile_numba(data, bias, flat, mask, bad_pixels, out):
+        for i in range(out.shape[0]):
+            for j in range(out.shape[1]):
+                value = (data[i, j] - bias[i, j]) / flat[i, j]
+                flags = mask[i, j]
+                if not np.isfinite(value):
+                    flags |= MASK_INVALID
+                if bad_pixels[i, j]:
+                    flags |= MASK_BAD_PIXEL
+                mask[i, j] = flags
+                if flags != 0:
+                    out[i, j] = np.nan
+                else:
+                    out[i, j] = value
+
+
+def get_backend(backend: Optional[str] = None) -> str:
+    """
+    Get the backend of the calibration kernel.
+
+    Args:
+        backend: One of `BACKENDS`, or None for the fastest one that is
+            installed.
+
+    Returns:
+        The backend.
+
+    Raises:
+        ValueError: The backend does not exist or is not installed.
+    """
+    if backend is None:
+        if use_numba:
+            return 'numba'
+        if use_numexpr:
+            return 'numexpr'
+        return 'numpy'
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown calibration backend {backend}. Should be "
+                         f"one of {', '.join(BACKENDS)}."
+                         )
+    if (backend == 'numba' and not use_numba) or \
+            (backend == 'numexpr' and not use_numexpr):
+        raise ValueError(f"{backend} is not installed.")
+
+    return backend
+
+
+def available_backends() -> List[str]:
+    """
+    Get the backends of the calibration kernel that are installed.
+    """
+    return [backend for backend in BACKENDS
+            if backend == 'numpy' or
+            (backend == 'numba' and use_numba) or
+            (backend == 'numexpr' and use_numexpr)
+            ]
+
+
+def _calibrate_tile_numpy(data, bias, flat, mask, bad_pixels, out, backend):
+    """
+    Calibrate a tile with NumPy, using numexpr for the arithmetic if asked.
+    """
+    if backend == 'numexpr':
+        numexpr.evaluate('(data - bias) / flat', out=out, casting='no')
+    else:
+        # The bias is subtracted in the precision of the image, as the
+        # in-place subtraction of the reference does
+        debiased = np.empty(data.shape, dtype=data.dtype)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.subtract(data, bias, out=debiased)
+            np.divide(debiased, flat, out=out)
+        del debiased
+
+    invalid = np.isfinite(out)
+    np.logical_not(invalid, out=invalid)
+    np.bitwise_or(mask, MASK_INVALID, out=mask, where=invalid)
+    np.bitwise_or(mask, MASK_BAD_PIXEL, out=mask, where=bad_pixels)
+    out[mask != 0] = np.nan
+
+
+def _tiles(shape: Tuple[int, int], tile_pixels: int) -> List[slice]:
+    """
+    Split the rows of an image into tiles of about `tile_pixels` pixels.
+    """
+    tile_rows = max(1, tile_pixels // max(1, shape[1]))
+
+    return [slice(start, min(start + tile_rows, shape[0]))
+            for start in range(0, shape[0], tile_rows)
+            ]
+
+
+def calibrate_image(data: np.ndarray,
+                    bias: np.ndarray,
+                    flat: np.ndarray,
+                    mask: np.ndarray,
+                    bad_pixels: np.ndarray,
+                    n_threads: int = 1,
+                    backend: Optional[str] = None,
+                    tile_pixels: int = TILE_PIXELS
+                    ) -> np.ndarray:
+    """
+    Bias subtract, flat field and mask an overscan corrected image in a
+    single pass over cache-sized tiles.
+
+    The result is identical, bit for bit, to `calibrate_image_reference`,
+    without its full-size temporary images.
+
+    Args:
+        data: Overscan corrected image, trimmed to its data section. Not
+            modified.
+        bias: Overscan corrected bias, trimmed to the same section.
+        flat: Normalised flat.
+        mask: Mask of the image, e.g. the saturated pixels. Invalid and
+            bad pixels are flagged in place.
+        bad_pixels: Boolean array of the bad pixels.
+        n_threads: Number of threads to calibrate tiles with.
+        backend: Backend of the kernel, see `get_backend`.
+        tile_pixels: Number of pixels in each tile.
+
+    Returns:
+        The calibrated image, with masked pixels set to NaN.
+    """
+    backend = get_backend(backend)
+
+    out = np.empty(data.shape, dtype=np.result_type(data.dtype, flat.dtype))
+
+    # The compiled kernels do the arithmetic in the promoted precision, so
+    # they only match the reference when the images share one precision
+    if backend != 'numpy' and \
+            not data.dtype == bias.dtype == flat.dtype == out.dtype:
+        logger.debug(f"Mixed precision images. Using numpy instead of "
+                     f"{backend}"
+                     )
+        backend = 'numpy'
+
+    def calibrate_tile(rows):
+        args = (data[rows],
+                bias[rows],
+                flat[rows],
+                mask[rows],
+                bad_pixels[rows],
+                out[rows]
+                )
+        if backend == 'numba':
+            _calibrate_tile_numba(*args)
+        else:
+            _calibrate_tile_numpy(*args, backend)
+
+    tiles = _tiles(data.shape, tile_pixels)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            # Consume the results so that errors are raised
+            list(pool.map(calibrate_tile, tiles))
+    else:
+        for rows in tiles:
+            calibrate_tile(rows)
+
+    return out
+
+
+def calibrate_image_reference(data: np.ndarray,
+                              bias: np.ndarray,
+                              flat: np.ndarray,
+                              mask: np.ndarray,
+                              bad_pixels: np.ndarray
+                              ) -> np.ndarray:
+    """
+    Bias subtract, flat field and mask an overscan corrected image with
+    whole-image NumPy operations, as the pipeline originally did. Used to
+    check `calibrate_image`.
+
+    Args:
+        data: Overscan corrected image, trimmed to its data section. The
+            bias is subtracted in place.
+        bias: Overscan corrected bias, trimmed to the same section.
+        flat: Normalised flat.
+        mask: Mask of the image. Invalid and bad pixels are flagged in
+            place.
+        bad_pixels: Boolean array of the bad pixels.
+
+    Returns:
+        The calibrated image, with masked pixels set to NaN.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data -= bias
+        calibpix = data / flat
+
+    invalid = np.isfinite(calibpix)
+    np.logical_not(invalid, out=invalid)
+    np.bitwise_or(mask, MASK_INVALID, out=mask, where=invalid)
+    del invalid
+
+    np.bitwise_or(mask, MASK_BAD_PIXEL, out=mask, where=bad_pixels)
+
+    calibpix[np.where(mask != 0)] = np.nan
+
+    return calibpix
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+from pathlib import Path
+from typing import Union, Optional
+
+try:
+    import xxhash
+    use_xxhash = True
+except ImportError:
+    use_xxhash = False
+
+logger = logging.getLogger('dwf_prepipe.manifest')
+
+# Bytes hashed at a time
+HASH_CHUNK = 2 ** 20
+
+# xxh3 is several times faster than BLAKE2, so it is used when installed
+DEFAULT_ALGORITHM = 'xxh3_64' if use_xxhash else 'blake2b'
+
+
+class ManifestError(Exception):
+    """
+    A defined error for a manifest that cannot be checked.
+    """
+    pass
+
+
+def manifest_path(filepath: Union[str, Path]) -> Path:
+    """
+    Get the path of the manifest of a file, which sits next to it.
+    """
+    filepath = Path(filepath)
+
+    return filepath.with_name(f'{filepath.name}.manifest.json')
+
+
+def _hasher(algorithm: str):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == 'xxh3_64':
+        if not use_xxhash:
+            raise ManifestError("xxhash is not installed, cannot check an "
+                                "xxh3_64 digest."
+                                )
+        return xxhash.xxh3_64()
+
+    raise ManifestError(f"Unknown hash algorithm {algorithm}")
+
+
+def file_digest(filepath: Union[str, Path],
+                algorithm: str = DEFAULT_ALGORITHM
+                ) -> str:
+    """
+    Hash a file, streaming it in chunks.
+
+    Args:
+        filepath: Path to the file.
+        algorithm: `xxh3_64` (requires xxhash) or `blake2b`.
+
+    Returns:
+        The hex digest.
+
+    Raises:
+        ManifestError: The algorithm is not available.
+    """
+    hasher = _hasher(algorithm)
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def write_manifest(filepath: Union[str, Path],
+                   algorithm: str = DEFAULT_ALGORITHM
+                   ) -> Path:
+    """
+    Write the manifest of a file, with its size and digest, atomically.
+
+    Args:
+        filepath: Path to the file.
+        algorithm: Hash algorithm, see `file_digest`.
+
+    Returns:
+        The path to the manifest.
+    """
+    filepath = Path(filepath)
+    manifest = {'name': filepath.name,
+                'size': filepath.stat().st_size,
+                'algorithm': algorithm,
+                'digest': file_digest(filepath, algorithm),
+                }
+
+    path = manifest_path(filepath)
+    tmp_path = path.with_name(f'{path.name}.tmp{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def read_manifest(filepath: Union[str, Path]) -> Optional[dict]:
+    """
+    Read the manifest of a file.
+
+    Args:
+        filepath: Path to the file (not the manifest).
+
+    Returns:
+        The manifest, or None if it does not exist.
+    """
+    try:
+        with open(manifest_path(filepath)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def verify_manifest(filepath: Union[str, Path],
+                    manifest: Optional[dict] = None
+                    ) -> bool:
+    """
+    Check a file against its manifest.
+
+    Args:
+        filepath: Path to the file.
+        manifest: The manifest. If None, it is read.
+
+    Returns:
+        True if the size and digest of the file match the manifest.
+
+    Raises:
+        ManifestError: There is no manifest, or its hash algorithm is not
+            available.
+    """
+    filepath = Path(filepath)
+    if manifest is None:
+        manifest = read_manifest(filepath)
+        if manifest is None:
+            raise ManifestError(f"No manifest for {filepath}")
+
+    size = filepath.stat().st_size
+    if size != manifest['size']:
+        logger.warning(f"{filepath} is {size} bytes, but its manifest says "
+                       f"{manifest['size']}"
+                       )
+        return False
+
+    digest = file_digest(filepath, manifest['algorithm'])
+    if digest != manifest['digest']:
+        logger.warning(f"{manifest['algorithm']} digest of {filepath} does "
+                       f"not match its manifest"
+                       )
+        return False
+
+    return True
+
+
+def wait_for_manifest(filepath: Union[str, Path],
+                      max_wait: Union[int, float] = 5,
+                      poll_time: Union[int, float] = 0.1
+                      ) -> Optional[dict]:
+    """
+    Wait for the manifest of a file to appear. The pusher writes it once the
+    file is complete, so the file can be used as soon as it appears.
+
+    Args:
+        filepath: Path to the file.
+        max_wait: Maximum time to wait for the manifest.
+        poll_time: Time to wait between checks.
+
+    Returns:
+        The manifest, or None if it did not appear in time.
+    """
+    deadline = time.monotonic() + max_wait
+    while True:
+        manifest = read_manifest(filepath)
+        if manifest is not None:
+            return manifest
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(poll_time)
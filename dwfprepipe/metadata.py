@@ -0,0 +1,245 @@
+import logging
+
+from pathlib import Path
+from typing import (Union, List, Optional, Dict, Tuple, NamedTuple,
+                    TYPE_CHECKING)
+from dwfprepipe.utils import append_jsonl, read_jsonl
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+
+class ExposureMetadata(NamedTuple):
+    """
+    Metadata of a single DECam CCD frame, as read from its primary header.
+    """
+    expnum: int
+    field: str
+    filter: str
+    obstype: str
+    ccdnum: Optional[int] = None
+    date_obs: Optional[str] = None
+
+    @property
+    def band(self) -> str:
+        """
+        Single character band name used in the file naming scheme.
+        """
+        return self.filter[0]
+
+    @property
+    def is_flat(self) -> bool:
+        return self.obstype in ('dome flat', 'domeflat')
+
+    @property
+    def is_bias(self) -> bool:
+        return self.obstype in ('zero', 'bias')
+
+    @property
+    def is_calibration(self) -> bool:
+        return self.is_flat or self.is_bias
+
+
+def _parse_card_value(value: str) -> Union[str, bool, int, float, None]:
+    """
+    Parse the value of a FITS header card, dropping any comment.
+    """
+    value = value.strip()
+    if value.startswith("'"):
+        # Quotes inside strings are escaped by doubling them
+        end = 1
+        while True:
+            end = value.find("'", end)
+            if end < 0 or value[end + 1:end + 2] != "'":
+                break
+            end += 2
+        return value[1:end].replace("''", "'").rstrip()
+
+    value = value.split('/')[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace('D', 'E'))
+    except ValueError:
+        return value
+
+
+def read_header(filepath: Union[str, Path]) -> Dict[str, object]:
+    """
+    Read the primary header of a FITS file into a dictionary, without
+    importing astropy.
+
+    Only the `KEYWORD = value` cards are kept, with long strings joined
+    from their CONTINUE cards as astropy does, so COMMENT and HISTORY cards
+    are dropped. This is enough for the metadata lookups and the WCS, and
+    keeps CCD jobs that stop after the metadata lookup (e.g. calibration
+    frames) from paying the astropy start-up cost.
+
+    Args:
+        filepath: Path to the FITS file.
+
+    Returns:
+        A dictionary of header values.
+    """
+
+    header = {}
+    # Keyword of the long string that the next CONTINUE card belongs to
+    continued = None
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise ValueError(f"{filepath} has no complete FITS header")
+            block = block.decode('ascii', errors='replace')
+            for start in range(0, FITS_BLOCK, FITS_CARD):
+                card = block[start:start + FITS_CARD]
+                keyword = card[:8].strip()
+                if keyword == 'END':
+                    return header
+
+                if keyword == 'CONTINUE' and continued is not None:
+                    value = _parse_card_value(card[8:])
+                    if isinstance(value, str):
+                        header[continued] = header[continued][:-1] + value
+                        if value.endswith('&'):
+                            continue
+                    continued = None
+                    continue
+                continued = None
+
+                if card[8:10] == '= ' and keyword not in header:
+                    value = _parse_card_value(card[10:])
+                    header[keyword] = value
+                    if isinstance(value, str) and value.endswith('&'):
+                        continued = keyword
+
+
+def metadata_from_header(
+    header: Union['fits.Header', Dict[str, object]]
+) -> ExposureMetadata:
+    """
+    Extract the exposure metadata from an already parsed FITS header.
+
+    Args:
+        header: Primary header of the frame, either as an astropy header or
+            as a dictionary from `read_header`.
+
+    Returns:
+        The exposure metadata.
+    """
+    ccdnum = header.get('CCDNUM')
+
+    return ExposureMetadata(expnum=int(header['EXPNUM']),
+                            field=str(header['OBJECT']),
+                            filter=str(header['FILTER']),
+                            obstype=str(header['OBSTYPE']),
+                            ccdnum=None if ccdnum is None else int(ccdnum),
+                            date_obs=header.get('DATE-OBS'),
+                            )
+
+
+def read_metadata(filepath: Union[str, Path]) -> ExposureMetadata:
+    """
+    Read the exposure metadata of a frame, opening and parsing the primary
+    header only once.
+
+    Args:
+        filepath: Path to the FITS file.
+
+    Returns:
+        The exposure metadata.
+    """
+
+    return metadata_from_header(read_header(filepath))
+
+
+class ExposureIndex:
+    def __init__(self, path: Union[str, Path]):
+        """
+        Constructor method.
+
+        The index is an append-only JSON-lines file, so that every CCD job
+        of a night can add to it concurrently. If a frame is added more than
+        once, the most recent entry is used.
+
+        Args:
+            path: Path to the index file.
+
+        Returns:
+            None
+        """
+
+        self.logger = logging.getLogger('dwf_prepipe.metadata.ExposureIndex')
+
+        self.path = Path(path)
+
+    def add(self,
+            metadata: ExposureMetadata,
+            filepath: Union[str, Path]
+            ):
+        """
+        Add a frame to the index.
+
+        Args:
+            metadata: Metadata of the frame.
+            filepath: Path to the frame.
+
+        Returns:
+            None
+        """
+
+        record = metadata._asdict()
+        record['filepath'] = str(filepath)
+
+        self.logger.debug(f"Adding {filepath} to {self.path}")
+        append_jsonl(self.path, record)
+
+    def load(self) -> Dict[Tuple[int, Optional[int]], dict]:
+        """
+        Load the index.
+
+        Args:
+            None
+
+        Returns:
+            A dictionary of records keyed by (expnum, ccdnum).
+        """
+
+        records = {}
+        for record in read_jsonl(self.path):
+            records[(record['expnum'], record['ccdnum'])] = record
+
+        return records
+
+    def query(self, **criteria) -> List[dict]:
+        """
+        Find all frames matching the given metadata values.
+
+        Args:
+            **criteria: Metadata values to match, e.g. `field='Prime'` or
+                `obstype='object'`.
+
+        Returns:
+            Matching records, sorted by exposure number and CCD.
+        """
+
+        matches = [record for record in self.load().values()
+                   if all(record.get(key) == value
+                          for key, value in criteria.items()
+                          )
+                   ]
+
+        return sorted(matches,
+                      key=lambda r: (r['expnum'], r['ccdnum'] or 0)
+                      )
@@ -0,0 +1,162 @@
+import time
+import queue
+import logging
+import threading
+
+from typing import Callable, List, Tuple, Iterable
+
+_STOP = object()
+
+
+class StagedPipeline:
+    def __init__(self,
+                 stages: List[Tuple[str, Callable, int]],
+                 maxsize: int = 2
+                 ):
+        """
+        Constructor method.
+
+        Items flow through a chain of stages that run concurrently in
+        threads, connected by bounded queues, so that e.g. one item can be
+        calibrated in Python while the previous one is in SExtractor and
+        the one before that is in SCAMP. The stages are expected to spend
+        most of their time in code that releases the GIL, such as NumPy or
+        external programs.
+
+        Args:
+            stages: The name, function and number of worker threads of each
+                stage. Each function is called with the output of the
+                previous stage (or an input item, for the first stage), and
+                returns the input of the next stage.
+            maxsize: Maximum number of items waiting between two stages.
+
+        Returns:
+            None
+        """
+
+        self.logger = logging.getLogger('dwf_prepipe.pipeline.StagedPipeline')
+
+        self.stages = stages
+        self.maxsize = maxsize
+
+        self.stats = {}
+        self.errors = []
+        self._lock = threading.Lock()
+        self._finished = {}
+
+    def _worker(self,
+                name: str,
+                func: Callable,
+                in_queue: queue.Queue,
+                out_queue: queue.Queue,
+                n_workers: int,
+                n_next: int
+                ):
+        stats = self.stats[name]
+        while True:
+            wait_start = time.perf_counter()
+            item = in_queue.get()
+            run_start = time.perf_counter()
+
+            if item is _STOP:
+                with self._lock:
+                    stats['idle'] += run_start - wait_start
+                    self._finished[name] += 1
+                    last = self._finished[name] == n_workers
+                # The last worker of the stage stops the next one
+                if last:
+                    for i in range(n_next):
+                        out_queue.put(_STOP)
+                return
+
+            try:
+                result = func(item)
+                error = None
+            except Exception as e:
+                self.logger.exception(f"Stage {name} failed for {item}")
+                error = str(e)
+            run_end = time.perf_counter()
+
+            if error is None:
+                out_queue.put(result)
+            put_end = time.perf_counter()
+
+            with self._lock:
+                stats['items'] += 1
+                stats['idle'] += run_start - wait_start
+                stats['busy'] += run_end - run_start
+                stats['blocked'] += put_end - run_end
+                if error is not None:
+                    self.errors.append((name, item, error))
+
+    def run(self, items: Iterable) -> list:
+        """
+        Run all items through the pipeline.
+
+        Items that fail in a stage are logged, recorded in `errors` and
+        dropped from the pipeline.
+
+        Args:
+            items: Input items of the first stage.
+
+        Returns:
+            The outputs of the last stage, in the order they finished.
+        """
+
+        self.stats = {name: {'workers': n_workers,
+                             'items': 0,
+                             'busy': 0.0,
+                             'idle': 0.0,
+                             'blocked': 0.0,
+                             }
+                      for name, func, n_workers in self.stages
+                      }
+        self.errors = []
+        self._finished = {name: 0 for name, func, n_workers in self.stages}
+
+        queues = [queue.Queue(self.maxsize) for stage in self.stages]
+        results = queue.Queue()
+        queues.append(results)
+
+        threads = []
+        for i, (name, func, n_workers) in enumerate(self.stages):
+            n_next = 1
+            if i + 1 < len(self.stages):
+                n_next = self.stages[i + 1][2]
+            for j in range(n_workers):
+                thread = threading.Thread(target=self._worker,
+                                          args=(name,
+                                                func,
+                                                queues[i],
+                                                queues[i + 1],
+                                                n_workers,
+                                                n_next
+                                                ),
+                                          name=f'{name}-{j}',
+                                          daemon=True
+                                          )
+                thread.start()
+                threads.append(thread)
+
+        start = time.perf_counter()
+        for item in items:
+            queues[0].put(item)
+        for i in range(self.stages[0][2]):
+            queues[0].put(_STOP)
+
+        outputs = []
+        while True:
+            output = results.get()
+            if output is _STOP:
+                break
+            outputs.append(output)
+
+        for thread in threads:
+            thread.join()
+
+        wall_time = time.perf_counter() - start
+        for stats in self.stats.values():
+            stats['utilisation'] = stats['busy'] / \
+                (stats['workers'] * wall_time)
+
+        return outputs
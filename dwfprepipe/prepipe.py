@@ -1,6 +1,7 @@
 import re
 import time
 import math
+import tarfile
 import subprocess
 import importlib.resources
 import logging
@@ -8,6 +9,11 @@ import logging
 from pathlib import Path
 from typing import Union, List, Optional
 from dwfprepipe.utils import wait_for_file
+from dwfprepipe.manifest import (ManifestError,
+                                 wait_for_manifest,
+                                 verify_manifest
+                                 )
+from dwfprepipe.trace import get_trace_id, get_trace_log
 
 from timeit import default_timer as timer
 
@@ -26,6 +32,10 @@ class Prepipe:
                  run_date: str,
                  res_name: Optional[str] = None,
                  dry_run: bool = False,
+                 trace_log: Optional[Union[str, Path]] = None,
+                 exposure_astrometry: bool = False,
+                 output_profile: str = 'full',
+                 tar_index: bool = False,
                  ):
         """
         Constructor method.
@@ -37,6 +47,17 @@ class Prepipe:
             run_date: UT date of the run in the form `utYYMMDD`.
             res_name: Name of the ozstar reservation, defaults to None.
             dry_run: If `True`, writes sbatch files but does not submit them.
+            trace_log: Path to the latency trace log. If None, defaults to
+                the PREPIPE_TRACE_LOG environment variable, and tracing is
+                disabled if that is not set either.
+            exposure_astrometry: If `True`, the CCD jobs only run SExtractor,
+                and a single job that depends on them solves the astrometry
+                of all CCDs of the exposure together.
+            output_profile: Name of the output profile of the CCD jobs, see
+                `dwfprepipe.products.OUTPUT_PROFILES`.
+            tar_index: If `True`, tarballs are indexed instead of unpacked,
+                and each CCD job reads its .jp2 file straight from the
+                tarball.
 
         Returns:
             None
@@ -52,7 +73,11 @@ class Prepipe:
         self.path_to_sbatch = Path(path_to_sbatch)
         self.run_date = run_date
         self.dry_run = dry_run
+        self.exposure_astrometry = exposure_astrometry
+        self.output_profile = output_profile
+        self.tar_index = tar_index
         self.sbatch_out_dir = self.path_to_sbatch / 'out'
+        self.trace = get_trace_log(trace_log)
 
         self.set_sbatch_vars(res_name)
 
@@ -66,6 +91,14 @@ class Prepipe:
         self.logger.debug(f"Running with path_to_untar={self.path_to_untar}")
         self.logger.debug(f"Running with path_to_sbatch={self.path_to_sbatch}")
         self.logger.debug(f"Running with run_date={self.run_date}")
+        self.logger.debug(f"Running with trace_log={self.trace.path}")
+        self.logger.debug(f"Running with "
+                          f"exposure_astrometry={self.exposure_astrometry}"
+                          )
+        self.logger.debug(f"Running with "
+                          f"output_profile={self.output_profile}"
+                          )
+        self.logger.debug(f"Running with tar_index={self.tar_index}")
 
     def _validate_settings(self):
         """
@@ -188,7 +221,10 @@ class Prepipe:
 
         file_name = Path(file_name)
 
-        unpacked = self.unpack(file_name)
+        if self.tar_index:
+            unpacked = self.index(file_name)
+        else:
+            unpacked = self.unpack(file_name)
         if not unpacked:
             return
 
@@ -196,9 +232,15 @@ class Prepipe:
         n_scripts = math.ceil(len(ccdlist) / n_per_ccd)
         self.logger.info(f'Writing {n_scripts} sbatch scripts for {file_name}')
 
+        job_ids = []
         for script_num in range(n_scripts):
             ccds = ccdlist[n_per_ccd * script_num:(script_num + 1) * n_per_ccd]
-            self.sbatchccds(file_name, script_num, ccds)
+            job_id = self.sbatchccds(file_name, script_num, ccds)
+            if job_id is not None:
+                job_ids.append(job_id)
+
+        if self.exposure_astrometry:
+            self.sbatch_astrometry(file_name, job_ids)
 
     def unpack(self,
                file_name: Union[Path, str]
@@ -222,7 +264,11 @@ class Prepipe:
                                str(self.path_to_untar)
                                ]
             self.logger.debug(f"Running {' '.join(subprocess_call)}")
-            subprocess.check_call(subprocess_call)
+            with self.trace.span(get_trace_id(file_name),
+                                 'prepipe.unpack',
+                                 night=self.run_date
+                                 ):
+                subprocess.check_call(subprocess_call)
 
         except subprocess.CalledProcessError:
             self.logger.critical(f"FAILED UN-TAR {file_name}. Skipping...")
@@ -230,10 +276,41 @@ class Prepipe:
 
         return True
 
+    def index(self,
+              file_name: Union[Path, str]
+              ):
+        """
+        Index the members of a new file, so that the CCD jobs can read them
+        without it being unpacked.
+
+        Args:
+            file_name: File to index
+
+        Returns:
+            bool
+        """
+        from dwfprepipe.tarindex import write_tar_index
+
+        self.logger.info(f'Indexing: {file_name}')
+        try:
+            with self.trace.span(get_trace_id(file_name),
+                                 'prepipe.index',
+                                 night=self.run_date
+                                 ):
+                index = write_tar_index(self.path_to_watch / file_name)
+        except (tarfile.TarError, OSError):
+            self.logger.critical(f"FAILED INDEX {file_name}. Skipping...")
+            return False
+
+        self.logger.debug(f"Indexed {len(index)} members of {file_name}")
+
+        return True
+
     def _write_sbatch(self,
                       sbatch_name: Union[str, Path],
                       qroot: str,
-                      jobs_str: str
+                      jobs_str: str,
+                      dependency_str: str = ''
                       ):
         """
         Write a single Qsub script.
@@ -242,6 +319,7 @@ class Prepipe:
             sbatch_name: Path to write the sbatch file to.
             qroot: Qsub root name.
             jobs_str: String containing the jobs to run, one per line.
+            dependency_str: sbatch dependency directive, defaults to none.
 
         Returns:
             None
@@ -263,6 +341,7 @@ class Prepipe:
                                           tmp=self.tmp,
                                           ozstar_proj=self.ozstar_proj,
                                           res_str=self.res_str,
+                                          dependency_str=dependency_str,
                                           jobs_str=jobs_str
                                           )
 
@@ -284,7 +363,7 @@ class Prepipe:
             ccds: CCDs to be processed in this sbatch file.
 
         Returns:
-            None
+            The job id, or None if the script was not submitted.
         """
 
         DECam_root = file_name.stem
@@ -297,30 +376,161 @@ class Prepipe:
         self.logger.info(f"Creating Script: {sbatch_name} "
                          f"for CCDs {min(ccds)} to {max(ccds)}"
                          )
+        # Process all CCDs in a single process with an internal worker pool,
+        # so the interpreter start-up and imports are only paid once
         with importlib.resources.path(
             "dwfprepipe.bin", "prepipe_process_ccd.py"
         ) as process_ccd_script:
-            jobs_str_temp = f'{process_ccd_script} ' \
-                            f'-i {{0}} ' \
-                            f'-d {self.run_date} ' \
-                            f'-p {self.path_to_watch} ' \
-                            f'-l --local-dir {self.path_to_untar} ' \
-                            '&\n'
-
-        jobs_str = ''
-        for image in image_list:
-            jobs_str += jobs_str_temp.format(image)
+            jobs_str = f'{process_ccd_script} ' \
+                       f'-i {" ".join(image_list)} ' \
+                       f'-n {min(self.ppn, len(image_list))} ' \
+                       f'-d {self.run_date} ' \
+                       f'-p {self.path_to_watch} '
+        if self.tar_index:
+            # The .jp2 files are extracted into the node local scratch
+            # requested with --tmp, so the shared untar directory is unused
+            jobs_str += f'--tar-file {self.path_to_watch / file_name} '
+        else:
+            jobs_str += f'-l --local-dir {self.path_to_untar} '
+        if self.trace.enabled:
+            jobs_str += f'--trace-log {self.trace.path} '
+        if self.exposure_astrometry:
+            jobs_str += '--exposure-astrometry '
+        if self.output_profile != 'full':
+            jobs_str += f'--output-profile {self.output_profile} '
+        jobs_str += '\n'
 
         self._write_sbatch(sbatch_name, qroot, jobs_str)
 
+        job_id = self._submit_sbatch(sbatch_name)
+        if job_id is not None:
+            self.trace.event(get_trace_id(file_name),
+                             'prepipe.submit',
+                             'submitted',
+                             night=self.run_date,
+                             ccds=[int(ccd) for ccd in ccds]
+                             )
+
+        return job_id
+
+    def sbatch_astrometry(self,
+                          file_name: Path,
+                          job_ids: List[str]
+                          ):
+        """
+        Write and submit the Qsub script that solves the astrometry of all
+        CCDs of an exposure together, once all of its CCD jobs have
+        finished.
+
+        Args:
+            file_name: Path to file to be processed.
+            job_ids: Ids of the CCD jobs of the exposure.
+
+        Returns:
+            The job id, or None if the script was not submitted.
+        """
+
+        DECam_root = file_name.stem
+        qroot = f'{DECam_root}_astrometry'
+        expnum = int(get_trace_id(file_name).split('_')[1])
+
+        sbatch_name = self.path_to_sbatch / f'{qroot}.sbatch'
+
+        self.logger.info(f"Creating Script: {sbatch_name} for exposure "
+                         f"{expnum}"
+                         )
+        with importlib.resources.path(
+            "dwfprepipe.bin", "prepipe_astrometry.py"
+        ) as astrometry_script:
+            jobs_str = f'{astrometry_script} ' \
+                       f'-d {self.run_date} ' \
+                       f'-e {expnum} '
+        if self.trace.enabled:
+            jobs_str += f'--trace-log {self.trace.path} '
+        jobs_str += '\n'
+
+        # Run once all CCD jobs have finished, even if some of them failed
+        dependency_str = ''
+        if job_ids:
+            dependency_str = f'#SBATCH --dependency=afterany:' \
+                             f'{":".join(job_ids)}'
+
+        self._write_sbatch(sbatch_name, qroot, jobs_str, dependency_str)
+
+        return self._submit_sbatch(sbatch_name)
+
+    def _submit_sbatch(self,
+                       sbatch_name: Path
+                       ) -> Optional[str]:
+        """
+        Submit a Qsub script to the queue.
+
+        Args:
+            sbatch_name: Path to the sbatch file.
+
+        Returns:
+            The job id, or None if the script was not submitted.
+        """
+
         if self.dry_run:
             self.logger.info("Dry run selected, not submitting sbatch jobs")
-        else:
-            if sbatch_name.is_file():
-                self.logger.debug(f"Running {sbatch_name}")
-                subprocess.run(['sbatch', str(sbatch_name)])
-            else:
-                logger.critical(f"{sbatch_name} does not exist!")
+            return None
+
+        if not sbatch_name.is_file():
+            self.logger.critical(f"{sbatch_name} does not exist!")
+            return None
+
+        self.logger.debug(f"Running {sbatch_name}")
+        result = subprocess.run(['sbatch', '--parsable', str(sbatch_name)],
+                                stdout=subprocess.PIPE,
+                                universal_newlines=True
+                                )
+        if result.returncode != 0:
+            self.logger.critical(f"Submitting {sbatch_name} failed!")
+            return None
+
+        # The output is `<job id>[;<cluster>]`
+        return result.stdout.strip().split(';')[0]
+
+    def wait_for_transfer(self,
+                          file_path: Union[str, Path],
+                          manifest_wait: float = 5
+                          ) -> bool:
+        """
+        Wait for a new file to be completely transferred.
+
+        The pusher moves the manifest of a tarball into place after the
+        tarball itself, so the tarball is complete as soon as its manifest
+        appears, and is then checked against it. If there is no manifest
+        (e.g. from an older pusher), fall back to waiting for the size of
+        the file to stop changing.
+
+        Args:
+            file_path: Path to the file.
+            manifest_wait: Number of seconds to wait for the manifest.
+
+        Returns:
+            bool
+        """
+        manifest = wait_for_manifest(file_path, max_wait=manifest_wait)
+        if manifest is None:
+            self.logger.warning(f"No manifest for {file_path}. Waiting for "
+                                f"its size to settle instead."
+                                )
+            return wait_for_file(file_path)
+
+        try:
+            verified = verify_manifest(file_path, manifest)
+        except ManifestError as e:
+            self.logger.warning(f"{e}. Waiting for the size of {file_path} "
+                                f"to settle instead."
+                                )
+            return wait_for_file(file_path)
+
+        if not verified:
+            self.logger.critical(f"{file_path} does not match its manifest!")
+
+        return verified
 
     def listen(self, warning_time=60):
         """
@@ -356,8 +566,21 @@ class Prepipe:
                 self.logger.info(f"Removed: {removed_str}")
 
             for i, f in enumerate(added):
-                if not wait_for_file(f):
-                    self.logger.info(f'{f} not written in time! Skipping...')
+                trace_id = get_trace_id(f)
+                self.trace.event(trace_id,
+                                 'prepipe',
+                                 'detected',
+                                 night=self.run_date
+                                 )
+                with self.trace.span(trace_id,
+                                     'prepipe.wait',
+                                     night=self.run_date
+                                     ):
+                    written = self.wait_for_transfer(f)
+                if not written:
+                    self.logger.info(f'{f} not transferred correctly! '
+                                     f'Skipping...'
+                                     )
                     continue
 
                 self.process_file(f)
@@ -0,0 +1,135 @@
+import logging
+
+from pathlib import Path
+from typing import Union, Optional, NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+    from astropy.io import fits
+
+logger = logging.getLogger('dwf_prepipe.products')
+
+
+class OutputProfile(NamedTuple):
+    """
+    Which products are written for each calibrated CCD, and how.
+    """
+    # Write the SExtractor .noise.fits check image
+    check_images: bool = True
+    # Tile compression of the mask (e.g. `RICE_1` or `GZIP_2`), or None
+    mask_compression: Optional[str] = None
+    # Append the mask to the science frame instead of writing its own file
+    mef: bool = False
+
+
+OUTPUT_PROFILES = {
+    # Everything, uncompressed, as the pipeline has always written it
+    'full': OutputProfile(),
+    # No check image, and a RICE compressed mask file
+    'compact': OutputProfile(check_images=False, mask_compression='RICE_1'),
+    # No check image, and the RICE compressed mask in the science frame
+    'mef': OutputProfile(check_images=False,
+                         mask_compression='RICE_1',
+                         mef=True
+                         ),
+}
+
+MASK_EXTNAME = 'MASK'
+
+
+def get_output_profile(name: str) -> OutputProfile:
+    """
+    Get an output profile by name.
+
+    Args:
+        name: One of the names in `OUTPUT_PROFILES`.
+
+    Returns:
+        The output profile.
+
+    Raises:
+        ValueError: The profile does not exist.
+    """
+    if name not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile {name}. Should be one of "
+                         f"{', '.join(OUTPUT_PROFILES)}."
+                         )
+
+    return OUTPUT_PROFILES[name]
+
+
+def mask_path(frame: Union[str, Path], profile: OutputProfile) -> str:
+    """
+    Path of the mask file of a science frame. Compressed masks have the
+    `.fz` suffix used by fpack.
+    """
+    mskname = str(frame).replace('.fits', '.mask.fits').replace('.fz', '')
+    if profile.mask_compression is not None:
+        mskname += '.fz'
+
+    return mskname
+
+
+def mask_hdu(mask: 'np.ndarray',
+             header: 'fits.Header',
+             compression: Optional[str] = None,
+             primary: bool = True
+             ):
+    """
+    Build the HDU of a mask.
+
+    Args:
+        mask: The mask.
+        header: Header of the science frame.
+        compression: Tile compression type, or None for no compression.
+        primary: Whether an uncompressed mask is the primary HDU.
+            Compressed masks are always an extension.
+
+    Returns:
+        The HDU.
+    """
+    from astropy.io import fits
+
+    if compression is not None:
+        hdu = fits.CompImageHDU(mask,
+                                header=header,
+                                compression_type=compression
+                                )
+    elif primary:
+        hdu = fits.PrimaryHDU(mask, header=header)
+    else:
+        hdu = fits.ImageHDU(mask, header=header)
+
+    if not primary or compression is not None:
+        hdu.header['EXTNAME'] = MASK_EXTNAME
+
+    return hdu
+
+
+def append_mask(frame: Union[str, Path],
+                mask: 'np.ndarray',
+                header: 'fits.Header',
+                compression: Optional[str] = None
+                ):
+    """
+    Append a mask extension to a science frame. Only the new extension is
+    written, so the frame itself is not rewritten.
+
+    This must happen after source extraction, as SExtractor would otherwise
+    extract the mask too.
+
+    Args:
+        frame: Path to the science frame.
+        mask: The mask.
+        header: Header of the science frame.
+        compression: Tile compression type, or None for no compression.
+
+    Returns:
+        None
+    """
+    from astropy.io import fits
+
+    with fits.open(frame, mode='append') as hdul:
+        hdul.append(mask_hdu(mask, header, compression, primary=False))
+
+    logger.debug(f"Appended the mask to {frame}")
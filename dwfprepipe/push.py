@@ -1,13 +1,12 @@
-import time
-import glob
-import subprocess
+import shutil
+import asyncio
 import logging
-import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
 
 from pathlib import Path
-from typing import Union
-from dwfprepipe.utils import wait_for_file
+from typing import Union, Optional, Dict, List
+from dwfprepipe.manifest import manifest_path, write_manifest
+from dwfprepipe.pushengine import PushEngine, CommandError
+from dwfprepipe.trace import get_trace_id, get_trace_log
 
 
 class CTIOPushInitError(Exception):
@@ -22,7 +21,10 @@ class CTIOPush:
                  path_to_watch: Union[str, Path],
                  Qs: float,
                  push_method: str,
-                 nbundle: int
+                 nbundle: int,
+                 trace_log: Optional[Union[str, Path]] = None,
+                 stage_limits: Optional[Dict[str, int]] = None,
+                 timeouts: Optional[Dict[str, Optional[float]]] = None
                  ):
         """
         Constructor method.
@@ -33,6 +35,13 @@ class CTIOPush:
             push_method: Method to push data with.
             nbundle: Number of files to bundle together. Only relevant if
                 `push_method` is set to `bundle`.
+            trace_log: Path to the latency trace log. If None, defaults to
+                the PREPIPE_TRACE_LOG environment variable, and tracing is
+                disabled if that is not set either.
+            stage_limits: Number of unpack, compress, package and transfer
+                commands that can run at once, see `PushEngine`.
+            timeouts: Seconds after which an unpack, compress, package or
+                transfer command is killed, see `PushEngine`.
 
         Returns:
             None
@@ -60,6 +69,10 @@ class CTIOPush:
 
         self.jp2_dir = self.path_to_watch / 'jp2'
 
+        self.trace = get_trace_log(trace_log)
+
+        self.engine = PushEngine(stage_limits, timeouts)
+
         self.set_ssh_config()
 
         valid_settings = self._validate_settings()
@@ -74,6 +87,11 @@ class CTIOPush:
         self.logger.debug(f"Running with Qs={self.Qs}")
         self.logger.debug(f"Running with nbundle={self.nbundle}")
         self.logger.debug(f"Running with jp2_dir={self.jp2_dir}")
+        self.logger.debug(f"Running with trace_log={self.trace.path}")
+        self.logger.debug(f"Running with "
+                          f"stage_limits={self.engine.stage_limits}"
+                          )
+        self.logger.debug(f"Running with timeouts={self.engine.timeouts}")
 
     def _validate_settings(self):
         """
@@ -154,118 +172,221 @@ class CTIOPush:
         self.logger.debug(f"Setting target_dir to {target_dir}")
         self.target_dir = Path(target_dir)
 
-    # Package new raw .fits.fz file
-    def packagefile(self, filepath: Union[str, Path]):
+    @staticmethod
+    def exposure_name(filepath: Union[str, Path]) -> str:
+        """
+        Get the name of the exposure of a file, without its directory or
+        extensions, e.g. `DECam_00123456` for `DECam_00123456.fits.fz`.
+        """
+        return Path(filepath).name.split('.')[0]
+
+    async def package(self, filepath: Union[str, Path]) -> Path:
         """
-        Package a file ready for shipping.
+        Unpack a raw .fits.fz file, compress it to .jp2 files and package
+        them in a tarball ready for shipping, with its manifest.
 
         Args:
             filepath: Path to the file to be packaged.
 
-        Returns
-            None
-        """
+        Returns:
+            The path to the tarball.
 
+        Raises:
+            CommandError: A command failed or timed out.
+        """
         filepath = Path(filepath)
-        file_name = filepath.name
-
-        self.logger.info(f'Unpacking: {file_name}')
+        name = self.exposure_name(filepath)
+
+        trace_id = get_trace_id(filepath)
+        with self.trace.span(trace_id, 'push.package'):
+            self.logger.info(f'Unpacking: {filepath.name}')
+            await self.engine.run('unpack', ['funpack', filepath])
+
+            jp2_dest = self.jp2_dir / name
+            if not jp2_dest.is_dir():
+                self.logger.info(f'Creating Directory: {jp2_dest}')
+                jp2_dest.mkdir()
+
+            self.logger.info(f'Compressing: {name}')
+            await self.engine.run('compress',
+                                  ['f2j_DECam',
+                                   '-i',
+                                   filepath.with_name(f'{name}.fits'),
+                                   '-o',
+                                   jp2_dest / f'{name}.jp2',
+                                   f'Qstep={self.Qs}',
+                                   '-num_threads',
+                                   '1']
+                                  )
+
+            packaged_file = self.jp2_dir / f'{name}.tar'
+            self.logger.info(f'Packaging: {packaged_file}')
+            await self.engine.run('package',
+                                  ['tar',
+                                   '-cf',
+                                   packaged_file,
+                                   '-C',
+                                   jp2_dest,
+                                   '.']
+                                  )
+
+            # The receiver treats the tarball as complete once this lands
+            await self.engine.run_blocking(write_manifest, packaged_file)
+
+        return packaged_file
+
+    async def transfer(self, tar_path: Union[str, Path]):
+        """
+        Push a tarball and its manifest to the destination, and remove them
+        locally once they have arrived.
 
-        fz_path = self.data_dir / file_name.with_suffix('.fits.fz')
+        Args:
+            tar_path: Path to the tarball.
 
-        subprocess.run(['funpack', str(fz_path)])
+        Returns:
+            None
 
-        jp2_dest = self.jp2_dir / file_name
-        if not jp2_dest.is_dir():
-            self.logger.info(f'Creating Directory: {jp2_dest}')
-            jp2_dest.mkdir()
+        Raises:
+            CommandError: A command failed or timed out.
+        """
+        tar_path = Path(tar_path)
+        tar_manifest = manifest_path(tar_path)
 
-        self.logger.info(f'Compressing: {file_name}')
-        fitsfile = file_name.with_suffix('.fits')
-        jp2file = file_name.with_suffix('.jp2')
+        trace_id = get_trace_id(tar_path)
+        self.trace.event(trace_id, 'push.transfer', 'start')
 
-        subprocess.run(['time',
-                        'f2j_DECam',
-                        '-i',
-                        str(self.data_dir / fitsfile),
-                        '-o',
-                        str(self.jp2_dir / jp2file),
-                        f'Qstep={self.Qs}',
-                        '-num_threads',
-                        '1']
-                       )
+        self.logger.info(f'Shipping: {tar_path}')
 
-        packaged_file = self.jp2_dir / file_name.with_suffix('.tar')
-        self.logger.info(f'Packaging: {packaged_file}')
-        subprocess.run(['tar',
-                        '-cf',
-                        str(packaged_file),
-                        '-C',
-                        str(jp2_path),
-                        '.']
-                       )
+        # Move the manifest into the target directory only after the
+        # tarball, so that the receiver never sees a manifest for a partial
+        # tarball
+        move_command = (f"mv {self.push_dir / tar_path.name} "
+                        f"{self.target_dir} && "
+                        f"mv {self.push_dir / tar_manifest.name} "
+                        f"{self.target_dir}"
+                        )
+
+        status = 'failed'
+        try:
+            await self.engine.run('transfer',
+                                  ['scp',
+                                   tar_path,
+                                   tar_manifest,
+                                   f'{self.reciever}:{self.push_dir}/']
+                                  )
+            await self.engine.run('transfer',
+                                  ['ssh', self.reciever, move_command]
+                                  )
+            status = 'ok'
+        finally:
+            self.trace.event(trace_id, 'push.transfer', 'end', status=status)
+
+        tar_path.unlink()
+        tar_manifest.unlink()
 
-    def pushfile(self, filepath: Union[str, Path], parallel: bool = False):
+    def cleantemp(self, filepath: Union[str, Path]):
         """
-        Push a file to the destination.
+        Remove the temporary unpacked .fits and .jp2 files of an exposure.
 
         Args:
-            filepath: Path to the file to be pushed.
-            parallel: If `True`, use parallel push, else use serial push.
+            filepath: Path of the raw .fits.fz file.
 
         Returns:
             None
         """
-
         filepath = Path(filepath)
+        name = self.exposure_name(filepath)
+
+        fits_path = filepath.with_name(f'{name}.fits')
+        if fits_path.is_file():
+            self.logger.info(f'Removing: {fits_path}')
+            fits_path.unlink()
+
+        jp2_dest = self.jp2_dir / name
+        if jp2_dest.is_dir():
+            self.logger.info(f'Cleaning: {jp2_dest}')
+            shutil.rmtree(jp2_dest)
+
+    async def push_exposure(self,
+                            filepath: Union[str, Path],
+                            wait: bool = True
+                            ) -> bool:
+        """
+        Package and push an exposure.
 
-        file_name = filepath.name
+        Args:
+            filepath: Path to the raw .fits.fz file.
+            wait: Wait for the file to finish being written first.
 
-        tar_path = self.jp2_dir / file_name.with_suffix('.tar')
+        Returns:
+            True if the exposure was pushed, otherwise False.
+        """
+        self.logger.info(f'Processing: {filepath}...')
 
-        self.logger.info(f'Shipping: {tar_path}')
+        if wait and not await self.engine.wait_for_file(filepath):
+            self.logger.info(f'{filepath} not written in time! Skipping...')
+            return False
 
-        command = (f"scp {tar_path} {self.reciever}:{self.push_dir}; "
-                   f"ssh {self.reciever} "
-                   f"'mv {self.push_dir / file_name}.tar {self.target_dir}'; "
-                   f"rm {tar_path}"
-                   )
+        try:
+            try:
+                tar_path = await self.package(filepath)
+            finally:
+                self.cleantemp(filepath)
+            await self.transfer(tar_path)
+        except CommandError as e:
+            self.logger.error(f"Pushing {filepath} failed: {e}")
+            return False
 
-        if parallel:
-            subprocess.Popen(command, shell=True)
-        else:
-            subprocess.run(command, shell=True)
+        return True
 
-    def cleantemp(self, filepath: Union[str, Path]):
+    async def serial_policy(self, filelist: List[Union[str, Path]]):
         """
-        Remove the temporary unpacked .fits; bundler .tar;
-        and individual .jp2 files.
+        Scheduling policy that pushes the newest file, and waits for it to
+        arrive before listening again.
 
         Args:
-            filepath: Path of the temp file to be cleaned.
+            filelist: New files.
 
         Returns:
             None
         """
+        await self.push_exposure(sorted(filelist)[-1])
+
+    async def parallel_policy(self, filelist: List[Union[str, Path]]):
+        """
+        Scheduling policy that pushes every file in the background, and
+        keeps listening.
 
-        file_name = filepath.name
+        Args:
+            filelist: New files.
 
-        fits_path = self.data_dir / file_name.with_suffix('.fits')
+        Returns:
+            None
+        """
+        for f in sorted(filelist):
+            self.engine.submit(self.push_exposure(f))
 
-        # remove funpacked .fits file
-        self.logger.info(f'Removing: {fits_path}')
-        fits_path.unlink()
+    async def bundle_policy(self, filelist: List[Union[str, Path]]):
+        """
+        Scheduling policy that pushes the newest `nbundle` files together,
+        and waits for them all to arrive before listening again.
 
-        # Remove .jp2 files
-        jp2_path = self.jp2_dir / file_name.with_suffix('.jp2')
-        self.logger.info(f'Cleaning: {self.jp2_dir}')
-        for jp2 in self.jp2_dir.iterdir():
-            if jp2.suffix == ".jp2":
-                jp2.unlink()
+        Args:
+            filelist: New files.
 
-    def process_endofnight(self, exp_min):
+        Returns:
+            None
         """
-        Run end-of-night processing.
+        bundle = [str(f) for f in sorted(filelist)[-1 * self.nbundle:]]
+
+        self.logger.info(f"Bundling: {', '.join(bundle)}...")
+
+        await asyncio.gather(*(self.push_exposure(f) for f in bundle))
+
+    async def endofnight_policy(self, exp_min: int):
+        """
+        Scheduling policy that pushes every exposure after `exp_min` that
+        is not at the destination yet.
 
         Args:
             exp_min: The first exposure number to process.
@@ -273,67 +394,85 @@ class CTIOPush:
         Returns:
             None
         """
-
         # Get list of files in remote target directory
         # & list of files in local directory
-        get_file_command = (f"ssh {self.user}@{self.host}"
-                            f"ls {self.target_dir}*.tar"
-                            )
-        remote_list = subprocess.getoutput(get_file_command)
-
-        sent_files = []
-        for filepath in remote_list.splitlines():
-            if filepath.endswith(".tar"):
-                file_name = Path(filepath).stem
-                sent_files.append(file_name)
-
-        obs_list = []
-        for f in self.data_dir.glob('*.fits.fz'):
-            obs = Path(f).stem
-            obs_list.append(obs)
-
-        obs_list.sort(reverse=True)
-        sent_files.sort(reverse=True)
-
-        missing = [f for f in obs_list if f not in sent_files]
+        remote_list = await self.engine.run('list',
+                                            ['ssh',
+                                             self.reciever,
+                                             f'ls {self.target_dir}'],
+                                            capture=True
+                                            )
+
+        sent_files = {self.exposure_name(f)
+                      for f in remote_list.splitlines()
+                      if f.endswith('.tar')
+                      }
+
+        obs_list = {self.exposure_name(f): f
+                    for f in self.path_to_watch.glob('*.fits.fz')
+                    }
+
+        missing = sorted((obs for obs in obs_list if obs not in sent_files),
+                         reverse=True
+                         )
         num_missing = len(missing)
         total_obs = len(obs_list)
-        perc = 100 * len(sent_files) / total_obs
+        perc = 100 * (total_obs - num_missing) / max(1, total_obs)
 
         self.logger.info('Starting end of night transfers...')
         self.logger.info(f'Missing {num_missing} of {total_obs} '
-                         f'files ({perc}% successful)'
+                         f'files ({perc:.1f}% successful)'
                          )
+
+        # Only needed for the end of night transfers
+        import tqdm
+        from tqdm.contrib.logging import logging_redirect_tqdm
+
+        pushes = [self.push_exposure(obs_list[obs], wait=False)
+                  for obs in missing
+                  if int(obs.split('_')[1]) > exp_min
+                  ]
+
         with logging_redirect_tqdm():
-            for i, f in tqdm.tqdm(enumerate(missing), total=num_missing):
-                exp_num = int(f.split('_')[1])
-                if exp_num > exp_min:
-                    self.logger.info(f'Processing: {f} ({i} of {num_missing})')
-                    self.packagefile(f)
-                    self.pushfile(f)
-                    self.cleantemp(f)
+            for push in tqdm.tqdm(asyncio.as_completed(pushes),
+                                  total=len(pushes)
+                                  ):
+                await push
 
-    def process_parallel(self, filelist: list):
+    async def _run_policy(self, policy, *args):
         """
-        Process a list of files in parallel.
+        Run a scheduling policy and wait for its background pushes. They
+        are cancelled, killing their commands, if it is interrupted.
+        """
+        try:
+            await policy(*args)
+            await self.engine.drain()
+        finally:
+            await self.engine.cancel()
+
+    def process_endofnight(self, exp_min: int):
+        """
+        Run end-of-night processing.
 
         Args:
-            filelist: List of files to process.
+            exp_min: The first exposure number to process.
 
         Returns:
             None
         """
+        asyncio.run(self._run_policy(self.endofnight_policy, exp_min))
 
-        for f in filelist:
-            self.logger.info(f'Processing: {f}...')
+    def process_parallel(self, filelist: list):
+        """
+        Process a list of files in parallel.
 
-            if not wait_for_file(f):
-                self.logger.info(f'{f} not written in time! Skipping...')
-                continue
+        Args:
+            filelist: List of files to process.
 
-            self.packagefile(f)
-            self.pushfile(f, parallel=True)
-            self.cleantemp(f)
+        Returns:
+            None
+        """
+        asyncio.run(self._run_policy(self.parallel_policy, filelist))
 
     def process_serial(self, filename: Union[str, Path]):
         """
@@ -345,16 +484,7 @@ class CTIOPush:
         Returns:
             None
         """
-
-        self.logger.info(f'Processing: {filename}...')
-
-        if not wait_for_file(f):
-            self.logger.info(f'{f} not written in time! Skipping...')
-            return
-
-        self.packagefile(filename)
-        self.pushfile(filename)
-        self.cleantemp(filename)
+        asyncio.run(self._run_policy(self.serial_policy, [filename]))
 
     def process_bundle(self, filelist: list):
         """
@@ -366,71 +496,53 @@ class CTIOPush:
         Returns:
             None
         """
-        sorted_filelist = sorted(filelist)
-
-        if len(sorted_filelist) > self.nbundle:
-            bundle = sorted_filelist[-1 * self.nbundle:]
-        else:
-            bundle = sorted_filelist
-
-        self.logger.info(f"Bundling: {', '.join(bundle)}...")
-
-        bundle_size = len(bundle)
-
-        for i, f in enumerate(bundle):
-            self.logger.info(f'Processing: {f}...')
+        asyncio.run(self._run_policy(self.bundle_policy, filelist))
 
-            if not wait_for_file(f):
-                self.logger.info(f'{f} not written in time! Skipping...')
-                continue
-
-            self.packagefile(f)
-            # do all but the last scp in parallel;
-            # then force python to wait until the final transfer is complete
-            if i < bundlesize:
-                self.pushfile(f, parallel=True)
-            else:
-                self.pushfile(f)
-
-            self.cleantemp(f, self.path_to_watch)
-
-    def listen(self):
+    async def _listen(self, poll_time: float = 1):
         """
-        Listen for new images, process and push them.
-
-        Args:
-            None
-
-        Returns:
-            None
+        Watch for new images and hand them to the scheduling policy of the
+        push method.
         """
+        policies = {'serial': self.serial_policy,
+                    'parallel': self.parallel_policy,
+                    'bundle': self.bundle_policy,
+                    }
+        policy = policies[self.push_method]
 
         self.logger.info("Now running!")
         self.logger.info(f"Monitoring: {self.path_to_watch}")
 
-        glob_str = str(self.path_to_watch) + '*.fits.fz'
-
-        before = glob.glob(glob_str)
+        before = set(self.path_to_watch.glob('*.fits.fz'))
 
         while True:
-            after = glob.glob(glob_str)
-            added = [f for f in after if f not in before]
-            removed = [f for f in before if f not in after]
+            # Background pushes carry on while this waits
+            await asyncio.sleep(poll_time)
+
+            after = set(self.path_to_watch.glob('*.fits.fz'))
+            added = sorted(str(f) for f in after - before)
+            removed = sorted(str(f) for f in before - after)
 
             if added:
-                logger.info("Added: {}".format(', '.join(added)))
+                self.logger.info(f"Added: {', '.join(added)}")
+                for f in added:
+                    self.trace.event(get_trace_id(f), 'push', 'detected')
 
-                if self.method == 'parallel':
-                    self.process_parallel(added)
-                elif self.method == 'serial':
-                    self.process_serial(added[-1])
-                elif self.method == 'bundle':
-                    self.process_bundle(added)
+                await policy(added)
 
             if removed:
                 removed_str = ', '.join(removed)
-                logger.info(f"Removed: {removed_str}")
+                self.logger.info(f"Removed: {removed_str}")
 
             before = after
 
-            time.sleep(1)
+    def listen(self):
+        """
+        Listen for new images, process and push them.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        asyncio.run(self._run_policy(self._listen))
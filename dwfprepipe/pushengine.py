@@ -0,0 +1,234 @@
+import asyncio
+import logging
+
+from pathlib import Path
+from typing import Union, Optional, Dict, List, Set, Coroutine
+
+# Number of commands of each stage that can run at once. Stages that are not
+# listed run one at a time.
+DEFAULT_STAGE_LIMITS = {'unpack': 2,
+                        'compress': 2,
+                        'package': 2,
+                        'transfer': 2,
+                        }
+
+# Seconds after which a command of each stage is killed. Stages that are
+# not listed have no timeout.
+DEFAULT_TIMEOUTS = {'unpack': 300,
+                    'compress': 600,
+                    'package': 300,
+                    'transfer': 1200,
+                    'list': 120,
+                    }
+
+
+class CommandError(Exception):
+    """
+    A defined error for a command that failed or timed out.
+    """
+    pass
+
+
+class PushEngine:
+    def __init__(self,
+                 stage_limits: Optional[Dict[str, int]] = None,
+                 timeouts: Optional[Dict[str, Optional[float]]] = None
+                 ):
+        """
+        Constructor method.
+
+        Runs the commands of the push as asyncio subprocesses, so that the
+        watched directory, compressions and transfers can all be waited on
+        at once.
+
+        Args:
+            stage_limits: Number of commands of each stage that can run at
+                once, updating `DEFAULT_STAGE_LIMITS`.
+            timeouts: Seconds after which a command of each stage is
+                killed, updating `DEFAULT_TIMEOUTS`. None for no timeout.
+
+        Returns:
+            None
+        """
+        self.logger = logging.getLogger('dwf_prepipe.pushengine.PushEngine')
+
+        self.stage_limits = dict(DEFAULT_STAGE_LIMITS)
+        if stage_limits is not None:
+            self.stage_limits.update(stage_limits)
+
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+
+        # Semaphores and tasks belong to the event loop they were made in,
+        # so they are made again for each loop
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _check_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphores = {}
+            self._tasks = set()
+
+    def _semaphore(self, stage: str) -> asyncio.Semaphore:
+        self._check_loop()
+        if stage not in self._semaphores:
+            limit = self.stage_limits.get(stage, 1)
+            self._semaphores[stage] = asyncio.Semaphore(limit)
+
+        return self._semaphores[stage]
+
+    async def run(self,
+                  stage: str,
+                  args: List[Union[str, Path]],
+                  capture: bool = False
+                  ) -> Optional[str]:
+        """
+        Run a command, once there is a free slot for its stage.
+
+        Args:
+            stage: Stage the command belongs to.
+            args: The command and its arguments.
+            capture: Capture and return the output of the command.
+
+        Returns:
+            The output of the command if `capture` is True, otherwise None.
+
+        Raises:
+            CommandError: The command could not be started, failed or timed
+                out.
+        """
+        args = [str(arg) for arg in args]
+        timeout = self.timeouts.get(stage)
+
+        async with self._semaphore(stage):
+            self.logger.debug(f"Running {' '.join(args)}")
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdout=asyncio.subprocess.PIPE if capture else None
+                )
+            except OSError as e:
+                raise CommandError(f"Could not run {args[0]}: {e}")
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(),
+                                                   timeout
+                                                   )
+            except asyncio.TimeoutError:
+                await self._kill(proc)
+                raise CommandError(f"{args[0]} timed out after {timeout}s")
+            except asyncio.CancelledError:
+                await self._kill(proc)
+                raise
+
+        if proc.returncode != 0:
+            raise CommandError(f"{args[0]} failed with exit status "
+                               f"{proc.returncode}"
+                               )
+
+        if capture:
+            return stdout.decode()
+
+        return None
+
+    async def _kill(self, proc: asyncio.subprocess.Process):
+        """
+        Kill a process and wait for it to exit.
+        """
+        if proc.returncode is None:
+            self.logger.debug(f"Killing process {proc.pid}")
+            proc.kill()
+            await proc.wait()
+
+    async def run_blocking(self, func, *args):
+        """
+        Run a blocking function (e.g. hashing a file) in a thread, so that
+        it does not hold up the event loop.
+        """
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(None, func, *args)
+
+    def submit(self, coro: Coroutine) -> asyncio.Task:
+        """
+        Run a coroutine in the background. Its errors are logged.
+
+        Args:
+            coro: The coroutine.
+
+        Returns:
+            The task running it.
+        """
+        self._check_loop()
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self.logger.error("Background task failed",
+                              exc_info=(type(exc), exc, exc.__traceback__)
+                              )
+
+    async def drain(self):
+        """
+        Wait for all background tasks to finish.
+        """
+        self._check_loop()
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def cancel(self):
+        """
+        Cancel all background tasks, killing their commands.
+        """
+        self._check_loop()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def wait_for_file(self,
+                            filepath: Union[str, Path],
+                            wait_time: Union[int, float] = 3,
+                            max_wait: Union[int, float] = 120
+                            ) -> bool:
+        """
+        Wait for a file to finish being written, without blocking the
+        event loop. See `dwfprepipe.utils.wait_for_file`.
+
+        Args:
+            filepath: Path to the file of interest
+            wait_time: Time to wait between file size checks
+            max_wait: Maximum time to wait for the file to finish being
+                written.
+
+        Returns:
+            A bool that is True if the file has been written and False
+            otherwise.
+        """
+        filepath = Path(filepath)
+
+        waited_time = 0
+        fsize_old = filepath.stat().st_size
+
+        while True:
+            await asyncio.sleep(wait_time)
+            waited_time += wait_time
+
+            fsize_new = filepath.stat().st_size
+            if fsize_new == fsize_old:
+                return True
+            elif waited_time > max_wait:
+                return False
+
+            fsize_old = fsize_new
@@ -0,0 +1,337 @@
+import os
+import time
+import logging
+import subprocess
+
+import numpy as np
+
+from pathlib import Path
+from typing import Union, List, Optional, Dict, Tuple
+from dwfprepipe.utils import get_cache_dir
+
+SHIFT_DTYPE = [('expnum', 'i8'),
+               ('ccd', 'i4'),
+               ('rashift', 'f8'),
+               ('decshift', 'f8'),
+               ]
+
+
+def check_wcs(ut, ccd, expnum):
+    pipeloop_out = subprocess.check_output(['pipeview.pl',
+                                            '-red',
+                                            ut,
+                                            ccd,
+                                            '-stage',
+                                            'WCSNON',
+                                            '-id', str(expnum)
+                                            ],
+                                           stderr=subprocess.STDOUT,
+                                           universal_newlines=True)
+
+    wcs_val = pipeloop_out.splitlines()[9].strip(' \t\n\r').split(' ')[-1]
+    return (wcs_val == 'X')
+
+
+def parse_pipeview(pipeview_out: str, field: str) -> np.ndarray:
+    """
+    Parse the output of `pipeview.pl -stage WCSNON -wcs` into a table of
+    WCS shifts.
+
+    Args:
+        pipeview_out: Output of pipeview.pl, including the two header lines.
+        field: Field to keep the shifts of.
+
+    Returns:
+        A structured array with columns `expnum`, `ccd`, `rashift` and
+        `decshift`, with one row per valid WCS solution.
+    """
+    rows = []
+    for line in pipeview_out.splitlines()[2:]:
+        cols = line.split()
+        # Checks Valid Line
+        if len(cols) < 7 or cols[1] != '1':
+            continue
+        name = cols[0]
+        if name.split('.')[0] != field:
+            continue
+        try:
+            expnum = int(name.split('_')[0].split('.')[-1])
+            ccd = int(name.split('_')[1].split('.')[0])
+            rows.append((expnum, ccd, float(cols[5]), float(cols[6])))
+        except (IndexError, ValueError):
+            continue
+
+    return np.array(rows, dtype=SHIFT_DTYPE)
+
+
+def _mean_shift(table: np.ndarray, close: np.ndarray) -> List[float]:
+    """
+    Average the shifts of the close rows, or of all rows if none are close.
+    """
+    if len(table) == 0:
+        return [0, 0]
+    if close.any():
+        table = table[close]
+
+    return [float(table['rashift'].mean()), float(table['decshift'].mean())]
+
+
+class PipeviewShifts:
+    def __init__(self,
+                 ut: str,
+                 field: str,
+                 cache_dir: Optional[Union[str, Path]] = None,
+                 workspace_ut_dir: Optional[Union[str, Path]] = None,
+                 max_age: float = 300
+                 ):
+        """
+        Constructor method.
+
+        The WCS shifts of all CCDs of a field are read with a single
+        pipeview.pl call, and cached on disk so that every CCD job of the
+        night can share them.
+
+        Args:
+            ut: UT date of the run in the form `utYYMMDD`.
+            field: Field name.
+            cache_dir: Directory to cache the shift table in. Defaults to
+                the dwfprepipe cache directory.
+            workspace_ut_dir: Photepipe workspace directory of the night.
+                If given, the cache is invalidated whenever a SCAMP header
+                (`.head`) of the field in one of its CCD directories is
+                newer than the cache, i.e. new WCS solutions may have
+                appeared.
+            max_age: Maximum age of the cache in seconds.
+
+        Returns:
+            None
+        """
+
+        self.logger = logging.getLogger('dwf_prepipe.shifts.PipeviewShifts')
+
+        self.ut = ut
+        self.field = field
+        self.max_age = max_age
+        self.workspace_ut_dir = None
+        if workspace_ut_dir is not None:
+            self.workspace_ut_dir = Path(workspace_ut_dir)
+
+        if cache_dir is None:
+            cache_dir = get_cache_dir() / 'shifts'
+        self.cache_path = Path(cache_dir) / f'{ut}_{field}.npy'
+
+        self._table = None
+        self._loaded = 0
+
+    def _cache_valid(self) -> bool:
+        if not self.cache_path.is_file():
+            return False
+
+        cache_mtime = self.cache_path.stat().st_mtime
+        if time.time() - cache_mtime > self.max_age:
+            return False
+
+        # A night without a workspace yet has no WCS solutions to check
+        if self.workspace_ut_dir is not None and \
+                self.workspace_ut_dir.is_dir():
+            if self._newest_solution() > cache_mtime:
+                return False
+
+        return True
+
+    def _newest_solution(self) -> float:
+        """
+        Get the modification time of the newest SCAMP header of the field
+        in the CCD directories of the workspace. Other products (catalogs,
+        masks, calibration caches) change with every frame, so they are
+        ignored.
+        """
+        prefix = f'{self.field}.'
+        newest = 0
+        with os.scandir(self.workspace_ut_dir) as ccd_dirs:
+            for ccd_dir in ccd_dirs:
+                if not (ccd_dir.name.isdigit() and ccd_dir.is_dir()):
+                    continue
+                with os.scandir(ccd_dir.path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(prefix) and \
+                                entry.name.endswith('.head'):
+                            newest = max(newest, entry.stat().st_mtime)
+
+        return newest
+
+    def refresh(self):
+        """
+        Re-run pipeview.pl and update the on-disk cache.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.logger.debug(f"Running pipeview.pl for {self.field} "
+                          f"on {self.ut}"
+                          )
+        pipeview_out = subprocess.check_output(['pipeview.pl',
+                                                '-red',
+                                                self.ut,
+                                                '1-60',
+                                                '-stage',
+                                                'WCSNON',
+                                                '-wcs',
+                                                '-im',
+                                                self.field
+                                                ],
+                                               stderr=subprocess.STDOUT,
+                                               universal_newlines=True
+                                               )
+        self._table = parse_pipeview(pipeview_out, self.field)
+        self._loaded = time.time()
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix(f'.tmp{os.getpid()}')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self._table)
+        os.replace(tmp_path, self.cache_path)
+
+    @property
+    def table(self) -> np.ndarray:
+        """
+        The table of WCS shifts, refreshed if the cache is stale.
+        """
+        if self._cache_valid():
+            cache_mtime = self.cache_path.stat().st_mtime
+            if self._table is None or self._loaded < cache_mtime:
+                self._table = np.load(self.cache_path)
+                self._loaded = cache_mtime
+        else:
+            self.refresh()
+
+        return self._table
+
+    def shift_ccd(self, ccd: Union[int, str], expnum: Union[int, str],
+                  max_dexp: int = 7) -> List[float]:
+        """
+        Average shift of a CCD over the nearby exposures of the field.
+
+        Args:
+            ccd: CCD number.
+            expnum: Exposure number.
+            max_dexp: Exposures closer than this are averaged. If there
+                are none, all exposures of the CCD are used.
+
+        Returns:
+            The RA and Dec shifts.
+        """
+        table = self.table
+        table = table[table['ccd'] == int(ccd)]
+        close = np.abs(table['expnum'] - int(expnum)) < max_dexp
+
+        return _mean_shift(table, close)
+
+    def shift_exp(self, ccd: Union[int, str], expnum: Union[int, str],
+                  max_dccd: int = 3) -> List[float]:
+        """
+        Average shift of the nearby CCDs of a single exposure.
+
+        Args:
+            ccd: CCD number.
+            expnum: Exposure number.
+            max_dccd: CCDs closer than this are averaged. If there are
+                none, all CCDs of the exposure are used.
+
+        Returns:
+            The RA and Dec shifts.
+        """
+        table = self.table
+        table = table[table['expnum'] == int(expnum)]
+        close = np.abs(table['ccd'] - int(ccd)) < max_dccd
+
+        return _mean_shift(table, close)
+
+    def shift_field(self, ccd: Union[int, str],
+                    max_dccd: int = 3) -> List[float]:
+        """
+        Average shift of the nearby CCDs over all exposures of the field.
+
+        Args:
+            ccd: CCD number.
+            max_dccd: CCDs closer than this are averaged. If there are
+                none, all CCDs are used.
+
+        Returns:
+            The RA and Dec shifts.
+        """
+        table = self.table
+        close = np.abs(table['ccd'] - int(ccd)) < max_dccd
+
+        return _mean_shift(table, close)
+
+
+_shift_services: Dict[Tuple[str, str], PipeviewShifts] = {}
+
+
+def default_workspace_ut_dir(ut: str) -> Optional[Path]:
+    """
+    Get the Photepipe workspace directory of a night from the
+    PHOTEPIPE_RAWDIR environment variable, as `prepipe_process_ccd` does.
+
+    Args:
+        ut: UT date of the run in the form `utYYMMDD`.
+
+    Returns:
+        The directory, or None if PHOTEPIPE_RAWDIR is not set.
+    """
+    photepipe_rawdir = os.getenv("PHOTEPIPE_RAWDIR")
+    if photepipe_rawdir is None:
+        return None
+
+    return Path(photepipe_rawdir.replace('rawdata', 'workspace')) / ut
+
+
+def get_shift_service(ut: str,
+                      field: str,
+                      workspace_ut_dir: Optional[Union[str, Path]] = None,
+                      **kwargs
+                      ) -> PipeviewShifts:
+    """
+    Get the process-wide shift service of a field.
+
+    Args:
+        ut: UT date of the run in the form `utYYMMDD`.
+        field: Field name.
+        workspace_ut_dir: Photepipe workspace directory of the night, used
+            to invalidate the cache when new WCS solutions appear. Defaults
+            to `default_workspace_ut_dir`.
+        **kwargs: Passed to `PipeviewShifts` on first use.
+
+    Returns:
+        The shift service.
+    """
+    if workspace_ut_dir is None:
+        workspace_ut_dir = default_workspace_ut_dir(ut)
+
+    key = (ut, field)
+    if key not in _shift_services:
+        kwargs['workspace_ut_dir'] = workspace_ut_dir
+        _shift_services[key] = PipeviewShifts(ut, field, **kwargs)
+    elif workspace_ut_dir is not None:
+        _shift_services[key].workspace_ut_dir = Path(workspace_ut_dir)
+
+    return _shift_services[key]
+
+
+def get_shift_ccd(ut, ccd, Field, expnum, workspace_ut_dir=None):
+    return get_shift_service(ut, Field, workspace_ut_dir).shift_ccd(ccd,
+                                                                    expnum
+                                                                    )
+
+
+def get_shift_exp(ut, ccd, exp, Field, workspace_ut_dir=None):
+    return get_shift_service(ut, Field, workspace_ut_dir).shift_exp(ccd, exp)
+
+
+def get_shift_field(ut, ccd, exp, Field, workspace_ut_dir=None):
+    return get_shift_service(ut, Field, workspace_ut_dir).shift_field(ccd)
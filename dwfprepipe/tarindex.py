@@ -0,0 +1,183 @@
+import os
+import json
+import logging
+import tarfile
+
+from pathlib import Path
+from typing import Union, Dict, Tuple, Optional
+
+logger = logging.getLogger('dwf_prepipe.tarindex')
+
+# Bytes copied at a time when extracting a member
+COPY_CHUNK = 2 ** 20
+
+
+def tar_index_path(tar_path: Union[str, Path]) -> Path:
+    """
+    Get the path of the index of a tarball, which sits next to it.
+    """
+    tar_path = Path(tar_path)
+
+    return tar_path.with_name(f'{tar_path.name}.index.json')
+
+
+def build_tar_index(tar_path: Union[str, Path]
+                    ) -> Dict[str, Tuple[int, int]]:
+    """
+    Index the members of an uncompressed tarball with a single scan of its
+    headers. The member data are skipped, not read.
+
+    Args:
+        tar_path: Path to the tarball.
+
+    Returns:
+        A dictionary of the offset and size in bytes of the data of each
+        regular file in the tarball, by file name. Directories in the
+        member names (e.g. `./`) are dropped.
+    """
+    index = {}
+    with tarfile.open(tar_path, mode='r:') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = Path(member.name).name
+            if name in index:
+                logger.warning(f"{tar_path} has more than one member named "
+                               f"{name}. Using the last one."
+                               )
+            index[name] = (member.offset_data, member.size)
+
+    return index
+
+
+def write_tar_index(tar_path: Union[str, Path]
+                    ) -> Dict[str, Tuple[int, int]]:
+    """
+    Index the members of a tarball, and write the index next to it so that
+    the jobs reading it do not need to scan it again.
+
+    Args:
+        tar_path: Path to the tarball.
+
+    Returns:
+        The index, see `build_tar_index`.
+    """
+    tar_path = Path(tar_path)
+    index = build_tar_index(tar_path)
+
+    index_path = tar_index_path(tar_path)
+    tmp_path = index_path.with_name(f'{index_path.name}.tmp{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        json.dump({'tar_size': tar_path.stat().st_size,
+                   'members': index,
+                   }, f)
+    os.replace(tmp_path, index_path)
+
+    logger.debug(f"Indexed {len(index)} members of {tar_path}")
+
+    return index
+
+
+def load_tar_index(tar_path: Union[str, Path]
+                   ) -> Dict[str, Tuple[int, int]]:
+    """
+    Load the index of a tarball, building it if it does not exist or does
+    not match the tarball.
+
+    Args:
+        tar_path: Path to the tarball.
+
+    Returns:
+        The index, see `build_tar_index`.
+    """
+    tar_path = Path(tar_path)
+    index_path = tar_index_path(tar_path)
+
+    try:
+        with open(index_path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+
+    if saved is None or saved['tar_size'] != tar_path.stat().st_size:
+        logger.info(f"No valid index for {tar_path}. Building it...")
+        return write_tar_index(tar_path)
+
+    return {name: tuple(entry) for name, entry in saved['members'].items()}
+
+
+def _member_range(tar_path: Union[str, Path],
+                  name: str,
+                  index: Optional[Dict[str, Tuple[int, int]]]
+                  ) -> Tuple[int, int]:
+    if index is None:
+        index = load_tar_index(tar_path)
+
+    if name not in index:
+        raise KeyError(f"{name} is not in {tar_path}")
+
+    return index[name]
+
+
+def read_member(tar_path: Union[str, Path],
+                name: str,
+                index: Optional[Dict[str, Tuple[int, int]]] = None
+                ) -> bytes:
+    """
+    Read a member of a tarball with a single seek and read.
+
+    Args:
+        tar_path: Path to the tarball.
+        name: File name of the member.
+        index: Index of the tarball. If None, it is loaded.
+
+    Returns:
+        The contents of the member.
+
+    Raises:
+        KeyError: The member is not in the tarball.
+    """
+    offset, size = _member_range(tar_path, name, index)
+
+    with open(tar_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def extract_member(tar_path: Union[str, Path],
+                   name: str,
+                   dest: Union[str, Path],
+                   index: Optional[Dict[str, Tuple[int, int]]] = None
+                   ) -> Path:
+    """
+    Copy a member of a tarball to a file, without reading the rest of the
+    tarball.
+
+    Args:
+        tar_path: Path to the tarball.
+        name: File name of the member.
+        dest: Path to write the member to.
+        index: Index of the tarball. If None, it is loaded.
+
+    Returns:
+        The path to the member.
+
+    Raises:
+        KeyError: The member is not in the tarball.
+    """
+    offset, size = _member_range(tar_path, name, index)
+
+    dest = Path(dest)
+    tmp_path = dest.with_name(f'{dest.name}.tmp{os.getpid()}')
+    with open(tar_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        src.seek(offset)
+        remaining = size
+        while remaining > 0:
+            chunk = src.read(min(COPY_CHUNK, remaining))
+            if not chunk:
+                raise ValueError(f"{tar_path} is truncated in {name}")
+            dst.write(chunk)
+            remaining -= len(chunk)
+    os.replace(tmp_path, dest)
+
+    return dest
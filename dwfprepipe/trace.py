@@ -0,0 +1,298 @@
+import os
+import time
+import logging
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Union, List, Optional, Dict
+from dwfprepipe.utils import append_jsonl, read_jsonl
+
+
+def get_trace_id(file_name: Union[str, Path]) -> str:
+    """
+    Get the trace id of the exposure a file belongs to.
+
+    The trace id is the DECam root name of the exposure, e.g.
+    `DECam_00123456`, so that the tarball, the individual CCD .jp2 files
+    and the uncompressed CCD frames all map to the same id.
+
+    Args:
+        file_name: Name of (or path to) a file from the exposure.
+
+    Returns:
+        The trace id.
+    """
+    name = Path(file_name).name.split('.')[0]
+
+    return '_'.join(name.split('_')[:2])
+
+
+class TraceLog:
+    def __init__(self, path: Optional[Union[str, Path]] = None):
+        """
+        Constructor method.
+
+        Args:
+            path: Path to the shared trace log. If None, tracing is disabled
+                and all events are discarded.
+
+        Returns:
+            None
+        """
+
+        self.logger = logging.getLogger('dwf_prepipe.trace.TraceLog')
+
+        self.path = None if path is None else Path(path)
+        self.host = None
+        if self.enabled:
+            import socket
+            self.host = socket.gethostname()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def event(self,
+              trace_id: str,
+              stage: str,
+              event: str,
+              ccd: Optional[Union[str, int]] = None,
+              **info
+              ):
+        """
+        Write a single event to the trace log.
+
+        Args:
+            trace_id: Trace id of the exposure.
+            stage: Name of the processing stage, e.g. `prepipe.unpack`.
+            event: Name of the event, e.g. `start` or `end`.
+            ccd: CCD the event refers to, if any.
+            **info: Any other JSON-serialisable information to record.
+
+        Returns:
+            None
+        """
+
+        if not self.enabled:
+            return
+
+        record = {'trace_id': trace_id,
+                  'stage': stage,
+                  'event': event,
+                  'time': time.time(),
+                  'host': self.host,
+                  'pid': os.getpid(),
+                  }
+        if ccd is not None:
+            record['ccd'] = int(ccd)
+        record.update(info)
+
+        try:
+            append_jsonl(self.path, record)
+        except OSError as e:
+            self.logger.warning(f"Could not write to trace log "
+                                f"{self.path}: {e}"
+                                )
+
+    @contextmanager
+    def span(self,
+             trace_id: str,
+             stage: str,
+             ccd: Optional[Union[str, int]] = None,
+             **info
+             ):
+        """
+        Record the start and end of a processing stage.
+
+        Args:
+            trace_id: Trace id of the exposure.
+            stage: Name of the processing stage.
+            ccd: CCD the stage refers to, if any.
+            **info: Any other JSON-serialisable information to record.
+
+        Returns:
+            None
+        """
+
+        self.event(trace_id, stage, 'start', ccd=ccd, **info)
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            self.event(trace_id, stage, 'end', ccd=ccd, status=status, **info)
+
+
+def get_trace_log(path: Optional[Union[str, Path]] = None) -> TraceLog:
+    """
+    Get a trace log, falling back to the PREPIPE_TRACE_LOG environment
+    variable if no path is provided.
+
+    Args:
+        path: Path to the shared trace log.
+
+    Returns:
+        A TraceLog, which is disabled if no path is available.
+    """
+    if path is None:
+        path = os.getenv("PREPIPE_TRACE_LOG")
+
+    return TraceLog(path)
+
+
+def read_trace_logs(paths: List[Union[str, Path]]) -> List[dict]:
+    """
+    Read and merge one or more trace logs, e.g. the CTIO and OzSTAR logs.
+
+    Args:
+        paths: Trace logs to read.
+
+    Returns:
+        All events, sorted by time.
+    """
+    events = []
+    for path in paths:
+        events.extend(read_jsonl(path))
+
+    return sorted(events, key=lambda e: e['time'])
+
+
+def _is_parent_stage(name: str, stages) -> bool:
+    return any(other.startswith(f'{name}.') for other in stages)
+
+
+def build_timelines(events: List[dict]) -> Dict[str, dict]:
+    """
+    Reconstruct per-exposure timelines from trace events.
+
+    The duration of a stage is measured from its first start to its last
+    end across all CCDs of the exposure. Stages are nested by name, e.g.
+    `ccd.decompress` is part of `ccd`, and the gaps between consecutive
+    innermost stages (e.g. transfer or queue waits) are reported as
+    separate `a->b` stages.
+
+    Args:
+        events: Trace events, as returned by `read_trace_logs`.
+
+    Returns:
+        A dictionary of timelines keyed by trace id.
+    """
+    grouped = {}
+    for e in events:
+        grouped.setdefault(e['trace_id'], []).append(e)
+
+    timelines = {}
+    for trace_id, trace_events in grouped.items():
+        stages = {}
+        night = None
+        ccds_done = set()
+        ccds_failed = set()
+        for e in trace_events:
+            night = night or e.get('night')
+            stage = stages.setdefault(e['stage'],
+                                      {'start': e['time'], 'end': e['time']}
+                                      )
+            stage['start'] = min(stage['start'], e['time'])
+            stage['end'] = max(stage['end'], e['time'])
+
+            if e['stage'] == 'ccd' and e['event'] == 'end':
+                if e.get('status') == 'ok':
+                    ccds_done.add(e.get('ccd'))
+                else:
+                    ccds_failed.add(e.get('ccd'))
+
+        ordered = sorted(stages.items(), key=lambda s: s[1]['start'])
+        durations = {name: stage['end'] - stage['start']
+                     for name, stage in ordered
+                     }
+
+        leaves = [(name, stage) for name, stage in ordered
+                  if not _is_parent_stage(name, stages)
+                  ]
+        for (prev_name, prev_stage), (name, stage) in zip(leaves,
+                                                          leaves[1:]
+                                                          ):
+            gap = stage['start'] - prev_stage['end']
+            if gap > 0:
+                durations[f'{prev_name}->{name}'] = gap
+
+        start = trace_events[0]['time']
+        end = trace_events[-1]['time']
+        timelines[trace_id] = {'night': night,
+                               'start': start,
+                               'end': end,
+                               'latency': end - start,
+                               'ccds_done': len(ccds_done),
+                               'ccds_failed': len(ccds_failed - ccds_done),
+                               'stages': dict(ordered),
+                               'durations': durations,
+                               }
+
+    return timelines
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    import statistics
+
+    values = sorted(values)
+    if len(values) == 1:
+        p50 = p90 = values[0]
+    else:
+        deciles = statistics.quantiles(values, n=10, method='inclusive')
+        p50 = deciles[4]
+        p90 = deciles[8]
+
+    return {'n': len(values),
+            'min': values[0],
+            'p50': p50,
+            'p90': p90,
+            'max': values[-1],
+            }
+
+
+def summarise_latencies(timelines: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Summarise the latency distribution of each night.
+
+    Args:
+        timelines: Per-exposure timelines, as returned by `build_timelines`.
+
+    Returns:
+        A dictionary keyed by night containing the distribution of the
+        end-to-end latency, the distribution of each stage duration and
+        the slowest innermost stage or gap (by median duration).
+    """
+    nights = {}
+    for timeline in timelines.values():
+        night = timeline['night'] or 'unknown'
+        nights.setdefault(night, []).append(timeline)
+
+    summary = {}
+    for night, night_timelines in nights.items():
+        stage_durations = {}
+        for timeline in night_timelines:
+            for stage, duration in timeline['durations'].items():
+                stage_durations.setdefault(stage, []).append(duration)
+
+        stages = {stage: _percentiles(durations)
+                  for stage, durations in stage_durations.items()
+                  }
+        # Only innermost stages and the gaps between them are candidates,
+        # as parent stages always contain their slowest child
+        candidates = [stage for stage in stages
+                      if not _is_parent_stage(stage, stages)
+                      ]
+        slowest = max(candidates,
+                      key=lambda s: stages[s]['p50'],
+                      default=None
+                      )
+
+        summary[night] = {
+            'latency': _percentiles([t['latency'] for t in night_timelines]),
+            'stages': stages,
+            'slowest_stage': slowest,
+        }
+
+    return summary
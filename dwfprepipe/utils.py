@@ -1,10 +1,14 @@
+import os
+import json
+import queue
+import atexit
+import shutil
 import logging
 import logging.handlers
-import logging.config
 import time
 from pathlib import Path
 
-from typing import Optional, Union
+from typing import Optional, Union, List, Tuple, TextIO
 
 try:
     import colorlog
@@ -13,28 +17,51 @@ except ImportError:
     use_colorlog = False
 
 
-def get_logger(debug: bool,
-               quiet: bool,
-               logfile: Optional[Union[str, Path]] = None
-               ):
+# Handlers installed on the root logger by `get_logger`, and the listener
+# that writes the queued records
+_log_handlers: List[logging.Handler] = []
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
     """
-    Initiate a logger.
+    Format log records as single-line JSON objects.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record, self.datefmt),
+                 'level': record.levelname,
+                 'name': record.name,
+                 'process': record.process,
+                 'message': record.getMessage(),
+                 }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+def make_log_handlers(debug: bool,
+                      quiet: bool,
+                      logfile: Optional[Union[str, Path]] = None,
+                      json_logs: bool = False,
+                      stream: Optional[TextIO] = None
+                      ) -> List[logging.Handler]:
+    """
+    Create the handlers that write the log.
 
     Args:
-        debug: Set the logging level to debug.
-        quiet: Suppress all non-essential output by setting the logging level
-            to warning.
-        logfile: File to write the log to.
+        debug: Set the level of the stream to debug.
+        quiet: Set the level of the stream to warning.
+        logfile: File to write the log to, at the debug level.
+        json_logs: Write the log file, or the stream if there is no log
+            file, as JSON lines.
+        stream: Stream to write to. Defaults to stderr.
 
     Returns:
-        A logger.
+        The handlers.
     """
-
-    logger = logging.getLogger()
-    s = logging.StreamHandler()
-    if logfile is not None:
-        fh = logging.FileHandler(logfile)
-        fh.setLevel(logging.DEBUG)
+    s = logging.StreamHandler(stream)
     logformat = '[%(asctime)s] - %(levelname)s - %(message)s'
 
     if use_colorlog:
@@ -54,7 +81,12 @@ def get_logger(debug: bool,
     else:
         formatter = logging.Formatter(logformat, datefmt="%Y-%m-%d %H:%M:%S")
 
-    s.setFormatter(formatter)
+    json_formatter = JsonFormatter(datefmt="%Y-%m-%dT%H:%M:%S")
+
+    if json_logs and logfile is None:
+        s.setFormatter(json_formatter)
+    else:
+        s.setFormatter(formatter)
 
     if debug:
         s.setLevel(logging.DEBUG)
@@ -64,13 +96,134 @@ def get_logger(debug: bool,
         else:
             s.setLevel(logging.INFO)
 
-    logger.addHandler(s)
+    handlers = [s]
 
     if logfile is not None:
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        fh = logging.FileHandler(logfile)
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(json_formatter if json_logs else formatter)
+        handlers.append(fh)
+
+    return handlers
+
+
+def start_log_queue(logger: logging.Logger,
+                    handlers: List[logging.Handler]
+                    ) -> Tuple[logging.handlers.QueueHandler,
+                               logging.handlers.QueueListener]:
+    """
+    Send the records of a logger through a queue to handlers that are run
+    by a background thread, so that logging does not block on I/O.
+
+    Args:
+        logger: The logger.
+        handlers: Handlers to write the records with.
+
+    Returns:
+        The handler added to the logger, and the listener running the
+        handlers. The listener must be stopped to flush the queue.
+    """
+    log_queue = queue.SimpleQueue()
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setLevel(min(handler.level for handler in handlers))
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue,
+                                              *handlers,
+                                              respect_handler_level=True
+                                              )
+    listener.start()
+
+    return queue_handler, listener
+
 
-    logger.setLevel(logging.DEBUG)
+def stop_logging():
+    """
+    Flush the log queue and remove the handlers installed by `get_logger`.
+    """
+    global _log_listener
+
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+    root = logging.getLogger()
+    for handler in _log_handlers:
+        root.removeHandler(handler)
+        handler.close()
+    _log_handlers.clear()
+
+
+def _log_after_fork():
+    """
+    The listener thread does not survive a fork, so write the log of a
+    forked child (e.g. a process pool worker) directly.
+    """
+    global _log_listener
+
+    if _log_listener is None:
+        return
+
+    root = logging.getLogger()
+    for handler in _log_handlers:
+        root.removeHandler(handler)
+    _log_handlers[:] = _log_listener.handlers
+    for handler in _log_handlers:
+        root.addHandler(handler)
+    _log_listener = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_log_after_fork)
+atexit.register(stop_logging)
+
+
+def get_logger(debug: bool,
+               quiet: bool,
+               logfile: Optional[Union[str, Path]] = None,
+               json_logs: bool = False,
+               queued: bool = True
+               ):
+    """
+    Initiate a logger.
+
+    Calling this again replaces the handlers it installed, rather than
+    adding more.
+
+    Args:
+        debug: Set the logging level to debug.
+        quiet: Suppress all non-essential output by setting the logging level
+            to warning.
+        logfile: File to write the log to.
+        json_logs: Write the log file, or the terminal output if there is no
+            log file, as JSON lines.
+        queued: Write the log from a background thread, so that logging
+            calls do not wait for the terminal or the file.
+
+    Returns:
+        A logger.
+    """
+    global _log_listener
+
+    logger = logging.getLogger()
+
+    stop_logging()
+
+    handlers = make_log_handlers(debug, quiet, logfile, json_logs=json_logs)
+
+    if queued:
+        queue_handler, _log_listener = start_log_queue(logger, handlers)
+        _log_handlers.append(queue_handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+        _log_handlers.extend(handlers)
+
+    # Records below every handler level are dropped before they are made
+    logger.setLevel(min(handler.level for handler in handlers))
 
     return logger
 
@@ -82,6 +235,9 @@ def wait_for_file(filepath: Union[str, Path],
     """
     Check if a file is still being written, and if so, wait for it to finish.
 
+    This is only a fallback for files without a manifest (see
+    `dwfprepipe.manifest`), as a stalled transfer can look finished.
+
     Args:
         filepath: Path to the file of interest
         wait_time: Time to wait between file size checks
@@ -107,3 +263,124 @@ def wait_for_file(filepath: Union[str, Path],
             return False
 
         fsize_old = fsize_new
+
+
+def get_cache_dir() -> Path:
+    """
+    Get the directory used to cache derived data products.
+
+    Defaults to `~/.cache/dwfprepipe`, and can be overridden with the
+    PREPIPE_CACHE_DIR environment variable. Created if it does not exist.
+
+    Returns:
+        The cache directory.
+    """
+    cache_dir = os.getenv("PREPIPE_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = Path.home() / '.cache' / 'dwfprepipe'
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    return cache_dir
+
+
+def append_jsonl(path: Union[str, Path], record: dict):
+    """
+    Append a single record to a JSON-lines file.
+
+    The record is written with a single `write` call on a file opened in
+    append mode, so concurrent writers on the same host do not interleave
+    partial lines.
+
+    Args:
+        path: Path to the JSON-lines file. Created if it does not exist.
+        record: JSON-serialisable dictionary to append.
+
+    Returns:
+        None
+    """
+    line = json.dumps(record, sort_keys=True) + '\n'
+
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def read_jsonl(path: Union[str, Path]) -> List[dict]:
+    """
+    Read all records from a JSON-lines file.
+
+    Lines that cannot be parsed (e.g. a partially written final line) are
+    skipped.
+
+    Args:
+        path: Path to the JSON-lines file.
+
+    Returns:
+        A list of records, in the order they were written. Empty if the
+        file does not exist.
+    """
+    path = Path(path)
+    if not path.is_file():
+        return []
+
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+    return records
+
+
+# ioctl request number to clone a file's extents (Linux, e.g. Btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def link_or_copy(src: Union[str, Path], dst: Union[str, Path]) -> str:
+    """
+    Make `dst` a copy of `src` without duplicating its data where the
+    filesystem supports it.
+
+    A hardlink is tried first, then a reflink (copy-on-write clone), and
+    finally a streamed copy. Hardlinked files share their data, so the
+    caller must replace `dst` rather than modify it in place.
+
+    Args:
+        src: Path to the source file.
+        dst: Path to the destination file. Replaced if it exists.
+
+    Returns:
+        The method used, one of `hardlink`, `reflink` or `copy`.
+    """
+    src = Path(src)
+    dst = Path(dst)
+
+    if dst.exists():
+        dst.unlink()
+
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return 'reflink'
+    except (ImportError, OSError):
+        pass
+
+    shutil.copyfile(src, dst)
+
+    return 'copy'
@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+import concurrent.futures
+
+from typing import Callable, List, Dict, Optional
+
+logger = logging.getLogger('dwf_prepipe.workqueue')
+
+TAG_READY = 1
+TAG_TASK = 2
+TAG_STOP = 3
+
+
+def _run_task(func: Callable, task, worker) -> dict:
+    """
+    Run a single task, catching and timing any failure so that one bad
+    task does not stop the worker.
+    """
+    start = time.time()
+    try:
+        func(task)
+        error = None
+    except Exception as e:
+        logger.exception(f"Task {task} failed")
+        error = str(e)
+
+    return {'worker': worker,
+            'task': task,
+            'start': start,
+            'end': time.time(),
+            'error': error,
+            }
+
+
+def _run_local_task(func: Callable, task) -> dict:
+    return _run_task(func, task, f'pid {os.getpid()}')
+
+
+def run_local(func: Callable,
+              tasks: list,
+              n_workers: int = 1,
+              initializer: Optional[Callable] = None,
+              initargs: tuple = ()
+              ) -> List[dict]:
+    """
+    Run tasks on a pool of local worker processes. Each worker takes the
+    next task as soon as it finishes its previous one.
+
+    Args:
+        func: Function to run on each task. Must be picklable if
+            `n_workers` is more than one.
+        tasks: Tasks to run, in the order they should be started.
+        n_workers: Number of worker processes. If one, the tasks are run
+            in this process.
+        initializer: Function to run in each worker before its first task.
+        initargs: Arguments of `initializer`.
+
+    Returns:
+        A report of every task, containing the worker it ran on, its start
+        and end time, and the error message if it failed.
+    """
+    if n_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [_run_local_task(func, task) for task in tasks]
+
+    reports = []
+    with concurrent.futures.ProcessPoolExecutor(n_workers,
+                                                initializer=initializer,
+                                                initargs=initargs
+                                                ) as pool:
+        futures = [pool.submit(_run_local_task, func, task)
+                   for task in tasks
+                   ]
+        for future in concurrent.futures.as_completed(futures):
+            reports.append(future.result())
+
+    return reports
+
+
+def run_mpi(func: Callable, tasks: list, comm) -> Optional[List[dict]]:
+    """
+    Run tasks on MPI ranks with a master/worker pattern. Rank 0 hands out
+    the tasks one at a time, and every other rank asks for its next task
+    as soon as it finishes its previous one. With a single rank, the tasks
+    are run on it.
+
+    Args:
+        func: Function to run on each task.
+        tasks: Tasks to run, in the order they should be started. Only
+            used on rank 0.
+        comm: MPI communicator.
+
+    Returns:
+        On rank 0, a report of every task (see `run_local`). None on all
+        other ranks.
+    """
+    from mpi4py import MPI
+
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    if size == 1:
+        return [_run_task(func, task, 'rank 0') for task in tasks]
+
+    if rank != 0:
+        report = None
+        status = MPI.Status()
+        while True:
+            comm.send(report, dest=0, tag=TAG_READY)
+            task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == TAG_STOP:
+                return None
+            report = _run_task(func, task, f'rank {rank}')
+
+    reports = []
+    pending = iter(tasks)
+    n_active = size - 1
+    status = MPI.Status()
+    while n_active:
+        report = comm.recv(source=MPI.ANY_SOURCE,
+                           tag=TAG_READY,
+                           status=status
+                           )
+        if report is not None:
+            reports.append(report)
+
+        worker = status.Get_source()
+        task = next(pending, None)
+        if task is None:
+            comm.send(None, dest=worker, tag=TAG_STOP)
+            n_active -= 1
+        else:
+            comm.send(task, dest=worker, tag=TAG_TASK)
+
+    return reports
+
+
+def summarise_utilisation(reports: List[dict],
+                          wall_time: float
+                          ) -> Dict[str, dict]:
+    """
+    Summarise how busy each worker was.
+
+    Args:
+        reports: Task reports from `run_local` or `run_mpi`.
+        wall_time: Wall time of the whole run in seconds.
+
+    Returns:
+        A dictionary of the number of tasks, number of failed tasks, busy
+        time and utilisation (busy time over wall time) of each worker.
+    """
+    summary = {}
+    for report in reports:
+        worker = summary.setdefault(report['worker'], {'tasks': 0,
+                                                       'failed': 0,
+                                                       'busy': 0.0,
+                                                       })
+        worker['tasks'] += 1
+        worker['failed'] += report['error'] is not None
+        worker['busy'] += report['end'] - report['start']
+
+    for worker in summary.values():
+        worker['utilisation'] = worker['busy'] / wall_time
+
+    return summary
@@ -18,6 +18,12 @@ setup(
         "bin/prepipe_reprocess.py",
         "bin/run_prepipe.py",
         "bin/run_push.py",
+        "bin/prepipe_latency.py",
+        "bin/prepipe_prepare_gaia.py",
+        "bin/prepipe_benchmark.py",
+        "bin/prepipe_astrometry.py",
+        "bin/prepipe_build_bpm.py",
+        "bin/prepipe_build_masters.py",
     ],
     include_package_data=True
 )
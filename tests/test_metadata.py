@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from dwfprepipe.metadata import (read_header,
+                                 read_metadata,
+                                 metadata_from_header
+                                 )
+
+
+@pytest.fixture
+def decam_frame(tmp_path):
+    """
+    A raw DECam CCD frame with the kinds of cards its header has.
+    """
+    header = fits.Header()
+    header['OBSTYPE'] = ('object', 'Observation type')
+    header['EXPNUM'] = (1234567, 'DECam exposure number')
+    header['OBJECT'] = ('8hr', 'Object name')
+    header['FILTER'] = ('g DECam SDSS c0001 4720.0 1520.0', 'Unique filter')
+    header['CCDNUM'] = (25, 'CCD number')
+    header['DATE-OBS'] = ('2026-10-18T23:41:02.123456', 'UTC exposure start')
+    header['EXPTIME'] = (20.0, 'Exposure time [s]')
+    header['MJD-OBS'] = (61331.98683013, 'MJD of observation start')
+    header['CRVAL1'] = (1.23456789012345e2, 'World coordinate')
+    header['CD1_1'] = (-7.2831e-05, 'Linear projection matrix')
+    header['SATURATA'] = (43451, 'Saturation level of amp A')
+    header['PHOTFLAG'] = (True, 'Night is photometric')
+    header['DETSEC'] = ('[2049:4096,12289:16384]', 'Detector section')
+    header['OBSERVER'] = ("O'Neil, Goode", 'Observer name(s)')
+    header['PROPOSER'] = ('', 'Proposal PI')
+    header['PROGRAM'] = ('Deeper, Wider, Faster: the fast transient '
+                         'programme with the Dark Energy Camera on the '
+                         'Blanco telescope at CTIO, Chile',
+                         )
+    header['ZD'] = (None, 'Zenith distance')
+    header.add_comment('Raw frame')
+    header.add_history('Compressed with f2j_DECam')
+    header['AMPSECA'] = '[1:1024,1:4096]'
+
+    path = tmp_path / 'c4d_raw.fits'
+    fits.PrimaryHDU(np.zeros((4, 2), dtype='int16'),
+                    header=header
+                    ).writeto(path)
+
+    return path
+
+
+def test_read_header_matches_astropy(decam_frame):
+    """
+    Every valued card is read as astropy reads it, including long strings
+    continued over CONTINUE cards.
+    """
+    header = fits.getheader(decam_frame)
+    parsed = read_header(decam_frame)
+
+    keywords = [keyword for keyword in header
+                if keyword not in ('COMMENT', 'HISTORY', '')
+                ]
+    assert sorted(parsed) == sorted(keywords)
+    for keyword in keywords:
+        value = header[keyword]
+        if isinstance(value, fits.card.Undefined):
+            value = None
+        assert parsed[keyword] == value, keyword
+        assert type(parsed[keyword]) is type(value), keyword
+
+
+def test_read_metadata_matches_astropy(decam_frame):
+    assert read_metadata(decam_frame) == \
+        metadata_from_header(fits.getheader(decam_frame))
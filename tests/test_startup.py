@@ -0,0 +1,14 @@
+import pytest
+
+from dwfprepipe.benchmark import (STARTUP_BUDGET,
+                                  entry_points,
+                                  benchmark_startup
+                                  )
+
+
+@pytest.mark.parametrize('module', entry_points())
+def test_entry_point_startup(module):
+    """
+    Each command line entry point starts within the budget from cold.
+    """
+    assert benchmark_startup([module], STARTUP_BUDGET) == []